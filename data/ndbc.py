@@ -8,8 +8,16 @@ v0.1 Gabriel Garcia Medina (ggarcia@coas.oregonstate.edu) July 2014
 v0.2 Gabriel Garcia Medina (ggarcia@coas.oregonstate.edu) November 2014
 v0.3 Gabriel Garcia Medina (ggarcia@coas.oregonstate.edu) February 2015
      Added spec2nc
+v0.4 Bulk parameter files are parsed once per file and written with 
+     compressed NetCDF4 variables (read_bulk, bulk2nc)
+     Vectorized directional spectrum reconstruction with Fourier and MEM
+     methods (read_spec, reconstruct_dir_spec, spec2nc)
+     Incremental updates and multi-buoy parallel driver (convert_buoys)
+     Header formats are parsed once and cached (_bulk_schema, _spec_schema)
 """
 
+from __future__ import division, print_function
+
 __author__ = "Gabriel Garcia Medina"
 __email__ = "ggarcia@coas.oregonstate.edu"
 __group__ = 'Nearshore Modeling Group'
@@ -18,390 +26,932 @@ __group__ = 'Nearshore Modeling Group'
 import time
 import numpy as np
 import netCDF4
-import pylab as pl
 import sys
 import datetime
 import os
 import getpass
+import json
+import re
+import collections
+
+
+#===============================================================================
+# Archive management
+#===============================================================================
+def _manifest_name(ncfile):
+    """
+    Manifest of the text files ingested into a NetCDF file
+    """
+    return os.path.splitext(ncfile)[0] + '_manifest.json'
+
+
+def _load_manifest(ncfile):
+    """
+    Load the manifest of a NetCDF file (empty if it does not exist)
+    """
+    manifest_file = _manifest_name(ncfile)
+    if not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file,'r') as f:
+        return json.load(f)
+
+
+def _save_manifest(ncfile,manifest):
+    """
+    Save the manifest of a NetCDF file (written to a temporary file first 
+    and atomically renamed so an interrupted save keeps the previous 
+    manifest)
+    """
+    manifest_file = _manifest_name(ncfile)
+    with open(manifest_file + '.tmp','w') as f:
+        json.dump(manifest,f,indent=1,sort_keys=True)
+    os.replace(manifest_file + '.tmp',manifest_file)
+
+
+def _file_entry(filename,wave_time):
+    """
+    Manifest entry of a text file: size, modification time and time range
+    """
+    stat = os.stat(filename)
+    if wave_time.shape[0] > 0:
+        trange = [float(np.min(wave_time)),float(np.max(wave_time))]
+    else:
+        trange = [None,None]
+    return {'size':stat.st_size,'mtime':stat.st_mtime,
+            'time_range':trange,'records':int(wave_time.shape[0])}
+
+
+def _changed_files(folder,archivos,manifest):
+    """
+    Files that are not in the manifest or whose size or modification time 
+    changed since they were ingested
+    """
+    changed = []
+    for archivo in archivos:
+        stat = os.stat(os.path.join(folder,archivo))
+        entry = manifest.get(archivo)
+        if (entry is None or entry['size'] != stat.st_size or 
+            entry['mtime'] != stat.st_mtime):
+            changed.append(archivo)
+    return changed
+
+
+def _pending_files(ncfile,folder,archivos,incremental):
+    """
+    Text files to ingest into a NetCDF file. In incremental mode, if the 
+    NetCDF file exists, only the new or changed files are returned. 
+    
+    Returns the files, the manifest and whether the NetCDF file is appended.
+    """
+    if incremental and os.path.isfile(ncfile):
+        manifest = _load_manifest(ncfile)
+        return _changed_files(folder,archivos,manifest),manifest,True
+    return list(archivos),{},False
+
+
+def _sort_unique(wave_time,data):
+    """
+    Sort records chronologically and remove repeated times keeping the last
+    occurrence (i.e. the most recent data). data is a dictionary of arrays 
+    with time along the first axis.
+    """
+    sorted_index = np.argsort(wave_time,kind='mergesort')
+    wave_time = wave_time[sorted_index]
+    keep = np.append(np.diff(wave_time) != 0,True)
+    sorted_index = sorted_index[keep]
+    return (wave_time[keep],
+            dict((name,data[name][sorted_index]) for name in data))
+
+
+def _nc_merge_tail(nc,timename,wave_time,data):
+    """
+    Merge new records into the unlimited time dimension of an open NetCDF 
+    file keeping it sorted and without repeated times. 
+    
+    Only the records of the file after the first new time are read and 
+    rewritten, so appending data that are newer than the file only writes 
+    the new records. New records replace existing records with the same 
+    time.
+    
+    Returns the number of records of the time dimension.
+    """
+    
+    if wave_time.shape[0] == 0:
+        return nc.variables[timename].shape[0]
+    
+    ncvars = nc.variables
+    ncvars[timename].set_auto_mask(False)
+    old_time = ncvars[timename][:]
+    i0 = np.searchsorted(old_time,np.min(wave_time),side='left')
+    
+    # Existing records that overlap the new data
+    if i0 < old_time.shape[0]:
+        tail = {}
+        for name in data:
+            ncvars[name].set_auto_mask(False)
+            tail[name] = np.concatenate((ncvars[name][i0:],data[name]))
+        wave_time = np.concatenate((old_time[i0:],wave_time))
+        data = tail
+    
+    wave_time,data = _sort_unique(wave_time,data)
+    
+    # Write the merged records
+    i1 = i0 + wave_time.shape[0]
+    ncvars[timename][i0:i1] = wave_time
+    for name in data:
+        ncvars[name][i0:i1] = data[name]
+    
+    return i1
+
+
+def _nc_merge_blocks(nc,timename,wave_time,name,compute,time_block):
+    """
+    Merge new records of variable name computed block by block into the 
+    unlimited time dimension of an open NetCDF file (see _nc_merge_tail).
+    
+    wave_time must be sorted and compute(tb) must return the records of 
+    wave_time[tb]. The insertion point is found and the overlapping records 
+    of the file are read only once, then the merged records are written 
+    time_block at a time, so memory and work scale with the new data and 
+    the overlapping tail.
+    
+    Returns the number of records of the time dimension.
+    """
+    
+    if wave_time.shape[0] == 0:
+        return nc.variables[timename].shape[0]
+    
+    ncvars = nc.variables
+    ncvars[timename].set_auto_mask(False)
+    ncvars[name].set_auto_mask(False)
+    old_time = ncvars[timename][:]
+    i0 = np.searchsorted(old_time,wave_time[0],side='left')
+    
+    # Existing records that overlap the new data (read once)
+    old_data = ncvars[name][i0:]
+    nold = old_data.shape[0]
+    
+    # Merged order as indices: old records first and new records after 
+    # them, so new records win repeated times
+    merged_time,source = _sort_unique(
+        np.concatenate((old_time[i0:],wave_time)),
+        {'source':np.arange(nold + wave_time.shape[0])})
+    source = source['source']
+    
+    # Write the merged records in blocks
+    for bb in range(0,merged_time.shape[0],time_block):
+        src = source[bb:bb + time_block]
+        isnew = src >= nold
+        block = np.empty((src.shape[0],) + old_data.shape[1:],
+                         dtype=old_data.dtype)
+        block[~isnew] = old_data[src[~isnew]]
+        if np.any(isnew):
+            jj = src[isnew] - nold
+            block[isnew] = compute(slice(jj[0],jj[-1] + 1))[jj - jj[0]]
+        ncvars[timename][i0 + bb:i0 + bb + src.shape[0]] = \
+            merged_time[bb:bb + time_block]
+        ncvars[name][i0 + bb:i0 + bb + src.shape[0]] = block
+    
+    return i0 + merged_time.shape[0]
 
 
 #===============================================================================
 # Bulk parameter code
 #===============================================================================
-def bulk2nc(buoyfld,buoyid,ncformat=4):
+
+# Bulk parameter variables: name, header aliases, missing value flag, units 
+# and long name
+_BULK_VARS = [
+    ('WDIR',('WDIR','WD'),999,'degrees',
+     'Wind direction (direction the wind is coming from in ' + 
+     'degrees clockwise from true North'),
+    ('WSPD',('WSPD',),99,'meter second-1',
+     'Wind speed averaged over an eight-minute period'),
+    ('GST',('GST',),99,'meter second-1','Peak gust speed'),
+    ('WVHT',('WVHT',),99,'meter',
+     'Significant wave height during the 20 minute sampling period'),
+    ('DPD',('DPD',),99,'second',
+     'Dominant wave period (period with the maximum wave energy)'),
+    ('APD',('APD',),99,'second',
+     'Average wave period of all waves during the 20 minute' + 
+     ' sampling period'),
+    ('MWD',('MWD',),999,'degrees',
+     'The direction from which the waves at the dominant period ' + 
+     'are coming in degrees from true North, increasing clockwise'),
+    ('PRES',('PRES','BAR'),9999,'hPa','Sea level pressure'),
+    ('ATMP',('ATMP',),99,'Celsius','Air temperature'),
+    ('WTMP',('WTMP',),99,'Celsius','Sea surface temperature')
+    ]
+
+# Time reference of the NetCDF files
+_BASETIME = np.datetime64('1900-01-01T00:00:00','s')
+
+
+# Parsed header formats (see _bulk_schema and _spec_schema)
+_BulkSchema = collections.namedtuple('_BulkSchema',['ncols','time','columns'])
+_SpecSchema = collections.namedtuple('_SpecSchema',['ncols','time','ntime',
+                                                    'freq'])
+_SCHEMA_CACHE = {}
+
+# loadtxt is implemented in C from numpy 1.23, older versions are pure 
+# python and much slower than a single fromstring parse of the text
+_LOADTXT_C = np.lib.NumpyVersion(np.__version__) >= '1.23.0'
+
+
+def _read_header(filename):
+    """
+    Returns the column names and the number of header lines of an NDBC text
+    file (NDBC uses one or two header lines). Not for standalone use.
+    """
+    with open(filename,'r') as f:
+        header1 = f.readline()
+        header2 = f.readline()
+    
+    headcnt = 1
+    if header2.startswith('Y') or header2.startswith('#'):
+        headcnt = 2
+    
+    return header1.split(),headcnt
+
+
+def _read_numeric(filename,headcnt,ncols):
+    """
+    Read the data records of an NDBC text file into a (records,ncols) 
+    array. Uses the C loadtxt where available and otherwise parses the 
+    whole body after the header with one np.fromstring call. 
+    Not for standalone use.
+    """
+    if _LOADTXT_C:
+        tmpdata = np.loadtxt(filename,skiprows=headcnt,ndmin=2)
+        if tmpdata.shape[0] == 0:
+            tmpdata = np.zeros((0,ncols))
+    else:
+        with open(filename,'r') as f:
+            for aa in range(headcnt):
+                f.readline()
+            body = f.read()
+        nrec = len([x for x in body.splitlines() if x.strip()])
+        tmpdata = np.fromstring(body,dtype=np.float64,sep=' ')
+        if tmpdata.shape[0] != nrec*ncols:
+            raise ValueError('The records of ' + filename + ' do not ' + 
+                             'match the header')
+        tmpdata = tmpdata.reshape((nrec,ncols))
+    
+    if tmpdata.shape[1] != ncols:
+        raise ValueError('The records of ' + filename + ' do not match ' + 
+                         'the header')
+    return tmpdata
+
+
+def _time_schema(column):
+    """
+    Time columns of an NDBC text file given the column map of the header:
+    (year column, year offset, minute column or None). Month, day and hour
+    are the following columns. Not for standalone use.
+    """
+    
+    # Years (two digit years are in the 1900s)
+    if 'YY' in column:
+        years = (column['YY'],1900)
+    elif '#YY' in column:
+        years = (column['#YY'],0)
+    elif 'YYYY' in column:
+        years = (column['YYYY'],0)
+    else:
+        years = (column['#YYYY'],0)
+    
+    # Minutes
+    return years + (column.get('mm'),)
+
+
+def _bulk_schema(header,headcnt):
+    """
+    Column map of a bulk parameter file header (cached). 
+    Not for standalone use.
+    """
+    key = ('bulk',tuple(header),headcnt)
+    if key not in _SCHEMA_CACHE:
+        column = dict((name,ind) for ind,name in enumerate(header))
+        columns = []
+        for name,aliases,missing,_,_ in _BULK_VARS:
+            ind = None
+            for alias in aliases:
+                if alias in column:
+                    ind = column[alias]
+                    break
+            columns.append((name,ind,missing))
+        _SCHEMA_CACHE[key] = _BulkSchema(len(header),_time_schema(column),
+                                         columns)
+    return _SCHEMA_CACHE[key]
+
+
+def _spec_schema(header,headcnt):
+    """
+    Date columns and frequencies of a spectral file header (cached). 
+    Not for standalone use.
+    """
+    key = ('spec',tuple(header),headcnt)
+    if key not in _SCHEMA_CACHE:
+        
+        # The header has the date columns followed by the frequencies
+        ntime = 0
+        for name in header:
+            try:
+                float(name)
+                break
+            except ValueError:
+                ntime += 1
+        column = dict((name,ind) for ind,name in enumerate(header[:ntime]))
+        freq = np.array(header[ntime:],dtype=float)
+        freq.flags.writeable = False
+        _SCHEMA_CACHE[key] = _SpecSchema(len(header),_time_schema(column),
+                                         ntime,freq)
+    return _SCHEMA_CACHE[key]
+
+
+def _ndbc_time(years,months,days,hours,minutes):
+    """
+    Seconds since 1900-01-01 from arrays of date components. 
+    Not for standalone use.
+    """
+    months = ((years.astype(np.int64) - 1970)*12 + 
+              months.astype(np.int64) - 1).astype('datetime64[M]')
+    stamps = (months.astype('datetime64[s]') + 
+              ((days.astype(np.int64) - 1)*86400 + 
+               hours.astype(np.int64)*3600 + 
+               minutes.astype(np.int64)*60).astype('timedelta64[s]'))
+    return (stamps - _BASETIME).astype(np.float64)
+
+
+def _record_time(time_schema,tmpdata):
+    """
+    Seconds since 1900-01-01 of the records of an NDBC text file given the
+    time columns (see _time_schema). Not for standalone use.
+    """
+    ycol,yoffset,mcol = time_schema
+    years = tmpdata[:,ycol] + yoffset
+    if mcol is None:
+        mm = np.zeros((tmpdata.shape[0],))
+    else:
+        mm = tmpdata[:,mcol]
+    return _ndbc_time(years,tmpdata[:,ycol + 1],tmpdata[:,ycol + 2],
+                      tmpdata[:,ycol + 3],mm)
+
+
+def read_bulk(filename):
+    """
+    Read a single NDBC bulk parameter (standard meteorological) text file.
+    
+    USAGE:
+    ------
+    data = read_bulk(filename)
+    
+    PARAMETERS:
+    -----------
+    filename : NDBC bulk parameter text file
+    
+    RETURNS:
+    --------
+    Dictionary with the variables in _BULK_VARS (NaN where the variable 
+    is missing or not reported) and wave_time [seconds since 1900-01-01].
+    
+    NOTES:
+    ------
+    Handles the header variants used by NDBC over the years (YY, #YY or 
+    YYYY years, with or without minutes, WD/WDIR and BAR/PRES).
+    """
+    
+    # Read header lines to determine the location of variables
+    header,headcnt = _read_header(filename)
+    schema = _bulk_schema(header,headcnt)
+    
+    # Load buoy data
+    tmpdata = _read_numeric(filename,headcnt,schema.ncols)
+    nrec = tmpdata.shape[0]
+    
+    data = {}
+    for name,ind,missing in schema.columns:
+        if ind is None:
+            data[name] = np.zeros((nrec,))*np.nan
+        else:
+            tmpvar = tmpdata[:,ind]
+            data[name] = np.where(tmpvar == missing,np.nan,tmpvar)
+    
+    data['wave_time'] = _record_time(schema.time,tmpdata)
+    
+    return data
+
+
+def _parse_bulk_file(filename):
+    """
+    Read a bulk parameter file and its manifest entry. Not for standalone 
+    use.
+    """
+    data = read_bulk(filename)
+    return data,{os.path.basename(filename):_file_entry(filename,
+                                                         data['wave_time'])}
+
+
+def _merge_bulk(records):
+    """
+    Concatenate a list of bulk parameter dictionaries, sort them 
+    chronologically and remove repeated times. Not for standalone use.
+    """
+    names = ['wave_time'] + [var[0] for var in _BULK_VARS]
+    data = dict((name,np.concatenate([rec[name] for rec in records])) 
+                for name in names)
+    wave_time = data.pop('wave_time')
+    wave_time,data = _sort_unique(wave_time,data)
+    data['wave_time'] = wave_time
+    return data
+
+
+def _create_bulk_nc(ncfile,buoyid,ncformat=4,chunk_size=8760):
+    """
+    Create a bulk parameter NetCDF file with empty variables. 
+    Not for standalone use.
+    
+    NetCDF4 variables are zlib compressed and chunked along time 
+    (chunk_size records).
+    """
+    
+    # Global attributes  
+    if ncformat == 4:
+        print("Saving the buoy data with NetCDF4 format")
+        nc = netCDF4.Dataset(ncfile,'w',format='NETCDF4')
+        ncopts = {'zlib':True,'complevel':4,'shuffle':True,
+                  'chunksizes':(chunk_size,)}
+    else:
+        print("Saving the buoy data with NetCDF3 format")
+        nc = netCDF4.Dataset(ncfile,'w',format='NETCDF3_CLASSIC')
+        ncopts = {}
+    nc.Description = buoyid + ' NDBC Bulk Parameter Data'
+    nc.rawdata = 'National Data Buoy Center \nwww.ndbc.noaa.gov'
+    nc.Author = 'ggarcia@coas.oregonstate.edu \nNearshore Modeling Group'
+    nc.Created = time.ctime()
+    nc.Software = 'Created with Python ' + sys.version
+    nc.NetCDF_Lib = str(netCDF4.getlibversion())
+    nc.Script = os.path.realpath(__file__)
+    
+    # Create dimensions  
+    nc.createDimension('wave_time',None)
+    
+    # pyroms subroutine to create NetCDF fields
+    def create_nc_var(name, dimensions, units=None, longname=None):
+        nc.createVariable(name, 'f8', dimensions, **ncopts)
+        if units is not None:
+            nc.variables[name].units = units  
+        if longname is not None:
+            nc.variables[name].long_name = longname  
+    
+    # Create Variables in the NetCDF file
+    create_nc_var('wave_time','wave_time',
+                  'seconds since 1900-01-01 00:00:00','measurement time UTC')
+    for name,_,_,units,longname in _BULK_VARS:
+        create_nc_var(name,'wave_time',units,longname)
+    
+    return nc
+
+
+def _write_bulk(ncfile,buoyid,data,append,ncformat=4):
+    """
+    Merge bulk parameter data (see _merge_bulk) into a new or existing 
+    NetCDF file. Not for standalone use.
+    """
+    if append:
+        nc = netCDF4.Dataset(ncfile,'a')
+    else:
+        nc = _create_bulk_nc(ncfile,buoyid,ncformat)
+    data = dict(data)
+    wave_time = data.pop('wave_time')
+    try:
+        _nc_merge_tail(nc,'wave_time',wave_time,data)
+    finally:
+        nc.close()
+
+
+def bulk2nc(buoyfld,buoyid,ncformat=4,incremental=False):
     '''
     Code to convert bulk parameter text files into netcdf file
     
     Usage:
     ------
-    bulk2nc(buoyfld,buoyid,ncformat)
+    bulk2nc(buoyfld,buoyid,ncformat,incremental)
     
     Input:
     ------
-    buoyfld  = Folder where the bulk paramerter text files reside.
-    buoyid   = Netcdf buoy identifier (to figure out the file names)
-    ncformat = set as 3 for netCDF3, set as 4 for netCDF4 (default)
+    buoyfld     = Folder where the bulk paramerter text files reside.
+    buoyid      = Netcdf buoy identifier (to figure out the file names)
+    ncformat    = set as 3 for netCDF3, set as 4 for netCDF4 (default)
+    incremental = Only ingest the text files that are new or changed since 
+                  the last run (see notes). Defaults to False.
     
     Notes:
     Only the bulk parameter files must be present in that directory. The code is
     not smart enough (and I do not have the time to make it so) to figure out 
     the bulk parameter files. 
     
+    Each file is parsed once (see read_bulk), all the records are 
+    concatenated and sorted chronologically at once. Repeated times are 
+    removed keeping the data of the last file read. NetCDF4 variables are 
+    compressed and chunked along time.
+    
+    The files that have been ingested (name, size, modification time and 
+    time range) are listed in buoyid_manifest.json next to the NetCDF file.
+    In incremental mode only the new or modified files are parsed and their
+    records are merged into the existing NetCDF file. Data newer than the 
+    file are appended, otherwise only the overlapping end of the record is 
+    rewritten.
+    
     '''
     
+    ncfile = os.path.join(buoyfld,buoyid + '.nc')
+    
     #===========================================================================
     # Read and Clean Up Data
     #===========================================================================
     
     # Get all files in folder
-    archivos = os.listdir(buoyfld)
-    
-    # Initialize variables
-    wavetime = np.empty([1,])
-    WDIR = np.empty([1,]) #AKA WD
-    WSPD = np.empty([1,])
-    GST = np.empty([1,])
-    WVHT = np.empty([1,])
-    DPD = np.empty([1,])
-    APD = np.empty([1,])
-    MWD = np.empty([1,])
-    PRES = np.empty([1,]) #AKA BAR
-    ATMP = np.empty([1,])
-    WTMP = np.empty([1,])
-    
-    
-    # Loop over files
-    for file in archivos:
-        
-        if file.endswith('.txt'):
-            
-            # Read header lines to determine the location of variables
-            with open(buoyfld + '/' + file,'r') as f:
-                header1 = f.readline()
-                header2 = f.readline()
-                
-                # Determine the number of header lines (NDBC uses one or two)
-                if header1.startswith('Y') or header1.startswith('#'):
-                    headcnt = 1
-                if header2.startswith('Y') or header2.startswith('#'):
-                    headcnt = 2
-                    
-                
-            # Collapse multiple spaces into one
-            header3 = ' '.join(header1.split())
-            header4 = header3.split()
-            
-            # Load buoy data
-            tmpdata = pl.loadtxt(buoyfld + '/' + file,skiprows=headcnt)
-            
-            
-            # ======================  Allocate variables  ==================== #
-            # Wind direction
-            if any(tt == 'WD' for tt in header4):
-                tind = header4.index('WD')
-                WDIR = np.concatenate((WDIR,tmpdata[:,tind]))
-            elif any(tt == 'WDIR' for tt in header4):
-                tind = header4.index('WDIR')
-                WDIR = np.concatenate((WDIR,tmpdata[:,tind]))
-            else:
-                tmparray = np.ones([tmpdata.shape[0],1])
-                tmparray[:] = NaN
-                WDIR = np.concatenate((WDIR,tmparray))
-                del tmparray 
-            
-            # Wind Speed
-            if any(tt == 'WSPD' for tt in header4):
-                tind = header4.index('WSPD')
-                WSPD = np.concatenate((WSPD,tmpdata[:,tind]))
-            else:
-                tmparray = np.ones([tmpdata.shape[0],1])
-                tmparray[:] = NaN
-                WSPD = np.concatenate((WSPD,tmparray))
-                del tmparray 
-                
-            # Wind Gust
-            if any(tt == 'GST' for tt in header4):
-                tind = header4.index('GST')
-                GST = np.concatenate((GST,tmpdata[:,tind]))
-            else:
-                tmparray = np.ones([tmpdata.shape[0],1])
-                tmparray[:] = NaN
-                GST = np.concatenate((GST,tmparray))
-                del tmparray 
-            
-            # Wave Height
-            if any(tt == 'WVHT' for tt in header4):
-                tind = header4.index('WVHT')
-                WVHT = np.concatenate((WVHT,tmpdata[:,tind]))
-            else:
-                tmparray = np.ones([tmpdata.shape[0],1])
-                tmparray[:] = NaN
-                WVHT = np.concatenate((WVHT,tmparray))
-                del tmparray 
-                
-            # Dominant Wave Period
-            if any(tt == 'DPD' for tt in header4):
-                tind = header4.index('DPD')
-                DPD = np.concatenate((DPD,tmpdata[:,tind]))
-            else:
-                tmparray = np.ones([tmpdata.shape[0],1])
-                tmparray[:] = NaN
-                DPD = np.concatenate((DPD,tmparray))
-                del tmparray
-                
-            # Average Wave Period
-            if any(tt == 'APD' for tt in header4):
-                tind = header4.index('APD')
-                APD = np.concatenate((APD,tmpdata[:,tind]))
-            else:
-                tmparray = np.ones([tmpdata.shape[0],1])
-                tmparray[:] = NaN
-                APD = np.concatenate((APD,tmparray))
-                del tmparray 
-                            
-            # Mean Wave Direction
-            if any(tt == 'MWD' for tt in header4):
-                tind = header4.index('MWD')
-                MWD = np.concatenate((MWD,tmpdata[:,tind]))
-            else:
-                tmparray = np.ones([tmpdata.shape[0],1])
-                tmparray[:] = NaN
-                MWD = np.concatenate((MWD,tmparray))
-                del tmparray 
-    
-            # Sea Level Pressure
-            if any(tt == 'PRES' for tt in header4):
-                tind = header4.index('PRES')
-                PRES = np.concatenate((PRES,tmpdata[:,tind]))
-            elif any(tt == 'BAR' for tt in header4):
-                tind = header4.index('BAR')
-                PRES = np.concatenate((PRES,tmpdata[:,tind]))
-            else:
-                tmparray = np.ones([tmpdata.shape[0],1])
-                tmparray[:] = NaN
-                PRES = np.concatenate((PRES,tmparray))
-                del tmparray 
-    
-            # Air temperature
-            if any(tt == 'ATMP' for tt in header4):
-                tind = header4.index('ATMP')
-                ATMP = np.concatenate((ATMP,tmpdata[:,tind]))
-            else:
-                tmparray = np.ones([tmpdata.shape[0],1])
-                tmparray[:] = NaN
-                ATMP = np.concatenate((ATMP,tmparray))
-                del tmparray  
-    
-            # Sea surface temperature
-            if any(tt == 'WTMP' for tt in header4):
-                tind = header4.index('WTMP')
-                WTMP = np.concatenate((WTMP,tmpdata[:,tind]))
-            else:
-                tmparray = np.ones([tmpdata.shape[0],1])
-                tmparray[:] = NaN
-                WTMP = np.concatenate((WTMP,tmparray))
-                del tmparray                   
-      
-      
-            # ================== Time management =================
-            # Years
-            if any(tt == 'YY' for tt in header4):
-                tind = header4.index('YY')
-                years = tmpdata[:,tind] + 1900   
-            elif any(tt == '#YY' for tt in header4):
-                tind = header4.index('#YY')
-                years = tmpdata[:,tind]             
-            else:
-                tind = header4.index('YYYY')
-                years = tmpdata[:,tind]
-    
-            # Minutes
-            if any(tt == 'mm' for tt in header4):
-                tind = header4.index('mm')
-                mm = tmpdata[:,tind]
-            else:
-                mm = np.zeros([tmpdata.shape[0],1])
-    
-    
-            # Create time vector
-            # Seconds from 1900-01-01 will be used
-            for aa in range(tmpdata.shape[0]):
-                tmptime = datetime.datetime(int(years[aa]),
-                                            int(tmpdata[aa,1]),
-                                            int(tmpdata[aa,2]),
-                                            int(tmpdata[aa,3]),
-                                            int(mm[aa]),
-                                            0)
-                sectime = tmptime - datetime.datetime(1900,01,01,0,0,0)
-                secsecs = sectime.total_seconds()
-                wavetime = np.concatenate([wavetime,np.array([secsecs])])            
-                del tmptime,sectime,secsecs
-            
-            # ================ Clean up ================
-            del header1,header2,header3,header4,years,mm
-    
-    
-    # Remove first term of each array
-    wavetime = np.delete(wavetime,0)
-    WDIR = np.delete(WDIR,0)
-    WSPD = np.delete(WSPD,0)
-    GST = np.delete(GST,0)
-    WVHT = np.delete(WVHT,0)
-    DPD = np.delete(DPD,0)
-    APD = np.delete(APD,0)
-    MWD = np.delete(MWD,0)
-    PRES = np.delete(PRES,0)
-    ATMP = np.delete(ATMP,0)
-    WTMP = np.delete(WTMP,0)
-    
-    # Clean up variables
-    WDIR[WDIR==999] = np.NaN
-    WSPD[WSPD==99] = np.NaN
-    GST[GST==99] = np.NaN
-    WVHT[WVHT==99] = np.NaN
-    DPD[DPD==99] = np.NaN
-    APD[APD==99] = np.NaN
-    MWD[MWD==999] = np.NaN
-    PRES[PRES==9999] = np.NaN
-    ATMP[ATMP==99] = np.NaN
-    WTMP[WTMP==99] = np.NaN
+    archivos = sorted([x for x in os.listdir(buoyfld) if x.endswith('.txt')])
     
-    # Order chronologically
-    sorted_index = np.argsort(wavetime)
-    wavetime = [wavetime[i] for i in sorted_index]
-    WDIR = [WDIR[i] for i in sorted_index]
-    WSPD = [WSPD[i] for i in sorted_index]
-    GST = [GST[i] for i in sorted_index]
-    WVHT = [WVHT[i] for i in sorted_index]
-    DPD = [DPD[i] for i in sorted_index]
-    APD = [APD[i] for i in sorted_index]
-    MWD = [MWD[i] for i in sorted_index]
-    PRES = [PRES[i] for i in sorted_index]
-    ATMP = [ATMP[i] for i in sorted_index]
-    WTMP = [WTMP[i] for i in sorted_index]
+    # Files to ingest
+    archivos,manifest,append = _pending_files(ncfile,buoyfld,archivos,
+                                              incremental)
+    if append and len(archivos) == 0:
+        print("No new bulk parameter data for " + buoyid)
+        return
+    
+    records = []
+    for archivo in archivos:
+        data,entries = _parse_bulk_file(os.path.join(buoyfld,archivo))
+        records.append(data)
+        manifest.update(entries)
     
+    # Order chronologically
+    data = _merge_bulk(records)
     
     #===========================================================================
     # Save as NetCDF 
     #===========================================================================
-      
-      
-    # Global attributes  
-    if ncformat == 4:
-        print "Saving the buoy data with NetCDF4 format"
-        nc = netCDF4.Dataset(buoyfld + '/' + buoyid + '.nc', 'w',
-                             format='NETCDF4')
+    _write_bulk(ncfile,buoyid,data,append,ncformat)
+    _save_manifest(ncfile,manifest)
+    
+
+
+
+#===============================================================================
+# Spectral parameters code
+#===============================================================================
+
+# Spectral files: variable and file type letter
+_SPEC_FILES = [('freq_spec','w'),('alpha_1','d'),('alpha_2','i'),
+               ('r_1','j'),('r_2','k')]
+
+
+def read_spec(filename):
+    """
+    Read a single NDBC spectral text file (spectral density, mean and 
+    principal wave directions or the r_1,r_2 coefficients).
+    
+    USAGE:
+    ------
+    data = read_spec(filename)
+    
+    PARAMETERS:
+    -----------
+    filename : NDBC spectral text file
+    
+    RETURNS:
+    --------
+    Dictionary containing
+        freq      : Spectral frequencies [Hz]
+        wave_time : Time [seconds since 1900-01-01]
+        values    : Data (time,freq), missing values (999) as NaN
+    """
+    
+    # The header has the date columns followed by the frequencies
+    header,headcnt = _read_header(filename)
+    schema = _spec_schema(header,headcnt)
+    
+    tmpdata = _read_numeric(filename,headcnt,schema.ncols)
+    values = tmpdata[:,schema.ntime:]
+    values[values >= 999.0] = np.nan
+    
+    return {'freq':schema.freq.copy(),
+            'wave_time':_record_time(schema.time,tmpdata),'values':values}
+
+
+def _mem_spreading(alpha_1,alpha_2,r_1,r_2,angles):
+    """
+    Maximum Entropy Method directional distribution (Lygre and Krogstad, 
+    1986) normalized to integrate to 1 over angles [degrees].
+    Not for standalone use.
+    """
+    
+    d2r = np.pi/180.0
+    
+    # First and second order Fourier coefficients
+    c1 = r_1*np.exp(1j*d2r*alpha_1)
+    c2 = r_2*np.exp(2j*d2r*alpha_2)
+    
+    with np.errstate(divide='ignore',invalid='ignore'):
+        phi1 = (c1 - c2*np.conjugate(c1))/(1.0 - np.abs(c1)**2)
+        phi2 = c2 - c1*phi1
+        
+        # Directional distribution
+        num = (1.0 - phi1*np.conjugate(c1) - phi2*np.conjugate(c2)).real
+        ang = np.exp(-1j*d2r*angles)
+        den = np.abs(1.0 - phi1[...,np.newaxis]*ang - 
+                     phi2[...,np.newaxis]*ang**2)**2
+        dspr = num[...,np.newaxis]/den
+        
+        # Normalize (discrete integral over directions)
+        dtheta = angles[1] - angles[0]
+        dspr /= np.sum(dspr,axis=-1,keepdims=True)*dtheta
+    
+    return dspr
+
+
+def reconstruct_dir_spec(freq_spec,alpha_1,alpha_2,r_1,r_2,angles,
+                         method='fourier',single=False):
+    """
+    Reconstruct the frequency-direction spectrum from NDBC data.
+    
+    USAGE:
+    ------
+    dir_spec = reconstruct_dir_spec(freq_spec,alpha_1,alpha_2,r_1,r_2,angles,
+                                    method,single)
+    
+    PARAMETERS:
+    -----------
+    freq_spec : Frequency spectrum [m2 s] (time,freq)
+    alpha_1   : Mean wave direction [deg] (time,freq)
+    alpha_2   : Principal wave direction [deg] (time,freq)
+    r_1,r_2   : First and second normalized polar coordinates of the Fourier
+                coefficients (0 to 1) (time,freq)
+    angles    : Directions [deg] (evenly spaced)
+    method    : 'fourier' for the truncated Fourier series (default) or 
+                'mem' for the Maximum Entropy Method
+    single    : (Optional) Return float32 spectra
+    
+    RETURNS:
+    --------
+    dir_spec  : Frequency-direction spectrum [m2 s deg-1] (time,freq,dir)
+    
+    NOTES:
+    ------
+    Fourier reconstruction (see http://www.ndbc.noaa.gov/measdes.shtml):
+      E(f,theta) = S(f)*D(f,theta)
+      D = 1/pi*(0.5 + r_1*cos(theta - alpha_1) + r_2*cos(2*(theta - alpha_2)))
+    The Fourier distribution can be negative, the MEM distribution is 
+    positive and narrower.
+    
+    REFERENCES:
+    -----------
+    Lygre, A., and H.E. Krogstad, 1986: Maximum entropy estimation of the 
+      directional distribution in ocean wave spectra. Journal of Physical 
+      Oceanography, 16, 2052-2060.
+    """
+    
+    dtype = np.float32 if single else np.float64
+    d2r = np.pi/180.0
+    angles = np.asarray(angles,dtype=np.float64)
+    
+    if method == 'fourier':
+        dspr = (0.5 + 
+                r_1[...,np.newaxis]*np.cos(d2r*(angles - 
+                                                alpha_1[...,np.newaxis])) +
+                r_2[...,np.newaxis]*np.cos(2.0*d2r*(angles - 
+                                                    alpha_2[...,np.newaxis])))
+        dspr *= d2r/np.pi
+    elif method == 'mem':
+        dspr = _mem_spreading(alpha_1,alpha_2,r_1,r_2,angles)
     else:
-        print "Saving the buoy data with NetCDF3 format"
-        nc = netCDF4.Dataset(buoyfld + '/' + buoyid + '.nc', 'w', 
-                             format='NETCDF3_CLASSIC')
-    nc.Description = buoyid + ' NDBC Bulk Parameter Data'
-    nc.rawdata = 'National Data Buoy Center \nwww.ndbc.noaa.gov'
-    nc.Author = 'ggarcia@coas.oregonstate.edu \nNearshore Modeling Group'
+        raise ValueError("method must be 'fourier' or 'mem'")
+    
+    dspr *= freq_spec[...,np.newaxis]
+    
+    return dspr.astype(dtype,copy=False)
+
+
+def _create_spec_nc(ncfile,buoyid,method):
+    """
+    Create a spectral NetCDF file with the time dimensions and global
+    attributes. Not for standalone use.
+    """
+    
+    # Global attributes  
+    nc = netCDF4.Dataset(ncfile,'w',format='NETCDF4')
+    nc.Description = buoyid + ' NDBC Spectral Data'
+    nc.Rawdata = 'National Data Buoy Center \nwww.ndbc.noaa.gov'
+    nc.Author = getpass.getuser()
     nc.Created = time.ctime()
     nc.Software = 'Created with Python ' + sys.version
     nc.NetCDF_Lib = str(netCDF4.getlibversion())
     nc.Script = os.path.realpath(__file__)
+    nc.Notes = 'Nautical convention used for directions'
+    nc.Directional_method = method
     
-    # Create dimensions  
+    # Create dimensions  (NetCDF4 supports multiple unlimited dimensions)
     nc.createDimension('wave_time',None)
+    nc.createDimension('dir_time',None)
+    
+    # Create bulk parameter variables
+    nc.createVariable('Hsig','f8','wave_time',zlib=True)
+    nc.variables['Hsig'].units = 'meter'
+    nc.variables['Hsig'].long_name = 'Significant wave height'
+    
+    return nc
+
+
+def _parse_spec_year(tmpfiles):
+    """
+    Read the spectral files of one year. The directional data are aligned 
+    on the times present in all the files (None if any is missing).
+    Returns the data and the manifest entries of the files. 
+    Not for standalone use.
+    """
+    
+    entries = {}
+    
+    # Read spectral density data (frequency spectra)
+    spec = read_spec(tmpfiles['freq_spec'])
+    entries[os.path.basename(tmpfiles['freq_spec'])] = \
+        _file_entry(tmpfiles['freq_spec'],spec['wave_time'])
+    parsed = {'freq':spec['freq'],'wave_time':spec['wave_time'],
+              'freq_spec':spec['values'],'dir_time':None}
+    
+    # Check if directional data exists
+    if not all([os.path.isfile(tmpfiles[name]) 
+                for name,_ in _SPEC_FILES[1:]]):
+        return parsed,entries
+    
+    # Read directional data and keep the times present in all files
+    dirdata = {'freq_spec':spec}
+    dir_time = np.unique(spec['wave_time'])
+    for name,_ in _SPEC_FILES[1:]:
+        dirdata[name] = read_spec(tmpfiles[name])
+        dir_time = np.intersect1d(dir_time,dirdata[name]['wave_time'])
+        entries[os.path.basename(tmpfiles[name])] = \
+            _file_entry(tmpfiles[name],dirdata[name]['wave_time'])
+    for name,_ in _SPEC_FILES:
+        _,ind,_ = np.intersect1d(dirdata[name]['wave_time'],dir_time,
+                                 return_indices=True)
+        parsed['dir_' + name] = dirdata[name]['values'][ind]
+    parsed['dir_time'] = dir_time
+    
+    # r_1 and r_2 are reported in percent in some files
+    for name in ['dir_r_1','dir_r_2']:
+        if np.nanmax(parsed[name],initial=0.0) > 1.0:
+            parsed[name] *= 0.01
+    
+    return parsed,entries
+
+
+def _write_spec_year(nc,parsed,angles,method,single,time_block):
+    """
+    Reconstruct the directional spectra of one year (see _parse_spec_year)
+    and merge them into the NetCDF file. Not for standalone use.
+    """
+    
+    ftype = 'f4' if single else 'f8'
+    freq = parsed['freq']
+    freq_spec = parsed['freq_spec']
+    
+    # Create frequency spectra variables
+    if 'freq' not in nc.dimensions:
+        nc.createDimension('freq',freq.shape[0])
+        
+        nc.createVariable('wave_time','f8','wave_time',zlib=True)
+        nc.variables['wave_time'].units = \
+        "seconds since 1900-01-01 00:00:00"
+        nc.variables['wave_time'].calendar = "julian"
+        
+        nc.createVariable('freq_spec',ftype,('wave_time','freq'),zlib=True)
+        nc.variables['freq_spec'].units = 'meter2 second'
+        nc.variables['freq_spec'].long_name = 'Frequency variance spectrum'            
+        
+        nc.createVariable('frequency','f8',('freq'))
+        nc.variables['frequency'].units = 'Hz'
+        nc.variables['frequency'].long_name = 'Spectral frequency'
+        nc.variables['frequency'][:] = freq
+    
+    # Compute bulk parameters
+    moment0 = np.sum(0.5*(freq_spec[:,1:] + freq_spec[:,:-1]) *
+                     np.diff(freq),axis=1)
+    Hsig = 4.004*(moment0)**0.5
     
+    # Write to NetCDF file
+    _nc_merge_tail(nc,'wave_time',parsed['wave_time'],
+                   {'Hsig':Hsig,'freq_spec':freq_spec})
     
-    # pyroms subroutine to write NetCDF fields
-    def write_nc_var(var, name, dimensions, units=None, longname=None):
-      nc.createVariable(name, 'f8', dimensions)
-      if units is not None:
-        nc.variables[name].units = units  
-      if longname is not None:
-        nc.variables[name].long_name = longname  
-      nc.variables[name][:] = var
-          
-    
-    # Write Variables To NetCDF file
-    write_nc_var(wavetime,'wave_time','wave_time',
-                 'seconds since 1900-01-01 00:00:00','measurement time UTC')
-    write_nc_var(WDIR, 'WDIR', 'wave_time', 'degrees',
-                 'Wind direction (direction the wind is coming from in ' + 
-                 'degrees clockwise from true North')
-    write_nc_var(WSPD, 'WSPD', 'wave_time', 'meter second-1',
-                 'Wind speed averaged over an eight-minute period')
-    write_nc_var(GST, 'GST','wave_time','meter second-1','Peak gust speed')
-    write_nc_var(WVHT,'WVHT','wave_time','meter',
-                 'Significant wave height during the 20 minute sampling period')
-    write_nc_var(DPD,'DPD','wave_time','second',
-                 'Dominant wave period (period with the maximum wave energy)')
-    write_nc_var(APD,'APD','wave_time','second',
-                 'Average wave period of all waves during the 20 minute' + 
-                 ' sampling period')
-    write_nc_var(MWD,'MWD','wave_time','degrees',
-                 'The direction from which the waves at the dominant period ' + 
-                 'are coming in degrees from true North, increasing clockwise')
-    write_nc_var(PRES,'PRES','wave_time','hPa','Sea level pressure')
-    write_nc_var(ATMP,'ATMP','wave_time','Celsius','Air temperature')
-    write_nc_var(WTMP,'WTMP','wave_time','Celsius','Sea surface temperature')
-      
-    # Close NetCDF File 
-    nc.close()
+    # Check if directional data exists
+    dir_time = parsed['dir_time']
+    if dir_time is None:
+        return
+    
+    # Create directional spectra variables
+    if 'dir' not in nc.dimensions:
+        nc.createDimension('dir',angles.shape[0])
+        
+        nc.createVariable('dir_time','f8','dir_time',zlib=True)
+        nc.variables['dir_time'].units = \
+        "seconds since 1900-01-01 00:00:00"
+        nc.variables['dir_time'].calendar = "julian"
+        
+        nc.createVariable('dir_spec',ftype,('dir_time','freq','dir'),
+                          zlib=True,chunksizes=(min(time_block,1024),
+                                                freq.shape[0],
+                                                angles.shape[0]))
+        nc.variables['dir_spec'].units = 'meter2 second degree-1'
+        nc.variables['dir_spec'].long_name = \
+            'Frequency-Direction variance spectrum'  
+            
+        nc.createVariable('direction','f8',('dir'))
+        nc.variables['direction'].units = 'degree'
+        nc.variables['direction'].long_name = \
+            'Degrees from true north in oceanographic convention'
+        nc.variables['direction'][:] = angles
     
+    # Construct 2D spectra in blocks of time
+    # See http://www.ndbc.noaa.gov/measdes.shtml
+    def compute(tb):
+        return reconstruct_dir_spec(parsed['dir_freq_spec'][tb],
+                                    parsed['dir_alpha_1'][tb],
+                                    parsed['dir_alpha_2'][tb],
+                                    parsed['dir_r_1'][tb],
+                                    parsed['dir_r_2'][tb],
+                                    angles,method,single)
+    _nc_merge_blocks(nc,'dir_time',dir_time,'dir_spec',compute,time_block)
 
 
+def _open_spec_nc(ncfile,buoyid,method,angles,append):
+    """
+    Open an existing spectral NetCDF file to append data (checking the 
+    directional resolution) or create a new one. Not for standalone use.
+    """
+    if not append:
+        return _create_spec_nc(ncfile,buoyid,method)
+    nc = netCDF4.Dataset(ncfile,'a')
+    if ('direction' in nc.variables and 
+        not np.array_equal(nc.variables['direction'][:],angles)):
+        nc.close()
+        raise ValueError('dtheta does not match the existing file')
+    return nc
 
-#===============================================================================
-# Spectral parameters code
-#===============================================================================
 
-def spec2nc(buoyfld,dtheta=5):
+def spec2nc(buoyfld,dtheta=5,method='fourier',single=False,time_block=1000,
+            incremental=False):
     '''
     Code to convert NDBC spectral data files to netCDF format. 
     
     Usage:
     ------
-    spec2nc(buoyfld,dtheta)
+    spec2nc(buoyfld,dtheta,method,single,time_block,incremental)
     
     Input:
     ------
-    buoyfld  : Folder where the text files reside. Those should be the only
-               files in the folder.
-    dtheta   : Directional resolution for the reconstruction of the frequency-
-               direction spectrum. Defaults to 5 degrees. 
+    buoyfld     : Folder where the text files reside. Those should be the 
+                  only files in the folder.
+    dtheta      : Directional resolution for the reconstruction of the 
+                  frequency-direction spectrum. Defaults to 5 degrees. 
+    method      : Directional distribution, 'fourier' (default) or 'mem' 
+                  (see reconstruct_dir_spec)
+    single      : Store the spectra in single precision (float32)
+    time_block  : Number of records reconstructed and written at a time
+    incremental : Only process the years with text files that are new or 
+                  changed since the last run (see notes). Defaults to False.
     
     Notes:
       1. NetCDF4 file will be generated
-      2. Code is not optimized since this is not something you will want to be
-         running often. Beware of slow performance for large datasets.
+      2. Each year is processed separately and the directional spectra are 
+         reconstructed in blocks of time_block records, so memory use does
+         not depend on the length of the record.
+      3. The directional spectra are only computed at the times present in
+         all five spectral files of a given year.
+      4. r_1 and r_2 reported in percent are scaled to 0-1.
+      5. The files that have been ingested (name, size, modification time 
+         and time range) are listed in buoyid_spec_manifest.json. In 
+         incremental mode the years with new or modified files are merged 
+         into the existing NetCDF file, the records stay sorted and repeated
+         times are replaced by the new data.
     
     References:
     Kuik, A.J., G.Ph. van Vledder, and L.H. Holthuijsen, 1998: "Method for
       the Routine Analysis of Pitch-and-Roll Buoy Wave Data", Journal of
       Physical Oceanography, 18, 1020-1034.
-      
-    TODO:
-    Only works with newer formats (YY MM DD hh mm)
     
     '''
     
-    # For testing only ---------------------------------------------------------
-    # buoyfld = '/home/shusin2/users/ggarcia/data/wave/b46029/spec/'
-    # dtheta = 5
-    # --------------------------------------------------------------------------
-    
     # Construct directional angle
     angles = np.arange(0.0,360.0,dtheta)
     
-    # Time reference
-    basetime = datetime.datetime(1900,01,01,0,0,0)
-
     #===========================================================================
     # Read file information
     #===========================================================================
     
     # Get all files in folder
-    archivos = os.listdir(buoyfld)
-    
-    # Year information
-    years = [x.split('.')[0][-4:] for x in archivos]    # Get all year stamps
-    years = list(set(years))                            # Find unique years
-    years.sort()                                        # Sort years
+    archivos = [x for x in os.listdir(buoyfld) if x.endswith('.txt')]
     
     # Get buoy ID information
     buoyid = [x[0:5] for x in archivos]                 # Find buoy ids
@@ -412,198 +962,298 @@ def spec2nc(buoyfld,dtheta=5):
         print('  ' +  buoyid + ' will be processed')
     else:
         buoyid = buoyid[0]
-        
+    ncfile = os.path.join(buoyfld,buoyid + '_spec.nc')
     
-    # Create output netcdf file ------------------------------------------------
-    # Global attributes  
-    nc = netCDF4.Dataset(buoyfld + '/' + buoyid + '_spec.nc',
-                         'w',format='NETCDF4')
-    nc.Description = buoyid + ' NDBC Spectral Data'
-    nc.Rawdata = 'National Data Buoy Center \nwww.ndbc.noaa.gov'
-    nc.Author = getpass.getuser()
-    nc.Created = time.ctime()
-    nc.Software = 'Created with Python ' + sys.version
-    nc.NetCDF_Lib = str(netCDF4.getlibversion())
-    nc.Script = os.path.realpath(__file__)
-    nc.Notes = 'Nautical convention used for directions'
-    
-    # Create dimensions  (NetCDF4 supports multiple unlimited dimensions)
-    nc.createDimension('wave_time',None)
-    nc.createDimension('dir_time',None)
-    
-    # Create bulk parameter variables
-    nc.createVariable('Hsig','f8','wave_time')
-    nc.variables['Hsig'].units = 'meter'
-    nc.variables['Hsig'].long_name = 'Significant wave height'
-        
+    # Output netcdf file -------------------------------------------------------
+    archivos,manifest,append = _pending_files(ncfile,buoyfld,archivos,
+                                              incremental)
+    if append and len(archivos) == 0:
+        print("No new spectral data for " + buoyid)
+        return
+    nc = _open_spec_nc(ncfile,buoyid,method,angles,append)
     
+    # Year information
+    years = [x.split('.')[0][-4:] for x in archivos]    # Get all year stamps
+    years = list(set(years))                            # Find unique years
+    years.sort()                                        # Sort years
     
     # Reconstruct the spectrum -------------------------------------------------        
-
-    # counter variable to create variables in the netcdf file
-    cnt_freq = 0 
-    cnt_dir = 0
-    tstep_freq = 0
-    tstep_dir = 0
-    
-    # Loop over years
-    for aa in years:
-                
-        # Load spectral density files
-        # Check if file exists
-        tmpfile = buoyfld + buoyid + 'w' + aa + '.txt'
-        if os.path.isfile(tmpfile) == False:
-            # No spectral density found for the given year, go to next one
-            continue
-        
-        # Read spectral density data (frequency spectra)
-        f_w = open(tmpfile,'r')
-        freq = f_w.readline().split()
-               
-        # Read frequencies
-        freq = np.array(freq[5:],dtype=float)
-        f_w.close()
-        
-        # Load spectral density
-        freq_spec = np.loadtxt(tmpfile,skiprows=1)
+    try:
         
-        # Allocate time and spectral density data    
-        freq_time = np.zeros((freq_spec.shape[0]))  
-        for bb in range(freq_time.shape[0]):
-            freq_time[bb] = (datetime.datetime(np.int(freq_spec[bb,0]),
-                                               np.int(freq_spec[bb,1]),
-                                               np.int(freq_spec[bb,2]),
-                                               np.int(freq_spec[bb,3]),
-                                               np.int(freq_spec[bb,4])) - 
-                             basetime).total_seconds()
-        freq_spec = freq_spec[:,5:]
-        
-        # Create frequency spectra variables
-        cnt_freq += 1
-        if cnt_freq == 1:
-            nc.createDimension('freq',freq.shape[0])
-            
-            nc.createVariable('wave_time','f8','wave_time')
-            nc.variables['wave_time'].units = \
-            "seconds since 1900-01-01 00:00:00"
-            nc.variables['wave_time'].calendar = "julian"
+        # Loop over years
+        for aa in years:
             
-            nc.createVariable('freq_spec','f8',('wave_time','freq'))
-            nc.variables['freq_spec'].units = 'meter2 second'
-            nc.variables['freq_spec'].long_name = 'Frequency variance spectrum'            
+            # Load spectral density files
+            # Check if file exists
+            tmpfiles = dict((name,os.path.join(buoyfld,buoyid + letter + 
+                                               aa + '.txt'))
+                            for name,letter in _SPEC_FILES)
+            if not os.path.isfile(tmpfiles['freq_spec']):
+                # No spectral density found for the given year, go to next one
+                continue
             
-            nc.createVariable('frequency','f8',('freq'))
-            nc.variables['frequency'].units = 'Hz'
-            nc.variables['frequency'].long_name = 'Spectral frequency'
-            nc.variables['frequency'][:] = freq
-        
-        # Check if directional data exists
-        tmp_alpha_1 = buoyfld  + buoyid + 'd' + aa + '.txt'
-        tmp_alpha_2 = buoyfld  + buoyid + 'i' + aa + '.txt'
-        tmp_r_1 = buoyfld  + buoyid + 'j' + aa + '.txt'
-        tmp_r_2 = buoyfld  + buoyid + 'k' + aa + '.txt'
+            parsed,entries = _parse_spec_year(tmpfiles)
+            _write_spec_year(nc,parsed,angles,method,single,time_block)
+            manifest.update(entries)
     
+    # Wrap up ------------------------------------------------------------------
+    finally:
+        # Close NetCDF File 
+        nc.close()
+    _save_manifest(ncfile,manifest)
+
+
+#===============================================================================
+# Multi-buoy driver
+#===============================================================================
+
+# Historical NDBC file names: station id, file type letter and year
+_NDBC_FILE = re.compile(r'^(\w{5})([hwdijk])(\d{4})\.txt$')
+
+
+def find_buoys(rootdir):
+    """
+    Find the NDBC bulk parameter and spectral text files under a directory.
     
-        if (os.path.isfile(tmp_alpha_1) and os.path.isfile(tmp_alpha_2) and
-            os.path.isfile(tmp_r_1) and os.path.isfile(tmp_r_2)):
-            
-            # Create directional spectra variables
-            cnt_dir += 1
-            if cnt_dir == 1:
-                nc.createDimension('dir',angles.shape[0])
-            
-                nc.createVariable('dir_time','f8','dir_time')
-                nc.variables['dir_time'].units = \
-                "seconds since 1900-01-01 00:00:00"
-                nc.variables['dir_time'].calendar = "julian"
-            
-                nc.createVariable('dir_spec','f8',('dir_time','freq','dir'))
-                nc.variables['dir_spec'].units = 'meter2 second degree-1'
-                nc.variables['dir_spec'].long_name = \
-                    'Frequency-Direction variance spectrum'  
-                    
-                nc.createVariable('direction','f8',('dir'))
-                nc.variables['direction'].units = 'degree'
-                nc.variables['direction'].long_name = \
-                    'Degrees from true north in oceanographic convention'
-                nc.variables['direction'][:] = angles
-            
-            
-            # Read spectral data
-            alpha_1 = np.loadtxt(tmp_alpha_1,skiprows=1)
-            alpha_2 = np.loadtxt(tmp_alpha_1,skiprows=1)
-            r_1 = np.loadtxt(tmp_alpha_1,skiprows=1) * 0.01
-            r_2 = np.loadtxt(tmp_alpha_1,skiprows=1) * 0.01
-    
-            # Allocate data
-            dir_time = np.zeros((alpha_1.shape[0]))              
-            for bb in range(dir_time.shape[0]):
-                dir_time[bb] = (datetime.datetime(np.int(alpha_1[bb,0]),
-                                                  np.int(alpha_1[bb,1]),
-                                                  np.int(alpha_1[bb,2]),
-                                                  np.int(alpha_1[bb,3]),
-                                                  np.int(alpha_1[bb,4])) - 
-                                basetime).total_seconds()
-                             
-                                         
-            alpha_1 = alpha_1[:,5:]
-            alpha_2 = alpha_2[:,5:]
-            r_1 = r_1[:,5:]
-            r_2 = r_2[:,5:]
-            
-            
-            # Construct 2D spectra
-            # See http://www.ndbc.noaa.gov/measdes.shtml
-            wspec = np.NaN * np.zeros((alpha_1.shape[0],
-                                       freq.shape[0],angles.shape[0]))
-            
-            
-            # Time loop
-            for bb in range(wspec.shape[0]):
-                # Frequency loop  
-                for cc in range(wspec.shape[1]):
-                    # Direction loop
-                    for dd in range(wspec.shape[2]):
-                        wspec[bb,cc,dd] = (freq_spec[bb,cc] * np.pi/180.0 *
-                                           (1.0/np.pi) * 
-                                           (0.5 + r_1[bb,cc] * 
-                                            np.cos((angles[dd]-alpha_1[bb,cc])*
-                                                   np.pi/180.0) +
-                                            r_2[bb,cc] * 
-                                            np.cos(2 * np.pi / 180.0 * 
-                                                   (angles[dd]-alpha_2[bb,cc])))
-                                           )
-            
-            # Write to file
-            if cnt_dir == 1:
-                nc.variables['dir_spec'][:] = wspec
-                nc.variables['dir_time'][:] = dir_time
-            else:
-                nc.variables['dir_spec'][tstep_dir:,:,:] = wspec
-                nc.variables['dir_time'][tstep_dir:] = dir_time
-            
-            tstep_dir += dir_time.shape[0]
-            
+    USAGE:
+    ------
+    stations = find_buoys(rootdir)
+    
+    PARAMETERS:
+    -----------
+    rootdir  : Directory that is searched recursively
+    
+    RETURNS:
+    --------
+    Dictionary with (kind,buoyid,folder) keys, kind is 'bulk' or 'spec', and
+    the sorted list of file names of each station as values.
+    
+    NOTES:
+    ------
+    Files are identified by the historical NDBC naming convention: station
+    id, file type letter (h: bulk parameters, w,d,i,j,k: spectral data) and
+    year, e.g. 46029h2010.txt or 46029w2010.txt. Several stations can share 
+    a folder.
+    """
+    
+    stations = {}
+    for folder,_,archivos in os.walk(rootdir):
+        for archivo in archivos:
+            match = _NDBC_FILE.match(archivo)
+            if match is None:
+                continue
+            kind = 'bulk' if match.group(2) == 'h' else 'spec'
+            key = (kind,match.group(1),folder)
+            stations.setdefault(key,[]).append(archivo)
+    
+    for key in stations:
+        stations[key].sort()
+    
+    return stations
+
+
+def _parse_task(task):
+    """
+    Parse a bulk parameter file or a year of spectral files in a worker 
+    process. Errors are returned instead of raised so a bad file does not 
+    stop the batch. Not for standalone use.
+    """
+    
+    kind,key,files = task
+    t0 = time.time()
+    nbytes = 0
+    try:
+        if kind == 'bulk':
+            nbytes = os.path.getsize(files)
+        else:
+            nbytes = sum([os.path.getsize(x) for x in files.values() 
+                          if os.path.isfile(x)])
+        if kind == 'bulk':
+            result = _parse_bulk_file(files)
+        else:
+            result = _parse_spec_year(files)
+        error = None
+    except Exception as err:
+        result = None
+        error = '%s: %s' % (type(err).__name__,err)
+    
+    return key,files,result,error,time.time() - t0,nbytes
+
+
+def convert_buoys(rootdir,outdir=None,processes=None,incremental=False,
+                  ncformat=4,dtheta=5,method='fourier',single=False,
+                  time_block=1000,verbose=True):
+    '''
+    Convert the NDBC bulk parameter and spectral text files of all the 
+    stations found under a directory to NetCDF.
+    
+    Usage:
+    ------
+    report = convert_buoys(rootdir,outdir,processes,incremental,ncformat,
+                           dtheta,method,single,time_block,verbose)
+    
+    Input:
+    ------
+    rootdir     : Directory with the text files (searched recursively, see 
+                  find_buoys)
+    outdir      : (Optional) Folder for the NetCDF files. Defaults to the 
+                  folder of the text files of each station.
+    processes   : (Optional) Number of processes used to parse the files. 
+                  Defaults to the number of CPUs, 1 runs without a pool.
+    incremental : Only ingest new or changed files (see bulk2nc and spec2nc)
+    ncformat    : NetCDF format of the bulk parameter files (see bulk2nc)
+    dtheta,method,single,time_block : Spectral options (see spec2nc)
+    verbose     : Print the report of each station when it is done
+    
+    Output:
+    -------
+    report      : Dictionary with (kind,buoyid) keys and, for each station, 
+                  a dictionary with the NetCDF file, the number of files and
+                  records ingested, the megabytes parsed, the parsing and 
+                  writing times [s], the throughput [MB/s] and a list of 
+                  failures (file,error message).
+    
+    Notes:
+    ------
+    The bulk parameter files (one per file) and the spectral files (one per 
+    year) are parsed in a pool of processes. All the NetCDF files are 
+    written by the calling process, one station at a time as soon as all 
+    of its files have been parsed, so there is a single writer per file. 
+    Files that fail to parse are reported and left out of the manifest so 
+    they are retried on the next incremental run. A station that fails to
+    write is reported and the batch continues.
+    
+    Outputs are buoyid.nc (bulk parameters) and buoyid_spec.nc (spectra) 
+    with their manifests.
+    
+    '''
+    
+    angles = np.arange(0.0,360.0,dtheta)
+    
+    #===========================================================================
+    # Find the work to do
+    #===========================================================================
+    stations = find_buoys(rootdir)
+    
+    tasks = []
+    pending = {}
+    report = {}
+    for (kind,buoyid,folder),archivos in sorted(stations.items()):
         
-        # Compute bulk parameters
-        moment0 = np.trapz(freq_spec.T,freq,axis=0)
-        Hsig = 4.004*(moment0)**0.5
+        key = (kind,buoyid)
+        if key in report:
+            print('Station ' + buoyid + ' (' + kind + ') found in more ' + 
+                  'than one folder, only ' + report[key]['ncfile'] + 
+                  ' will be processed')
+            continue
         
-        # Write to NetCDF file
-        if cnt_freq == 1:
-            nc.variables['Hsig'][:] = Hsig
-            nc.variables['freq_spec'][:] = freq_spec
-            nc.variables['wave_time'][:] = freq_time
+        ncfolder = folder if outdir is None else outdir
+        if kind == 'bulk':
+            ncfile = os.path.join(ncfolder,buoyid + '.nc')
         else:
-            nc.variables['Hsig'][tstep_freq:] = Hsig
-            nc.variables['freq_spec'][tstep_freq:,:] = freq_spec
-            nc.variables['wave_time'][tstep_freq:] = freq_time
+            ncfile = os.path.join(ncfolder,buoyid + '_spec.nc')
         
-        tstep_freq += freq_time.shape[0]
+        archivos,manifest,append = _pending_files(ncfile,folder,archivos,
+                                                  incremental)
+        report[key] = {'ncfile':ncfile,'files':0,'records':0,'MB':0.0,
+                       'parse_time':0.0,'write_time':0.0,'throughput':np.nan,
+                       'failures':[]}
+        if append and len(archivos) == 0:
+            continue
         
+        # Parsing tasks (files for bulk data, years for spectral data)
+        if kind == 'bulk':
+            station_tasks = [(kind,key,os.path.join(folder,x)) 
+                             for x in archivos]
+        else:
+            years = sorted(set([x[6:10] for x in archivos]))
+            station_tasks = []
+            for aa in years:
+                tmpfiles = dict((name,os.path.join(folder,buoyid + letter + 
+                                                   aa + '.txt'))
+                                for name,letter in _SPEC_FILES)
+                if os.path.isfile(tmpfiles['freq_spec']):
+                    station_tasks.append((kind,key,tmpfiles))
         
-       
-    # Wrap up ------------------------------------------------------------------
-    # Close NetCDF File 
-    nc.close()
+        if len(station_tasks) == 0:
+            continue
+        tasks.extend(station_tasks)
+        pending[key] = {'ntasks':len(station_tasks),'results':[],
+                        'manifest':manifest,'append':append}
+    
+    #===========================================================================
+    # Parse in parallel and write each station when it is complete
+    #===========================================================================
+    def write_station(key):
+        
+        kind,buoyid = key
+        station = pending.pop(key)
+        stats = report[key]
+        results = [x for x in station['results'] if x is not None]
+        
+        # Stations where every task failed are only reported
+        t0 = time.time()
+        if len(results) > 0:
+            try:
+                manifest = station['manifest']
+                if kind == 'bulk':
+                    data = _merge_bulk([x[0] for x in results])
+                    _write_bulk(stats['ncfile'],buoyid,data,station['append'],
+                                ncformat)
+                else:
+                    results.sort(key=lambda x: x[0]['wave_time'].min() 
+                                 if x[0]['wave_time'].shape[0] > 0 else 0.0)
+                    nc = _open_spec_nc(stats['ncfile'],buoyid,method,angles,
+                                       station['append'])
+                    try:
+                        for parsed,_ in results:
+                            _write_spec_year(nc,parsed,angles,method,single,
+                                             time_block)
+                    finally:
+                        nc.close()
+                for _,entries in results:
+                    manifest.update(entries)
+                    stats['files'] += len(entries)
+                    stats['records'] += sum([x['records'] 
+                                             for x in entries.values()])
+                _save_manifest(stats['ncfile'],manifest)
+            except Exception as err:
+                stats['failures'].append((stats['ncfile'],'%s: %s' % 
+                                          (type(err).__name__,err)))
+        stats['write_time'] = time.time() - t0
         
+        elapsed = stats['parse_time'] + stats['write_time']
+        if elapsed > 0:
+            stats['throughput'] = stats['MB']/elapsed
+        if verbose:
+            print('%s %-4s %6d files %9d records %8.2f MB %8.2f MB/s %d failures'
+                  % (buoyid,kind,stats['files'],stats['records'],stats['MB'],
+                     stats['throughput'],len(stats['failures'])))
+    
+    if processes == 1 or len(tasks) <= 1:
+        pool = None
+        results = map(_parse_task,tasks)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_parse_task,tasks)
+    
+    try:
+        for key,files,result,error,elapsed,nbytes in results:
+            stats = report[key]
+            stats['parse_time'] += elapsed
+            stats['MB'] += nbytes/1.0e6
+            if error is not None:
+                if not isinstance(files,str):
+                    files = files['freq_spec']
+                stats['failures'].append((files,error))
+            pending[key]['results'].append(result)
+            pending[key]['ntasks'] -= 1
+            if pending[key]['ntasks'] == 0:
+                write_station(key)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    return report
@@ -20,7 +20,6 @@ Dependencies:
 -------------
     numpy
     scipy
-    sys
   
 Internal dependencies:
 ----------------------
@@ -36,15 +35,20 @@ __group__ = 'Nearshore Modeling Group (Oregon State University)'
 
 # Import modules
 import numpy as np
-import sys
+import os
 import scipy as spi
+try:
+    import scipy.fft as _fft
+except ImportError:
+    _fft = np.fft
+import scipy.signal
 import scipy.stats
 
 
 # =============================================================================
 # Cross correlation Function
 # =============================================================================
-def cross_corr(x,y,lags,norma=1.0):
+def cross_corr(x,y,lags,norma=1.0,pairs='columns'):
     """
     
     CROSS_CORR
@@ -54,10 +58,13 @@ def cross_corr(x,y,lags,norma=1.0):
     Input
     -----
        - x, y  : are time series of the same length. Missing values should be
-                 flagged as np.nan.
+                 flagged as np.nan. Can also be 2D arrays (time,channels).
        - lags  : number of lags desired
        - norma : normalization, takes 0 or 1. If not provided the function
                  defaults to 1 (based estimate, N).         
+       - pairs : (Optional) for 2D inputs, 'columns' correlates x[:,i] with
+                 y[:,i] and 'all' correlates every column of x with every 
+                 column of y. Defaults to 'columns'.
 
     Results
     -------
@@ -65,63 +72,105 @@ def cross_corr(x,y,lags,norma=1.0):
        - stats : lag, cross(auto)-covariance, x standard deviation,
                  y standard deviation, number of observations 
          
+       For 1D inputs rho.shape = (2*lags+1,1) and stats.shape = 
+       (2*lags+1,5). For 2D inputs the channel dimensions are appended: 
+       rho.shape = (2*lags+1,channels) and stats.shape = (2*lags+1,5,channels)
+       with pairs = 'columns', or (2*lags+1,channels_x,channels_y) and 
+       (2*lags+1,5,channels_x,channels_y) with pairs = 'all'.
+         
     Notes 
     -----
        - For auto-correlation use x = y
        - Positive lags indicate y follows x (i.e. x leads y)
+       - Adjacent pairs of a (time,points) array are correlated with
+         cross_corr(eta[:,:-1],eta[:,1:],lags)
+       - At every lag only the pairs where both x and y are finite are used.
+         The sums over those pairs (counts, sums and sums of squares and 
+         products of the masked series) are computed for all lags at once
+         as cross-correlations with the FFT, so the cost is O(N log N) 
+         instead of O(N*lags).
        - Use at your own risk
        
     """
     
     # Quick data check
-    lags = np.int(lags)
-    norma = np.float(norma)
+    lags = int(lags)
+    norma = float(norma)
     
     if (norma != 0.0) and (norma != 1.0):
-        print("A normalization value of " + np.str(norma) + 
+        print("A normalization value of " + str(norma) + 
               " is not supported. Will compute with norma = 1.0\n")
         norma = 1.0
-        
-    # Preallocate variables
-    rho = np.zeros((2*lags+1,1))
-    stats = np.zeros((2*lags+1,5))
-    
-    # loop over lags
-    for aa in range(-lags,lags+1,1):
-        
-        # Get data subset        
-        if aa > 0:
-            # Positive lags
-            ytmp = np.array(y[aa:])
-            xtmp = np.array(x[0:-aa])       
-        elif aa < 0:
-            # Negative lags
-            ytmp = np.array(y[0:aa])
-            xtmp = np.array(x[-aa:])
-        else:
-            xtmp = np.array(x)
-            ytmp = np.array(y)
-            
     
-        # Make sure NaNs are consistent in both subsets
-        xtmp[np.isnan(ytmp)] = np.nan
-        ytmp[np.isnan(xtmp)] = np.nan
+    if pairs not in ('columns','all'):
+        raise ValueError("pairs = " + repr(pairs) + " is not supported, " + 
+                         "use 'columns' or 'all'")
+    
+    x = np.asarray(x,dtype=np.float64)
+    y = np.asarray(y,dtype=np.float64)
+    one_d = x.ndim == 1
+    if one_d:
+        x = x[:,np.newaxis]
+        y = y[:,np.newaxis]
+    N = x.shape[0]
+    
+    # Masks of valid data, remove the mean to reduce round off errors (the
+    # statistics are computed relative to the shift below)
+    mx = np.isfinite(x)
+    my = np.isfinite(y)
+    cx = np.nanmean(x,axis=0)
+    cy = np.nanmean(y,axis=0)
+    x0 = np.where(mx,x - cx,0.0)
+    y0 = np.where(my,y - cy,0.0)
+    
+    # Fourier transforms of the masked series (zero padded to avoid circular
+    # correlation)
+    nfft = 2**int(np.ceil(np.log2(2*N - 1)))
+    fx = np.fft.rfft(np.array([mx,x0,x0**2]),n=nfft,axis=1)
+    fy = np.fft.rfft(np.array([my,y0,y0**2]),n=nfft,axis=1)
+    
+    # Cross-correlation sum_i a[i]*b[i+lag] for all lags
+    def corr(a,b):
+        if pairs == 'all':
+            prod = np.conjugate(a)[...,:,np.newaxis]*b[...,np.newaxis,:]
+        else:
+            prod = np.conjugate(a)*b
+        cc = np.fft.irfft(prod,n=nfft,axis=0)
+        return np.concatenate((cc[nfft-lags:],cc[:lags+1]),axis=0)
+    
+    nobs = np.rint(corr(fx[0],fy[0]))     # Valid pairs
+    sx = corr(fx[1],fy[0])                # sum(x)
+    sy = corr(fx[0],fy[1])                # sum(y)
+    sxx = corr(fx[2],fy[0])               # sum(x**2)
+    syy = corr(fx[0],fy[2])               # sum(y**2)
+    sxy = corr(fx[1],fy[1])               # sum(x*y)
+    
+    if pairs == 'all':
+        cx = cx[:,np.newaxis]
+        cy = cy[np.newaxis,:]
+    
+    with np.errstate(divide='ignore',invalid='ignore'):
         
-        # Compute mean values
-        nn = np.sum(np.isfinite(xtmp) - 1.0 + norma)
-        xtmpmean = np.nansum(xtmp)/nn
-        ytmpmean = np.nansum(ytmp)/nn
+        # Compute mean values (relative to the shift)
+        nn = nobs - 1.0 + norma
+        xmean = sx/nn - cx*(1.0 - nobs/nn)
+        ymean = sy/nn - cy*(1.0 - nobs/nn)
         
         # Cross-covariance
-        crosscov = np.nansum((xtmp - xtmpmean) * (ytmp - ytmpmean))/nn
-        rho[aa+lags] = crosscov / np.nanstd(xtmp) / np.nanstd(ytmp) 
+        crosscov = (sxy - xmean*sy - ymean*sx + nobs*xmean*ymean)/nn
         
-        # Compute and save statistics
-        stats[aa + lags,0] = aa
-        stats[aa + lags,1] = crosscov
-        stats[aa + lags,2] = np.nanstd(xtmp)
-        stats[aa + lags,3] = np.nanstd(ytmp)
-        stats[aa + lags,4] = np.sum(np.isfinite(xtmp))
+        # Standard deviations of the valid pairs
+        xstd = np.sqrt(np.maximum(sxx/nobs - (sx/nobs)**2,0.0))
+        ystd = np.sqrt(np.maximum(syy/nobs - (sy/nobs)**2,0.0))
+        rho = crosscov / xstd / ystd
+    
+    # Compute and save statistics
+    lag = np.broadcast_to(np.arange(-lags,lags+1,1.0).reshape(
+        (2*lags+1,) + (1,)*(rho.ndim-1)),rho.shape)
+    stats = np.stack((lag,crosscov,xstd,ystd,nobs),axis=1)
+    
+    if one_d:
+        return rho,stats[...,0]
         
     return rho,stats
             
@@ -129,75 +178,85 @@ def cross_corr(x,y,lags,norma=1.0):
 #===============================================================================
 # Variance spectrum
 #===============================================================================
-def psdraw(ts,dt=1,demean=False):
+def _psdraw_grid(N,dt,dtype):
+    """
+    Cached frequencies and one sided scale factors for psdraw (read only).
+    """
+    key = (N,float(dt),np.dtype(dtype).str)
+    if key not in _psdraw_cache:
+        if len(_psdraw_cache) >= 16:
+            _psdraw_cache.pop(next(iter(_psdraw_cache)))
+        freq = np.fft.rfftfreq(N,dt).astype(dtype)
+        scale = np.empty(freq.shape[0],dtype=dtype)
+        scale[:] = 2.0*dt/N
+        scale[0] = dt/N
+        if np.mod(N,2) == 0:
+            scale[-1] = dt/N
+        freq.flags.writeable = False
+        scale.flags.writeable = False
+        _psdraw_cache[key] = (freq,scale)
+    return _psdraw_cache[key]
+
+_psdraw_cache = {}
+
+
+def psdraw(ts,dt=1,demean=False,axis=0,single=False,workers=None):
     """
     
-    [freq,Sf] = psdraw(ts,dt,demean)
+    [freq,Sf] = psdraw(ts,dt,demean,axis,single,workers)
     
     Compute the variance spectrum             
     
     PARAMETERS:
     -----------
-    ts    : time series
-    dt    : sampling rate (in time domain)
-    demean: Remove mean
+    ts     : time series, can be N-dimensional (e.g. (time,y,x))
+    dt     : sampling rate (in time domain)
+    demean : Remove mean (the input is not modified)
+    axis   : Time axis. Defaults to 0.
+    single : (Optional) Compute in single precision (float32)
+    workers: (Optional) Number of threads used by the FFT (requires 
+             scipy.fft, ignored otherwise)
     
     RETURNS:
     --------
-    freq  : Spectral frequencies (Positive Fourier frequencies)
-    Sf    : Variance spectrum
+    freq   : Spectral frequencies (Positive Fourier frequencies)
+    Sf     : Variance spectrum with the time axis replaced by frequency
     
     Notes:
     var(ts) = integrate(freq,Sf) 
         >>> np.var(ts)
         >>> spi.integrate.trapz(Sf,freq)
+    
+    The spectrum is computed with a real FFT of all series at once. 
+    Frequencies and scale factors are cached for repeated calls with the
+    same record length, and scipy.fft keeps its own cache of FFT plans.
     """
-
-    # Remove mean
-    if demean:
-        ts -= ts.mean()
-
-    # Compute record length
-    N = ts.shape[0]
-
-    # Another way that is equivalent for reference
-    """
-    # Compute frequency information
-    freq = np.fft.fftshift(np.fft.fftfreq(N,dt))
-
-    if np.mod(N,2) == 1:
-        zero_ind = np.int((N - 1.0)/2.0)
-    else:
-        zero_ind = np.int(N/2.0)  
-    freq_amp = freq[zero_ind:]
     
-    # Compute spectrum
-    ff = np.fft.fftshift(np.fft.fft(ts))
-    sf = 2.0/N*(ff[zero_ind:].real**2 + ff[zero_ind:].imag**2)
+    dtype = np.float32 if single else np.float64
+    ts = np.asarray(ts,dtype=dtype)
     
+    # Remove mean
+    if demean:
+        ts = ts - ts.mean(axis=axis,keepdims=True)
     
-    """
+    # Compute record length
+    N = ts.shape[axis]
+    freq,scale = _psdraw_grid(N,dt,dtype)
     
-    # Compute fourier frequencies
-    fj = np.fft.fftfreq(N,dt)
-
     # Compute power spectral density (Cooley-Tukey Method)
-    yf = np.fft.fft(ts)/N
-    psd = N*dt*yf*np.conjugate(yf)
-
-    # One sided psd from dft
-    if np.mod(N,2) == 0:
-	   sf = np.concatenate((np.array([psd[0]]),2.0*psd[1:N/2],
-                            np.array([psd[N/2]])))
-	   freq_amp = np.abs(np.concatenate((np.array([fj[0]]),fj[1:N/2],
-                                         np.array([fj[N/2]]))))
+    if workers is not None and _fft is not np.fft:
+        yf = _fft.rfft(ts,axis=axis,workers=workers)
     else:
-	   sf = np.concatenate((np.array([psd[0]]),2.0*psd[1:(N+1)/2]))
-	   freq_amp = np.abs(np.concatenate((np.array([fj[0]]),fj[1:(N+1)/2])))
-
-
+        yf = _fft.rfft(ts,axis=axis)
+    sf = yf.real**2 + yf.imag**2
+    
+    # One sided psd from dft
+    sshape = [1]*sf.ndim
+    sshape[axis] = scale.shape[0]
+    sf *= scale.reshape(sshape)
+    
     # End of function
-    return freq_amp,sf.real
+    return freq,sf.astype(dtype,copy=False)
 
 
 # =============================================================================
@@ -246,6 +305,292 @@ def psd_ci(spec,cl,dof):
 
     return conf_lims
 
+#===============================================================================
+# Welch (segment averaged) power spectral density
+#===============================================================================
+def _segments(ts,nperseg,step):
+    """
+    Strided view of the overlapping segments of ts along its first axis with
+    shape (nseg,nperseg) + ts.shape[1:]. No data is copied.
+    """
+    nseg = (ts.shape[0] - nperseg)//step + 1
+    return np.lib.stride_tricks.as_strided(
+        ts,shape=(nseg,nperseg) + ts.shape[1:],
+        strides=(step*ts.strides[0],) + ts.strides,writeable=False)
+
+
+def welch_dof(window,nperseg,step,nseg):
+    """
+    Equivalent degrees of freedom of a Welch spectral estimate.
+    
+    PARAMETERS:
+    -----------
+    window   : Window name (see scipy.signal.get_window) or window values
+    nperseg  : Number of points per segment
+    step     : Number of points between the start of consecutive segments
+    nseg     : Number of averaged segments
+    
+    RETURNS:
+    --------
+    dof      : Degrees of freedom (2*nseg for non-overlapping segments)
+    
+    NOTES:
+    ------
+    Accounts for the correlation between overlapping windowed segments 
+    (Welch 1967; Percival and Walden 1993, eq. 292b)
+        dof = 2*nseg / (1 + 2*sum_k (1 - k/nseg)*rho(k)**2)
+        rho(k) = sum_n w[n]*w[n + k*step] / sum_n w[n]**2
+    """
+    
+    if isinstance(window,str) or isinstance(window,tuple):
+        window = spi.signal.get_window(window,nperseg)
+    window = np.asarray(window,dtype=np.float64)
+    
+    corr = 0.0
+    for kk in range(1,nseg):
+        lag = kk*step
+        if lag >= nperseg:
+            break
+        rho = np.sum(window[:nperseg-lag]*window[lag:])/np.sum(window**2)
+        corr += (1.0 - kk/nseg)*rho**2
+    
+    return 2.0*nseg/(1.0 + 2.0*corr)
+
+
+def _periodogram_sum(segs,win):
+    """
+    Sum over segments of the squared magnitude of the real FFT of the 
+    demeaned and windowed segments (nseg,nperseg,...).
+    """
+    wshape = (win.shape[0],) + (1,)*(segs.ndim - 2)
+    segs = (segs - segs.mean(axis=1,keepdims=True))*win.reshape(wshape)
+    yf = np.fft.rfft(segs,axis=1)
+    return np.sum(yf.real**2 + yf.imag**2,axis=0)
+
+
+def _welch_scale(psum,nseg,win,dt):
+    """
+    One sided spectral density from the sum of nseg periodograms
+    """
+    Sf = psum*(2.0*dt/np.sum(win**2)/nseg)
+    Sf[0] *= 0.5
+    if win.shape[0] % 2 == 0:
+        Sf[-1] *= 0.5
+    return Sf
+
+
+def psd_welch(ts,dt=1,nperseg=256,window='hann',overlap=0.5,axis=0):
+    """
+    
+    freq,Sf,dof = psd_welch(ts,dt,nperseg,window,overlap,axis)
+    
+    Compute the variance spectrum averaging the periodograms of overlapping
+    windowed segments (Welch method).
+    
+    PARAMETERS:
+    -----------
+    ts      : time series, can be N-dimensional (e.g. (time,gauges))
+    dt      : sampling rate (in time domain)
+    nperseg : Number of points per segment (Defaults to 256, limited to the
+              record length)
+    window  : Window applied to each segment (see scipy.signal.get_window).
+              Defaults to 'hann'.
+    overlap : Fraction of overlap between segments. Defaults to 0.5
+    axis    : Time axis. Defaults to 0.
+    
+    RETURNS:
+    --------
+    freq    : Spectral frequencies (Positive Fourier frequencies)
+    Sf      : Variance spectrum with the time axis replaced by frequency
+    dof     : Equivalent degrees of freedom (see welch_dof)
+    
+    NOTES:
+    ------
+    Each segment is demeaned before windowing. The periodograms are scaled
+    by the window power so that integrate(freq,Sf) ~ var(ts). All segments 
+    of all series are transformed with a single real FFT.
+    Confidence limits can be computed with psd_ci(Sf,cl,dof).
+    See StreamingPSD for records that do not fit in memory.
+    """
+    
+    ts = np.moveaxis(np.asarray(ts,dtype=np.float64),axis,0)
+    nperseg = int(min(nperseg,ts.shape[0]))
+    step = max(int(round(nperseg*(1.0 - overlap))),1)
+    win = spi.signal.get_window(window,nperseg)
+    
+    # Averaged one sided periodogram of the segments (nseg,nperseg,...)
+    segs = _segments(np.ascontiguousarray(ts),nperseg,step)
+    nseg = segs.shape[0]
+    Sf = _welch_scale(_periodogram_sum(segs,win),nseg,win,dt)
+    freq = np.fft.rfftfreq(nperseg,dt)
+    
+    dof = welch_dof(win,nperseg,step,nseg)
+    
+    return freq,np.moveaxis(Sf,0,axis),dof
+
+
+#===============================================================================
+# Streaming Welch power spectral density
+#===============================================================================
+class StreamingPSD(object):
+    """
+    Welch power spectral density accumulated over chunks of a record that 
+    does not fit in memory.
+    
+    USAGE:
+    ------
+    spsd = StreamingPSD(nperseg,dt,window,overlap)
+    spsd.update(chunk)                   # Any number of times
+    spsd.feed(source,chunk_size)         # Or consume a whole source
+    freq,Sf = spsd.spectrum()
+    ci = psd_ci(Sf,0.95,spsd.dof)
+    
+    PARAMETERS:
+    -----------
+    nperseg : Number of points per segment
+    dt      : sampling rate (in time domain)
+    window  : Window applied to each segment (see scipy.signal.get_window).
+              Defaults to 'hann'.
+    overlap : Fraction of overlap between segments. Defaults to 0.5
+    
+    ATTRIBUTES:
+    -----------
+    nseg     : Number of segments averaged so far
+    nsamples : Number of samples consumed so far
+    dof      : Equivalent degrees of freedom (see welch_dof)
+    
+    NOTES:
+    ------
+    Chunks are arrays with time along the first axis, e.g. (time,) or 
+    (time,gauges). The samples that do not complete a segment are kept 
+    until the next chunk arrives, so the result is the same as psd_welch on
+    the concatenated record regardless of how it is chunked.
+    
+    The state can be saved with save(filename) and restored with 
+    StreamingPSD.load(filename) to resume long jobs:
+        spsd = StreamingPSD.load('psd.npz')
+        spsd.feed(ncvar,chunk_size,start=spsd.nsamples,checkpoint='psd.npz')
+    """
+    
+    def __init__(self,nperseg,dt=1,window='hann',overlap=0.5):
+        
+        self.nperseg = int(nperseg)
+        self.dt = dt
+        self.overlap = overlap
+        self.step = max(int(round(self.nperseg*(1.0 - overlap))),1)
+        if isinstance(window,str) or isinstance(window,tuple):
+            window = spi.signal.get_window(window,self.nperseg)
+        self.window = np.asarray(window,dtype=np.float64)
+        
+        self.nseg = 0
+        self.nsamples = 0
+        self._psum = None
+        self._buffer = None
+    
+    
+    def update(self,chunk):
+        """
+        Add a chunk of data (time along the first axis)
+        """
+        
+        chunk = np.asarray(chunk,dtype=np.float64)
+        self.nsamples += chunk.shape[0]
+        if self._buffer is not None:
+            chunk = np.concatenate((self._buffer,chunk),axis=0)
+        
+        if chunk.shape[0] < self.nperseg:
+            self._buffer = chunk
+            return
+        
+        # Process all complete segments
+        segs = _segments(np.ascontiguousarray(chunk),self.nperseg,self.step)
+        psum = _periodogram_sum(segs,self.window)
+        if self._psum is None:
+            self._psum = psum
+        else:
+            self._psum += psum
+        self.nseg += segs.shape[0]
+        
+        # Keep the samples needed by the next segment
+        self._buffer = chunk[segs.shape[0]*self.step:].copy()
+    
+    
+    def feed(self,source,chunk_size=None,start=0,checkpoint=None):
+        """
+        Consume a whole source of data.
+        
+        PARAMETERS:
+        -----------
+        source     : Iterable of chunks (e.g. a generator) or, if chunk_size 
+                     is given, an array-like sliced along its first axis 
+                     (numpy array, memory map, netCDF4 variable).
+        chunk_size : (Optional) Number of samples read at a time from source
+        start      : (Optional) First sample read from source (only used 
+                     with chunk_size, e.g. start=self.nsamples to resume)
+        checkpoint : (Optional) File where the state is saved after each 
+                     chunk
+        """
+        
+        if chunk_size is None:
+            chunks = iter(source)
+        else:
+            chunks = (source[i0:i0 + chunk_size] 
+                      for i0 in range(start,len(source),chunk_size))
+        
+        for chunk in chunks:
+            self.update(chunk)
+            if checkpoint is not None:
+                self.save(checkpoint)
+    
+    
+    @property
+    def dof(self):
+        return welch_dof(self.window,self.nperseg,self.step,self.nseg)
+    
+    
+    def spectrum(self):
+        """
+        Return the frequencies and the averaged variance spectrum
+        """
+        if self.nseg == 0:
+            raise ValueError('Not enough data to complete a segment')
+        freq = np.fft.rfftfreq(self.nperseg,self.dt)
+        return freq,_welch_scale(self._psum,self.nseg,self.window,self.dt)
+    
+    
+    def save(self,filename):
+        """
+        Save the state to a numpy .npz file (written to a temporary file 
+        first and atomically renamed so an interrupted save keeps the last
+        checkpoint)
+        """
+        tmpfile = filename + '.tmp'
+        with open(tmpfile,'wb') as f:
+            np.savez(f,nperseg=self.nperseg,dt=self.dt,overlap=self.overlap,
+                     window=self.window,nseg=self.nseg,nsamples=self.nsamples,
+                     psum=self._psum if self._psum is not None else np.nan,
+                     buffer=(self._buffer if self._buffer is not None 
+                             else np.nan))
+        os.replace(tmpfile,filename)
+    
+    
+    @classmethod
+    def load(cls,filename):
+        """
+        Restore a StreamingPSD saved with save
+        """
+        with np.load(filename) as data:
+            spsd = cls(int(data['nperseg']),float(data['dt']),data['window'],
+                       float(data['overlap']))
+            spsd.nseg = int(data['nseg'])
+            spsd.nsamples = int(data['nsamples'])
+            if data['psum'].ndim > 0:
+                spsd._psum = data['psum']
+            if data['buffer'].ndim > 0:
+                spsd._buffer = data['buffer']
+        return spsd
+
+
 #===============================================================================
 # Compute psd with the pre-whitening and post-colouring technique
 #===============================================================================
@@ -349,93 +694,211 @@ def squared_coherence(x,y,stencil,dt=1,cl=0.95):
         
     DEPENDENCIES:
     -------------
-    band_average
+    cross_spectral_matrix
     
     """
 
-    # Compute record length
-    N = x.shape[0]
-   
-    # Compute fourier frequencies
-    fj = np.fft.fftfreq(N,dt)
-
-    # Compute power spectral density (Cooley-Tukey Method) for each time 
-    # series.
-    xf = np.fft.fft(x)/N
-    yf = np.fft.fft(y)/N
-    
-    sxy_conj = N*dt*xf*np.conjugate(yf)
-    sxy      = N*dt*np.conjugate(xf)*yf
-    sxx      = N*dt*xf*np.conjugate(xf)
-    syy      = N*dt*yf*np.conjugate(yf)
-        
-    # Compute with only the positive side of the spectrum
-    freq_ind = fj>=0
-    fj       = fj[freq_ind]
-    sxy_conj = sxy_conj[freq_ind]
-    sxy      = sxy[freq_ind]
-    sxx      = sxx[freq_ind]
-    syy      = syy[freq_ind]
-    
-    # Compute the cross spectrum and quadrature spectrum
-    #cxy   = 1.0*sxy.real
-    #qxy = -1.0*sxy.imag
-    
-    # Compute the phase spectrum
-    #pxy = np.arctan2(-1.0*qxy,cxy)
-    #pxy = np.arctan(-1.0*qxy/cxy)
-    
-    # Band averaging    
-    fj_ba,sxy_conj_ba = band_averaging(sxy_conj,fj,stencil)
-    _,sxy_ba = band_averaging(sxy,fj,stencil)
-    _,sxx_ba = band_averaging(sxx,fj,stencil)
-    _,syy_ba = band_averaging(syy,fj,stencil)
-    #_,pxy_ba = band_averaging(pxy,fj,stencil) 
-    
-    # Compute phase spectrum from band averaged quantities
-    #pxy_ba = np.arctan(sxy_ba.imag/sxy_ba.real)
-    pxy_ba = np.arctan2(sxy_ba.imag,sxy_ba.real)
-    
-    # Compute the cross spectral densities
-    g2 = sxy_conj_ba * sxy_ba / sxx_ba / syy_ba
-    
-    # Confidence intervals on squared coherence
-    alpha = 1.0 - cl
-    g2crit = 1.0 - alpha**(2.0/(2.0*stencil - 2.0))
-    #g2crit = (spi.stats.f.ppf(cl,2,2.0*stencil - 2.0)/
-    #          ((2.0*stencil - 2.0)/2 + 
-    #           spi.stats.f.ppf(cl,2.0,2.0*stencil-2.0)))
-    
-    # Confidence intervals on phase
-    pcl = np.arcsin((2.0/(2.0*stencil - 2.0) * 
-                    (1.0 - g2.real) / (g2.real) * 
-                    spi.stats.f.ppf(cl,2.0,2.0*stencil-2.0))**0.5)
-                                        
-    # Compute time lags
-    tl = pxy_ba/(2.0 * np.pi * fj_ba)
+    # Cross spectral matrix of the pair
+    csm = cross_spectral_matrix(np.column_stack((x,y)),dt=dt,stencil=stencil,
+                                cl=cl,pairs=[(0,1)])
+    fj_ba = csm['freq']
+    sxy_ba = csm['S'][:,0]
+    sxy_conj_ba = np.conjugate(sxy_ba)
+    sxx_ba = csm['sxx'][:,0]
+    syy_ba = csm['sxx'][:,1]
+    pxy_ba = csm['phase'][:,0]
+    g2 = csm['g2'][:,0]
+    g2crit = csm['g2crit']
+    pcl = csm['pcl'][:,0]
+    tl = csm['tl'][:,0]
    
     # End of function
-    return fj_ba,g2.real,g2crit,sxy_conj_ba,sxy_ba,sxx_ba,syy_ba,pxy_ba,pcl,tl
+    return fj_ba,g2,g2crit,sxy_conj_ba,sxy_ba,sxx_ba,syy_ba,pxy_ba,pcl,tl
+
+
+#===============================================================================
+# Cross spectral matrix
+#===============================================================================
+def cross_spectral_matrix(data,dt=1,stencil=None,nperseg=None,window='hann',
+                          overlap=0.5,cl=0.95,pairs=None,axis=0,
+                          max_elements=2**22):
+    """
+    
+    csm = cross_spectral_matrix(data,dt,stencil,nperseg,window,overlap,cl,
+                                pairs,axis,max_elements)
+    
+    Cross spectra, squared coherence and phase between all the channels of a
+    multichannel record (e.g. an array of wave gauges).
+    
+    PARAMETERS:
+    -----------
+    data     : Time series of all channels (time,ch)
+    dt       : sampling rate (in time domain)
+    stencil  : Stencil over which to band average (band averaging method, 
+               see squared_coherence)
+    nperseg  : Number of points per segment (segment averaging method, see
+               psd_welch). Used when stencil is None.
+    window   : Window applied to each segment (segment averaging only)
+    overlap  : Fraction of overlap between segments (segment averaging only)
+    cl       : confidence level (Optional: Defaults to 0.95)
+    pairs    : (Optional) Sequence of (i,j) channel pairs. When given only 
+               these cross spectra are computed, otherwise the full 
+               (freq,ch,ch) matrix is computed.
+    axis     : Time axis of data. Defaults to 0.
+    max_elements : (Optional) Maximum number of complex products held in 
+                   memory at once when band averaging.
+    
+    RETURNS:
+    --------
+    Dictionary containing
+        freq   : Spectral frequencies (averaged)
+        S      : Cross spectra S_ij = conj(X_i)*X_j (freq,ch,ch) or 
+                 (freq,npairs) if pairs were given
+        sxx    : Auto-spectra (freq,ch)
+        g2     : Squared coherence, same shape as S
+        g2crit : Critical value that g2 must exceed to be significant at cl
+        phase  : Phase spectrum, same shape as S
+        pcl    : Confidence limits for the phase spectrum, same shape as S
+        tl     : Time lags (t = phase/(2*pi*freq)), same shape as S
+        dof    : Degrees of freedom of the spectral estimates
+        pairs  : Channel pairs (only if pairs were given)
+    
+    NOTES:
+    ------
+    Each channel is Fourier transformed once and all cross spectra are 
+    formed with batched products. Spectra are two sided densities as in 
+    squared_coherence. The full matrix is Hermitian (S_ji = conj(S_ij)).
+    Positive phases indicate channel i leads channel j.
+    
+    With band averaging the frequencies where fftfreq >= 0 are used (as in
+    squared_coherence) and dof = 2*stencil. With segment averaging each 
+    segment is demeaned and windowed and dof is computed by welch_dof. The
+    confidence limits are those of squared_coherence with stencil = dof/2.
+    
+    """
+    
+    data = np.moveaxis(np.asarray(data,dtype=np.float64),axis,0)
+    N,nch = data.shape
+    
+    if pairs is not None:
+        pairs = np.atleast_2d(np.asarray(pairs,dtype=np.intp))
+        ich,jch = pairs[:,0],pairs[:,1]
+    
+    if stencil is not None:
+        
+        # Band averaging: FFT of each channel (only fftfreq >= 0)
+        nfreq = (N + 1)//2
+        xf = np.fft.rfft(data,axis=0)[:nfreq]
+        fj = np.fft.rfftfreq(N,dt)[:nfreq]
+        scale = dt/N
+        
+        # Band limits (see band_averaging)
+        stencil = int(stencil)
+        ind = np.concatenate(([0],np.arange(1,nfreq,stencil))).astype(np.intp)
+        counts = np.diff(np.append(ind,nfreq))
+        nband = ind.shape[0]
+        dof = 2.0*stencil
+        
+        freq = np.add.reduceat(fj,ind)/counts
+        sxx = (np.add.reduceat(xf.real**2 + xf.imag**2,ind,axis=0)*
+               (scale/counts[:,None]))
+        
+        # Blocks of bands so that the products fit in memory
+        npair = nch*nch if pairs is None else pairs.shape[0]
+        bblock = max(int(max_elements//max(npair*stencil,1)),1)
+        if pairs is None:
+            S = np.empty((nband,nch,nch),dtype=np.complex128)
+        else:
+            S = np.empty((nband,npair),dtype=np.complex128)
+        for b0 in range(0,nband,bblock):
+            b1 = min(b0 + bblock,nband)
+            f0 = ind[b0]
+            f1 = ind[b1] if b1 < nband else nfreq
+            xb = xf[f0:f1]
+            if pairs is None:
+                prod = np.einsum('fi,fj->fij',np.conjugate(xb),xb)
+            else:
+                prod = np.conjugate(xb[:,ich])*xb[:,jch]
+            S[b0:b1] = np.add.reduceat(prod,ind[b0:b1] - f0,axis=0)
+        S /= counts.reshape((nband,) + (1,)*(S.ndim - 1))
+        S *= scale
+        
+    else:
+        
+        # Segment averaging: FFT of all segments of all channels at once
+        nperseg = int(min(N if nperseg is None else nperseg,N))
+        step = max(int(round(nperseg*(1.0 - overlap))),1)
+        win = spi.signal.get_window(window,nperseg)
+        segs = _segments(np.ascontiguousarray(data),nperseg,step)
+        nseg = segs.shape[0]
+        segs = (segs - segs.mean(axis=1,keepdims=True))*win[:,None]
+        xf = np.fft.rfft(segs,axis=1)
+        scale = dt/np.sum(win**2)/nseg
+        
+        freq = np.fft.rfftfreq(nperseg,dt)
+        dof = welch_dof(win,nperseg,step,nseg)
+        
+        sxx = np.sum(xf.real**2 + xf.imag**2,axis=0)*scale
+        if pairs is None:
+            S = np.einsum('sfi,sfj->fij',np.conjugate(xf),xf)*scale
+        else:
+            S = np.einsum('sfp,sfp->fp',np.conjugate(xf[...,ich]),
+                          xf[...,jch])*scale
+    
+    # Auto-spectra of each side of the pairs
+    if pairs is None:
+        sii = sxx[:,:,None]
+        sjj = sxx[:,None,:]
+        fshape = (freq.shape[0],1,1)
+    else:
+        sii = sxx[:,ich]
+        sjj = sxx[:,jch]
+        fshape = (freq.shape[0],1)
+    
+    with np.errstate(divide='ignore',invalid='ignore'):
+        
+        # Squared coherence and phase spectrum
+        g2 = (S.real**2 + S.imag**2)/sii/sjj
+        phase = np.arctan2(S.imag,S.real)
+        
+        # Confidence intervals on squared coherence and phase
+        alpha = 1.0 - cl
+        g2crit = 1.0 - alpha**(2.0/(dof - 2.0))
+        pcl = np.arcsin((2.0/(dof - 2.0) * (1.0 - g2) / g2 * 
+                         spi.stats.f.ppf(cl,2.0,dof - 2.0))**0.5)
+        
+        # Compute time lags
+        tl = phase/(2.0 * np.pi * freq.reshape(fshape))
+    
+    csm = {'freq':freq,'S':S,'sxx':sxx,'g2':g2,'g2crit':g2crit,
+           'phase':phase,'pcl':pcl,'tl':tl,'dof':dof}
+    if pairs is not None:
+        csm['pairs'] = pairs
+    
+    # End of function
+    return csm
 
 
 #===============================================================================
 # Band averaging variance spectra
 #===============================================================================
-def band_averaging(psd,freq,stencil):
+def band_averaging(psd,freq,stencil,axis=0):
     """
 
     Function to band average power spectral density
     
     USAGE:
     ------
-    freq_ba,psd_ba = band_averaging(psd,freq,stencil)
+    freq_ba,psd_ba = band_averaging(psd,freq,stencil,axis)
 
     PARAMETERS:
     -----------
-    psd     : Power spectral density
+    psd     : Power spectral density, real or complex, can be N-dimensional
+              (e.g. (freq,y,x))
     freq    : Frequencies of the PSD. It is assumed that freq[0] = 0. Thus the 
               band averaging will start at freq[1]. 
     stencil : Number of frequencies to average.
+    axis    : Frequency axis of psd. Defaults to 0.
     
     RETURNS:
     --------
@@ -445,40 +908,26 @@ def band_averaging(psd,freq,stencil):
     NOTES:
     ------    
     One sided spectra expected
+    The last band averages the remaining frequencies when they are fewer 
+    than stencil. All bands are summed in a single pass with np.add.reduceat.
 
     """
     
     # Make sure we are dealing with integers
-    stencil = np.int(stencil)
-
-    # Determine the size of the output arrays
-    Nout = np.int(1 + np.ceil((psd.shape[0]-1)/stencil))
-    
-    # Preallocate variables
-    if np.sum(np.iscomplex(psd)) > 0:
-        psd_ba = np.zeros((Nout,))*1j
-    else:
-        psd_ba = np.zeros((Nout,))
-    freq_ba = np.zeros((Nout,))
+    stencil = int(stencil)
+    psd = np.asarray(psd)
+    freq = np.asarray(freq)
+    nfreq = psd.shape[axis]
 
-    # Allocate the first frequency and PSD estimate
-    psd_ba[0] = psd[0]
-    freq_ba[0] = freq[0]
-
-    # Loop over the central bands to average
-    for aa in range(1,Nout-1):
-        
-        # Find averaging limits
-        ind_low = (aa - 1.0)*stencil + 1.0
-        ind_high = ind_low + stencil
-        
-        # Band averaging
-        psd_ba[aa] = np.mean(psd[ind_low:ind_high])
-        freq_ba[aa] = np.mean(freq[ind_low:ind_high])
-        
-    # Work on the last frequency bin
-    psd_ba[Nout-1] = np.mean(psd[ind_high::])
-    freq_ba[Nout-1] = np.mean(freq[ind_high::])
+    # First index of each band (freq[0] is kept as is)
+    ind = np.concatenate(([0],np.arange(1,nfreq,stencil))).astype(np.intp)
+    counts = np.diff(np.append(ind,nfreq))
+    
+    # Band averaging
+    cshape = [1]*psd.ndim
+    cshape[axis] = ind.shape[0]
+    psd_ba = np.add.reduceat(psd,ind,axis=axis)/counts.reshape(cshape)
+    freq_ba = np.add.reduceat(freq,ind)/counts
 
     # End of function
     return freq_ba,psd_ba
@@ -488,18 +937,21 @@ def band_averaging(psd,freq,stencil):
 #===============================================================================
 # Very simple implementation of a boxcar function for averaging purposes.
 #===============================================================================
-def boxcar(y,span):
+def boxcar(y,span,axis=0,double=False):
     """
     
     Usage:
     ------
-    ylpf = boxcar(y,span)
+    ylpf = boxcar(y,span,axis,double)
     
     Input
     -----
        - y is the signal that will be filtered
        - span is the stencil width (should be an odd number, otherwise it will
          be forced to be so)
+       - axis along which to filter (Optional, defaults to 0)
+       - double applies the running average twice (Optional, defaults to 
+         False)
 
     Results
     -------
@@ -511,7 +963,12 @@ def boxcar(y,span):
          fc = 0.6/(time_span)
        - Double running average filter:
          fc = 0.4429/(time_span)
-       - Operates on first dimension of the array
+       - Near the edges the average is taken over the part of the stencil
+         that falls inside the array.
+       - NaNs are ignored, the average is taken over the valid points in the
+         stencil (NaN if there are none).
+       - Running sums are computed with cumulative sums, so the cost does not
+         depend on span.
        - A lot of assumptions about the data are made here, this function is by
          no means as robust as Matlab's smooth function. Only real valued
          numbers are assumed to be passed to the array and no repetition in the 
@@ -519,37 +976,57 @@ def boxcar(y,span):
        
     """
     
-    # Quick data check
-    if span > y.shape[0]:
-        print("Stencil of " + np.str(span) + " is larger than the " + 
-              "length of the array (" + np.str(y.shape[0]) + ")")
-        sys.exit()
+    y = np.moveaxis(np.asarray(y,dtype=np.float64),axis,0)
+    n = y.shape[0]
     
+    # Quick data check
+    if span > n:
+        raise ValueError("Stencil of " + str(span) + " is larger than the " + 
+                         "length of the array (" + str(n) + ")")
     
     # Span must be an odd number
     width = span - 1 + span % 2
-    offset = np.int((width - 1.0)/2.0)
+    offset = (width - 1)//2
+    
+    # Stencil limits clipped at the edges
+    ind = np.arange(n)
+    lo = np.maximum(ind - offset,0)
+    hi = np.minimum(ind + offset + 1,n)
+    
+    ybox = y
+    for aa in range(2 if double else 1):
+        ybox = _running_mean(ybox,lo,hi)
+    
+    return np.moveaxis(ybox,0,axis)
+
+
+def _running_mean(y,lo,hi):
+    """
+    Mean of y[lo:hi] along the first axis for every (lo,hi) pair ignoring 
+    NaNs. Not for standalone use.
+    """
     
-    # Preallocate variable
-    ybox = np.zeros_like(y)
+    valid = np.isfinite(y)
     
-    # Find indices for averaging
-    first = np.int(np.ceil(width/2.0) - 1.0)
-    last = np.int(y.shape[0] - first - 1.0)
+    # Remove the mean to limit the round off in the cumulative sums
+    with np.errstate(invalid='ignore'):
+        ymean = np.nanmean(y,axis=0) if not valid.all() else y.mean(axis=0)
+    ymean = np.where(np.isfinite(ymean),ymean,0.0)
+    yc = np.where(valid,y - ymean,0.0)
     
-    for aa in range(first,last+1):
-        ybox[aa] = np.sum(y[aa-offset:aa+offset+1],axis=0)/width
+    zero = np.zeros((1,) + y.shape[1:])
+    csum = np.concatenate((zero,np.cumsum(yc,axis=0)),axis=0)
+    ysum = csum[hi] - csum[lo]
     
-    # Provide end treatment
-    for aa in range(0,first):
-        ybox[aa] = (np.sum(y[0:aa+offset+1],axis=0) / 
-                    (aa + offset + 1.0))
-        
-    for aa in range(last+1,y.shape[0]):
-        ybox[aa] = (np.sum(y[aa-offset::],axis=0) /
-                    (y.shape[0] - aa + offset + 0.0))    
+    if valid.all():
+        cshape = (hi.shape[0],) + (1,)*(y.ndim - 1)
+        count = (hi - lo).reshape(cshape).astype(np.float64)
+    else:
+        ccount = np.concatenate((zero,np.cumsum(valid,axis=0)),axis=0)
+        count = ccount[hi] - ccount[lo]
     
-    return ybox
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return ysum/count + ymean
 
 
 # ==============================================================================
@@ -562,6 +1039,10 @@ def aliased_frequency(dt_sampling,signal_period):
     Determines the frequency into which a high frequency signal is aliased to.
     This is due to aliasing. 
     
+    USAGE:
+    ------
+    fa,Ta = aliased_frequency(dt_sampling,signal_period)
+    
     PARAMETERS:
     -----------
     dt_sampling     : Sampling period [s,min,hr,day,etc]
@@ -569,49 +1050,43 @@ def aliased_frequency(dt_sampling,signal_period):
     
     RETURNS:
     --------
-    aliased_frequency : Frequency that will contain the information of the 
-                        high frequency process:
+    fa              : Frequency that will contain the information of the 
+                      high frequency process (0 <= fa <= Nyquist frequency)
+    Ta              : Aliased period (1/fa, inf if the signal is aliased to 
+                      the mean)
+    
+    NOTES:
+    ------
+    Inputs can be arrays and are broadcast against each other, e.g. a sweep 
+    of sampling intervals against a set of tidal periods:
+        fa,Ta = aliased_frequency(dt[:,np.newaxis],periods[np.newaxis,:])
+    Signals that are resolved by the sampling (frequency below the Nyquist
+    frequency) are returned unchanged.
+    The signal frequency fk is folded into the [0,fN] band:
+        fa = |fk - round(fk*dt)/dt|
     """
     
-    # Compute Nyquist frequency
-    fN = 1.0/(2.0 * dt_sampling)
+    dt_sampling = np.asarray(dt_sampling,dtype=np.float64)
     
     # Frequency of the signal
-    fk = 1.0/signal_period
-    
-    # Screen output
-    print(" ")
-    print("freq_signal = " + np.str(fk))
-    print("freq_nyquist = " + np.str(fN))
-    
-    # Determine if the signal is indeed aliased or if it is resolved
-    if fk <= fN:
-        print("The signal is theoretically resolved given the sampling rate")
-        return
-
-    # Figure out the aliased frequency
-    k = -1
-    while True:
-        k = k + 1
-        aliased_frequency = fk - 2.0 * k * fN
-        if aliased_frequency < fN:
-            print('aliased_frequency = ' + np.str(aliased_frequency))
-            print('aliased_period = ' + np.str(1.0/aliased_frequency))
-            break
-        elif k > 100000000:
-            print('Maximum number of iterations reached, exiting')
-            aliased_frequency = np.NaN
-            break
+    fk = 1.0/np.asarray(signal_period,dtype=np.float64)
+    
+    # Fold the frequency about multiples of the sampling frequency
+    aliased_freq = np.abs(fk - np.round(fk*dt_sampling)/dt_sampling)
+    
+    with np.errstate(divide='ignore'):
+        aliased_period = 1.0/aliased_freq
     
     # Exit function 
-    return aliased_frequency
+    return aliased_freq,aliased_period
     
     
 
 # =============================================================================
 # Smooth1d Loeess filter
 # =============================================================================
-def smooth1d_loess(data,data_grid,span_x,est_grid=None):
+def smooth1d_loess(data,data_grid,span_x,est_grid=None,processes=None,
+                   max_pairs=2**22):
     '''
     1-dimensional loess smoother. The smoothed value at each grid point is
     found from a weighted least-squares regression of the poins within
@@ -631,7 +1106,14 @@ def smooth1d_loess(data,data_grid,span_x,est_grid=None):
     EST_GRID   : (optional) Are the locations of the grid where smoothed
                  estimates are desired. The estimate grid can be irregular
                  and non-monotonic. Any points in EST_GRID outside of the range
-                 of DATA_GRID will not have SM_DATA-NaN
+                 of DATA_GRID will have SM_DATA=NaN
+    PROCESSES  : (optional) Number of processes used to smooth long grids 
+                 (blocks of estimate points are distributed across a 
+                 multiprocessing pool). Defaults to serial.
+    MAX_PAIRS  : (optional) Maximum number of (estimate point,data point) 
+                 pairs held in memory at once. Blocks of estimate points are
+                 sized so that the total number of data points within SPAN_X
+                 of them stays below this limit. Defaults to 2**22.
                  
     RETURNS:
     --------
@@ -667,136 +1149,228 @@ def smooth1d_loess(data,data_grid,span_x,est_grid=None):
     - Written in python by Gabriel Garcia Medina, 19 April 2015. This code was
       provided to me in Matlab by Dr. Jonathan Nash (Oregon State University),
       as part of the OC683 course during the Spring 2015 term.
+    - The neighbours of each estimate point are found with searchsorted on
+      the sorted data grid and the weighted quadratic regression is solved
+      in closed form for all points at once. Memory scales with MAX_PAIRS
+      and not with the number of points or the window size.
     
     '''    
     
     if est_grid is None:
         est_grid = 1.0*data_grid
+    est_grid = np.asarray(est_grid,dtype=np.float64)
      
-    # Data check (need to do some more)
+    # Data check: keep finite data sorted by location
+    data = np.asarray(data,dtype=np.float64)
+    data_grid = np.asarray(data_grid,dtype=np.float64)
     data_finite_flag = np.isfinite(data)
-    
-    # Preallocate output variables
-    sm_data = np.zeros_like(est_grid)*np.NaN
-    flag = np.zeros_like(sm_data)*np.NaN
+    isort = np.argsort(data_grid[data_finite_flag],kind='mergesort')
     
     # Normalize grids by span_x
-    data_grid = data_grid/span_x
-    est_grid = est_grid/span_x
-        
-    # Loop through all the points in EST_GRID that are within the range of 
-    # DATA_GRID    
-    for ii in range(est_grid.shape[0]):
-        
-        # Verify that the data is within the range of the input data
-        if est_grid[ii] < data_grid.min():
-            continue
-        elif est_grid[ii] > data_grid.max():
-            return
-            
-        dx = data_grid - est_grid[ii];
-        distx = np.abs(dx)
-        igood = np.logical_and(distx < 1,data_finite_flag)
-        ngood = np.sum(igood)
-        
-        
-        # Need at least 3 data points for regression
-        if ngood < 3:
-            continue
-        
-        # Extract data to work with
-        datareg = data[igood]
-        dxsel = dx[igood]
-        distsel = distx[igood]
-        
-        # Use tricubic weighting function for the filter weights. 
-        w = (1.0 - distsel**3)**3
-        
-        # Compute array of w*(1+x+x2)
-        xin = np.zeros((w.shape[0],3))*np.NaN
-        xin[:,0] = w
-        xin[:,1] = w*dxsel
-        xin[:,2] = xin[:,1]*dxsel
-        
-        # Least-squares solution to the over-determined set of equations. 
-        # It solves the equation wY = B*(wX), where Y is the smoothed estimate
-        # of the input DATA, X is the coordinate relative to the grid point
-        # of the smoothed estimate, and B are the regression coefficients. 
-        # Solves the QR decomposition
-        
-        B = np.linalg.lstsq(xin,w*datareg)
-        
-        # Smoothed value is just the first regression coefficient, since the
-        # grid point was chosen such that it is at x=0. Also need to check
-        # that the regression point is within the range of the data points 
-        # used in fitting the quadratic surface. It should be out of range 
-        # only rarely, and if it is, the smoothed estimate at that point is
-        # given and the FLAG is set to 1. 
-        sm_data[ii] = B[0][0]
-        
-        if np.logical_and(B[0][0] > datareg.min(), B[0][0] < datareg.max()):
-            flag[ii] = 1
-        
+    xdata = data_grid[data_finite_flag][isort]/span_x
+    ydata = data[data_finite_flag][isort]
+    xest = est_grid/span_x
+    
+    # Preallocate output variables
+    sm_data = np.zeros_like(xest)*np.nan
+    flag = np.zeros_like(sm_data)*np.nan
+    
+    # Only the points in EST_GRID that are within the range of DATA_GRID
+    grid_min = np.nanmin(data_grid)/span_x
+    grid_max = np.nanmax(data_grid)/span_x
+    ind = np.flatnonzero(np.logical_and(xest >= grid_min,xest <= grid_max))
+    if ind.shape[0] == 0:
+        return sm_data,flag
+    
+    # Split the estimate points in blocks holding at most max_pairs
+    # neighbours (a single point with more neighbours is its own block)
+    npairs = (np.searchsorted(xdata,xest[ind] + 1.0,side='left') - 
+              np.searchsorted(xdata,xest[ind] - 1.0,side='right'))
+    cpairs = np.concatenate(([0],np.cumsum(npairs)))
+    blocks = []
+    i0 = 0
+    while i0 < ind.shape[0]:
+        i1 = np.searchsorted(cpairs,cpairs[i0] + max_pairs,side='right') - 1
+        i1 = max(i1,i0 + 1)
+        blocks.append(ind[i0:i1])
+        i0 = i1
+    
+    # Distribute the blocks across a pool of processes
+    if processes is not None and processes > 1 and len(blocks) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_loess_block,
+                               [(xdata,ydata,xest[bb]) for bb in blocks])
+        finally:
+            pool.close()
+            pool.join()
+        for bb,(sm_bb,flag_bb) in zip(blocks,results):
+            sm_data[bb] = sm_bb
+            flag[bb] = flag_bb
+    else:
+        for bb in blocks:
+            sm_data[bb],flag[bb] = _loess_block((xdata,ydata,xest[bb]))
     
     # Exit function
     return sm_data,flag
 
 
+def _loess_block(args):
+    """
+    Loess estimates at a block of points. Not for standalone use.
+    
+    args = (xdata,ydata,xest) with xdata sorted and normalized by span_x
+    """
+    
+    xdata,ydata,xest = args
+    sm_data = np.zeros_like(xest)*np.nan
+    flag = np.zeros_like(sm_data)*np.nan
+    
+    # Neighbours within +- 1 (normalized span) of each estimate point
+    lo = np.searchsorted(xdata,xest - 1.0,side='right')
+    hi = np.searchsorted(xdata,xest + 1.0,side='left')
+    ngood = hi - lo
+    
+    # Need at least 3 data points for regression
+    good = np.flatnonzero(ngood >= 3)
+    if good.shape[0] == 0:
+        return sm_data,flag
+    lo = lo[good]
+    ngood = ngood[good]
+    
+    # Flatten all the (estimate point,neighbour) pairs
+    start = np.concatenate(([0],np.cumsum(ngood)[:-1]))
+    point = np.repeat(np.arange(good.shape[0]),ngood)
+    idx = np.arange(point.shape[0]) - start[point] + lo[point]
+    datareg = ydata[idx]
+    dxsel = xdata[idx] - xest[good][point]
+    
+    # Use tricubic weighting function for the filter weights. The least 
+    # squares solution of wY = B*(wX) uses w**2 in the normal equations.
+    w2 = (1.0 - np.abs(dxsel)**3)**6
+    
+    # Weighted sums for the normal equations of the quadratic fit
+    npts = good.shape[0]
+    s0 = np.bincount(point,w2,npts)
+    wdx = w2*dxsel
+    s1 = np.bincount(point,wdx,npts)
+    wdx *= dxsel
+    s2 = np.bincount(point,wdx,npts)
+    wdx *= dxsel
+    s3 = np.bincount(point,wdx,npts)
+    wdx *= dxsel
+    s4 = np.bincount(point,wdx,npts)
+    wy = w2*datareg
+    t0 = np.bincount(point,wy,npts)
+    wy *= dxsel
+    t1 = np.bincount(point,wy,npts)
+    wy *= dxsel
+    t2 = np.bincount(point,wy,npts)
+    
+    # Smoothed value is just the first regression coefficient, since the
+    # grid point was chosen such that it is at x=0 (Cramer's rule).
+    m0 = s2*s4 - s3*s3
+    m1 = s1*s4 - s3*s2
+    m2 = s1*s3 - s2*s2
+    det = s0*m0 - s1*m1 + s2*m2
+    with np.errstate(divide='ignore',invalid='ignore'):
+        est = (t0*m0 - s1*(t1*s4 - s3*t2) + s2*(t1*s3 - s2*t2))/det
+    
+    # Least-squares solution where the normal equations are singular
+    singular = np.flatnonzero(np.logical_not(np.abs(det) > 
+                                             1e-12*s0*np.abs(s2)*np.abs(s4)))
+    for ii in singular:
+        sel = slice(start[ii],start[ii] + ngood[ii])
+        w = w2[sel]**0.5
+        xin = np.column_stack((w,w*dxsel[sel],w*dxsel[sel]**2))
+        est[ii] = np.linalg.lstsq(xin,w*datareg[sel],rcond=None)[0][0]
+    
+    # Check that the regression point is within the range of the data points 
+    # used in fitting the quadratic surface. It should be out of range 
+    # only rarely, and if it is, the smoothed estimate at that point is
+    # given and the FLAG is set to 1. 
+    datamin = np.minimum.reduceat(datareg,start)
+    datamax = np.maximum.reduceat(datareg,start)
+    sm_data[good] = est
+    flag[good] = np.logical_or(est < datamin,est > datamax)
+    
+    return sm_data,flag
+
+
 
 # ==============================================================================
 # Slow Fourier Transform
 # ==============================================================================
-def slow_dft(yt,freq=None,dt=1):
+def slow_dft(yt,freq=None,dt=1,ot=None,axis=0,max_elements=2**22):
     '''
     Slow Discrete Fourier transform code
     
     PARAMETERS:
     -----------
-    yt          : Input time series (vector)
+    yt          : Input time series, can be N-dimensional (e.g. (time,gauges))
     freq        : Frequencies to compute the fourier transform (optional)
     dt          : Must be specified if dt is specified (yt sampling interval)
+    ot          : Time vector for unevenly sampled series (optional, 
+                  overrides dt)
+    axis        : Time axis. Defaults to 0.
+    max_elements: Maximum number of elements of the complex exponential 
+                  matrix held in memory at once (optional)
     
     RETURNS:
     --------
-    yf          : Fourier coefficients (vector)
+    yf          : Fourier coefficients with the time axis replaced by 
+                  frequency
 
     NOTES:
     ------
-    I have not extensively tested this function but I believe it works fine.
-    It is really slow.
+    yf(f) = sum(yt*exp(-2j*pi*f*t))/N
+    The transform is evaluated as a matrix product of blocks of frequencies 
+    and all the series at once. Without freq the N Fourier frequencies 
+    k/(N*dt) (k=0,...,N-1) are used and the result is equivalent to 
+    np.fft.fft(yt)/N, which is much faster on uniform grids. When ot is 
+    given dt is the mean sampling interval (max(ot) - min(ot))/(N - 1).
+    NaNs are treated as gaps: they are excluded from the sum and N is the 
+    number of valid samples of each series.
     
     '''
     
-    # Compute length of the time series
+    yt = np.moveaxis(np.asarray(yt),axis,0)
     N = yt.shape[0]
+    shape = yt.shape[1:]
+    yt = yt.reshape((N,-1))
     
-    # Preallocate Fourier matrix (complex variable)
-    if freq is None:
-        yf = 1j * np.zeros_like(yt)
-        N_fourier = N
+    # Time vector and mean sampling interval
+    if ot is None:
+        ot = np.arange(N)*dt
     else:
-        yf = 1j * np.zeros_like(freq)
-        N_fourier = yf.shape[0]
+        ot = np.asarray(ot,dtype=np.float64) - ot[0]
+        if N > 1:
+            dt = (np.max(ot) - np.min(ot))/(N - 1)
     
-    # Loop over fourier frequencies
-    for aa in range(N_fourier):
-        
-        # Temporary sum variable (this will be a complex variable)
-        tmpsum = np.complex(0)
-        
-        # Loop over input time series
-        for bb in range(N):  
-            
-            if freq is None:
-                tmpsum += yt[bb] * np.exp(-2j * np.pi * aa * bb / N)
-            else:
-                tmpsum += yt[bb] * np.exp(-2j * np.pi * bb * freq[aa] * dt)
-            
-        # Allocate output for the given frequency
-        yf[aa] = tmpsum / N
+    # Fourier frequencies
+    if freq is None:
+        freq = np.arange(N)/(N*dt)
+    freq = np.atleast_1d(np.asarray(freq,dtype=np.float64))
+    
+    # Gaps
+    valid = np.isfinite(yt)
+    if not valid.all():
+        yt = np.where(valid,yt,0.0)
+    nvalid = np.sum(valid,axis=0)
+    
+    # Loop over blocks of fourier frequencies
+    yf = np.empty((freq.shape[0],yt.shape[1]),dtype=np.complex128)
+    fblock = max(int(max_elements//N),1)
+    for aa in range(0,freq.shape[0],fblock):
+        fourier = np.exp(-2j*np.pi*np.outer(freq[aa:aa + fblock],ot))
+        yf[aa:aa + fblock] = np.dot(fourier,yt)
+    
+    with np.errstate(invalid='ignore',divide='ignore'):
+        yf /= nvalid
         
     # Exit function
-    return yf
+    return np.moveaxis(yf.reshape(freq.shape + shape),0,axis)
         
 
 
@@ -848,3 +1422,140 @@ def basic_stats(x,y):
             'bias':bias,'si':si,'r2':r2}    
 
 
+#===============================================================================
+# Online statistics from two time series
+#===============================================================================
+class SkillAccumulator(object):
+    """
+    Mergeable accumulator of the statistics in basic_stats for comparisons 
+    that do not fit in memory.
+    
+    USAGE:
+    ------
+    skill = SkillAccumulator()
+    skill.update(x,y)          # Any number of aligned chunks
+    skill.merge(other)         # e.g. accumulators from other processes
+    stats = skill.result()
+    
+    NOTES:
+    ------
+    x is thought to be the real (measured) data and y the model, as in 
+    basic_stats. Pairs where x or y are not finite are skipped.
+    
+    Chunks can be N-dimensional (e.g. (time,buoys)), the statistics are 
+    computed along the first axis and kept for each of the other elements.
+    
+    Means and co-moments are updated with the pairwise formulas of Chan et 
+    al. (1979) (Welford's algorithm for single samples), so the results are 
+    the same as the batch computation to round off and do not depend on how
+    the data are chunked or merged. Accumulators can be pickled.
+    
+    REFERENCES:
+    -----------
+    Chan, T.F., G.H. Golub, and R.J. LeVeque, 1979: Updating formulae and a 
+        pairwise algorithm for computing sample variances. Technical Report 
+        STAN-CS-79-773, Stanford University.
+    Welford, B.P., 1962: Note on a method for calculating corrected sums of 
+        squares and products. Technometrics, 4, 419-420.
+    """
+    
+    def __init__(self):
+        
+        self.N = 0
+        self.mean_x = 0.0
+        self.mean_y = 0.0
+        self.mean_r2 = 0.0
+        self.sxx = 0.0
+        self.syy = 0.0
+        self.sxy = 0.0
+    
+    
+    def update(self,x,y):
+        """
+        Add a chunk of aligned pairs (time along the first axis)
+        """
+        
+        x = np.asarray(x,dtype=np.float64)
+        y = np.asarray(y,dtype=np.float64)
+        valid = np.logical_and(np.isfinite(x),np.isfinite(y))
+        x = np.where(valid,x,0.0)
+        y = np.where(valid,y,0.0)
+        
+        # Statistics of the chunk
+        nb = np.sum(valid,axis=0)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            mean_x = np.sum(x,axis=0)/nb
+            mean_y = np.sum(y,axis=0)/nb
+            dx = np.where(valid,x - mean_x,0.0)
+            dy = np.where(valid,y - mean_y,0.0)
+            r2 = np.where(valid,((x - y)/x)**2,0.0)
+            mean_r2 = np.sum(r2,axis=0)/nb
+        
+        self._combine(nb,mean_x,mean_y,mean_r2,np.sum(dx*dx,axis=0),
+                      np.sum(dy*dy,axis=0),np.sum(dx*dy,axis=0))
+    
+    
+    def merge(self,other):
+        """
+        Add the statistics of another SkillAccumulator
+        """
+        self._combine(other.N,other.mean_x,other.mean_y,other.mean_r2,
+                      other.sxx,other.syy,other.sxy)
+        return self
+    
+    
+    def _combine(self,nb,mean_x,mean_y,mean_r2,sxx,syy,sxy):
+        """
+        Chan et al. (1979) update. Not for standalone use.
+        """
+        
+        na = self.N
+        n = na + nb
+        with np.errstate(invalid='ignore',divide='ignore'):
+            fb = np.where(n > 0,nb/np.maximum(n,1),0.0)
+            fab = np.where(n > 0,na*nb/np.maximum(n,1),0.0)
+        empty = nb == 0
+        delta_x = np.where(empty,0.0,mean_x - self.mean_x)
+        delta_y = np.where(empty,0.0,mean_y - self.mean_y)
+        delta_r2 = np.where(empty,0.0,mean_r2 - self.mean_r2)
+        
+        self.sxx = self.sxx + np.where(empty,0.0,sxx) + delta_x**2*fab
+        self.syy = self.syy + np.where(empty,0.0,syy) + delta_y**2*fab
+        self.sxy = self.sxy + np.where(empty,0.0,sxy) + delta_x*delta_y*fab
+        self.mean_x = self.mean_x + delta_x*fb
+        self.mean_y = self.mean_y + delta_y*fb
+        self.mean_r2 = self.mean_r2 + delta_r2*fb
+        self.N = n
+    
+    
+    def result(self):
+        """
+        Return a dictionary with the following parameters
+        N      : Number of valid pairs
+        rmse   : Root-mean squared error [input units]
+        nrmse  : Normalized root-mean squared error [percentage]
+        bias   : Bias [input units]
+        si     : Scatter index
+        r      : Linear correlation coefficient
+        All the statistics are NaN when there are no valid pairs (N=0).
+        """
+        
+        with np.errstate(invalid='ignore',divide='ignore'):
+            
+            # Statistics are NaN where there are no valid pairs
+            N = np.float64(self.N)
+            nodata = np.where(N > 0,1.0,np.nan)
+            bias = (self.mean_y - self.mean_x)*nodata
+            
+            # Mean squared error from the co-moments of x and y
+            mse = (self.sxx + self.syy - 2.0*self.sxy)/N + bias**2
+            rmse = np.maximum(mse,0.0)**0.5
+            
+            nrmse = 100.0*self.mean_r2**0.5*nodata
+            si = rmse/self.mean_x
+            r = self.sxy/np.sqrt(self.sxx*self.syy)
+        
+        return {'N':self.N,'rmse':rmse,'nrmse':nrmse,
+                'bias':bias,'si':si,'r':r}
+
+
@@ -25,6 +25,10 @@ Internal dependencies:
 from __future__ import division,print_function
 
 # Import generic modules
+import os
+import tempfile
+import hashlib
+import collections
 import numpy as np                                                             
 import scipy 
 import scipy.optimize
@@ -34,38 +38,504 @@ import scipy.signal
 import pynmd.data.signal as gsignal
 
 
+#===============================================================================
+# Output helper
+#===============================================================================
+def _unwrap(a):
+    '''
+    Return a numpy scalar when a is a zero-dimensional array, so that scalar
+    inputs keep producing scalar outputs.
+    '''
+    a = np.asarray(a)
+    if a.ndim == 0:
+        return a[()]
+    return a
+
+
+#===============================================================================
+# Integration weights and cached frequency grids
+#===============================================================================
+def _trapz_weights(x):
+    '''
+    Weights w such that np.dot(y,w) is the trapezoidal integral of y(x).
+    '''
+    x = np.asarray(x,dtype=np.float64)
+    w = np.zeros_like(x)
+    dx = np.diff(x)
+    w[:-1] += 0.5*dx
+    w[1:] += 0.5*dx
+    return w
+
+
+# Frequency grids and integration weights shared by the spectral generators
+_frequency_grids = {}
+
+def _frequency_grid(freq_min,freq_max,freq_int):
+    '''
+    Cached (read-only) frequency vector and trapezoidal weights
+    '''
+    key = (freq_min,freq_max,freq_int)
+    if key not in _frequency_grids:
+        freq = np.arange(freq_min,freq_max+freq_int,freq_int)
+        weights = _trapz_weights(freq)
+        freq.setflags(write=False)
+        weights.setflags(write=False)
+        _frequency_grids[key] = (freq,weights)
+    return _frequency_grids[key]
+
+
+#===============================================================================
+# Broadcasting and chunking helpers
+#===============================================================================
+def _broadcast_shape(*args):
+    '''
+    Shape resulting from broadcasting the arguments without reading or 
+    allocating them (arguments only need a shape attribute).
+    '''
+    dummies = [np.lib.stride_tricks.as_strided(np.zeros(1),shape=np.shape(a),
+                                               strides=(0,)*np.ndim(a))
+               for a in args]
+    return np.broadcast(*dummies).shape
+
+
+def _chunked(func,args,chunk_size=None,out=None):
+    '''
+    Evaluate func(*args) on blocks of chunk_size elements along the leading 
+    axis of the broadcast shape of args. Arguments that span the leading axis
+    are sliced lazily, so numpy memory maps and netCDF4 variables are only 
+    read one block at a time. The result is written to out (which can be a
+    memory map or netCDF4 variable as well) if given.
+    '''
+    
+    shape = _broadcast_shape(*args)
+    
+    if chunk_size is None or len(shape) == 0:
+        res = func(*[np.asarray(a[...] if hasattr(a,'shape') else a) 
+                     for a in args])
+        if out is None:
+            return res
+        out[...] = res
+        return out
+    
+    # Arguments that do not span the leading axis are read only once
+    spans = [np.ndim(a) == len(shape) and np.shape(a)[0] > 1 for a in args]
+    fixed = [None if ss else np.asarray(a[...] if hasattr(a,'shape') else a)
+             for a,ss in zip(args,spans)]
+    
+    if out is None:
+        out = np.empty(shape)
+    
+    for i0 in range(0,shape[0],chunk_size):
+        sl = slice(i0,min(i0 + chunk_size,shape[0]))
+        block = [np.asarray(a[sl]) if ss else ff
+                 for a,ss,ff in zip(args,spans,fixed)]
+        res = func(*block)
+        out[sl] = np.broadcast_to(res,(sl.stop - sl.start,) + shape[1:])
+    
+    return out
+
+
+#===============================================================================
+# Safeguarded vectorized Newton-Raphson iteration
+#===============================================================================
+def _newton(fun,k,args,tol=1e-12,maxiter=100):
+    '''
+    Solve fun(k,*args) = 0 for every element of k with Newton-Raphson 
+    iterations. fun must return the function and its derivative. Only the
+    points that have not converged are evaluated at each iteration.
+    
+    The function is assumed to increase towards the root. Points where the
+    derivative becomes non-positive (e.g. blocked waves) or that do not 
+    converge after maxiter iterations are returned as NaN. Steps that would
+    give a non-positive wave number are replaced by halving k.
+    '''
+    
+    k = np.array(k,dtype=np.float64)
+    shape = k.shape
+    k = np.atleast_1d(k)
+    args = [np.broadcast_to(a,k.shape) for a in args]
+    active = np.isfinite(k)
+    converged = ~active
+    
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        for _ in range(maxiter):
+            if not np.any(active):
+                break
+            ka = k[active]
+            f,df = fun(ka,*[a[active] for a in args])
+            
+            # The root cannot be reached if the function stops increasing
+            blocked = ~(df > 0)
+            knew = ka - f/df
+            knew = np.where(knew > 0,knew,0.5*ka)
+            done = np.abs(knew - ka) <= tol*ka
+            
+            knew[blocked] = np.nan
+            k[active] = knew
+            
+            ind = np.flatnonzero(active)
+            converged.flat[ind[done & ~blocked]] = True
+            active.flat[ind[done | blocked]] = False
+    
+    # Points that did not converge
+    k[~converged] = np.nan
+    
+    return k.reshape(shape)
+
+
+#===============================================================================
+# Solve the nondimensional linear dispersion relation
+#===============================================================================
+def _kh_linear(x,tol=1e-14,maxiter=10):
+    '''
+    Solve kh * tanh(kh) = x for kh (element-wise).
+    
+    PARAMETERS:
+    -----------
+    x        : Nondimensional frequency sigma**2 * h / g (array)
+    tol      : Relative tolerance on the Halley iterations
+    maxiter  : Maximum number of Halley iterations
+    
+    RETURNS:
+    --------
+    kh       : Nondimensional wave number. NaN where x <= 0 or x is NaN.
+    
+    NOTES:
+    ------
+    The explicit approximation of Guo (2002) is used as first guess (maximum
+    relative error ~0.75%). Halley's method converges cubically from there,
+    so two or three iterations reach machine precision. For x >= 20 the deep
+    water limit kh = x is exact to double precision.
+    
+    REFERENCES:
+    -----------
+    Guo, J., 2002: Simple and explicit solution of wave dispersion equation.
+        Coastal Engineering, 45, 71-74.
+    '''
+    
+    x = np.asarray(x,dtype=np.float64)
+    valid = x > 0
+    deep = x >= 20.0
+    
+    # Explicit first guess (expm1 avoids 0**-0.4 at small x, where the 
+    # guess reduces to the shallow water limit kh = sqrt(x))
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        kh = x * (-1.0*np.expm1(-1.0*x**1.25))**-0.4
+        kh = np.where(x < 1e-8,np.sqrt(x),kh)
+    kh = np.where(valid & ~deep,kh,np.nan)
+    
+    # Halley iterations on F(kh) = kh*tanh(kh) - x
+    active = valid & ~deep
+    for _ in range(maxiter):
+        if not np.any(active):
+            break
+        t = np.tanh(kh)
+        s2 = 1.0 - t**2
+        F = kh*t - x
+        dF = t + kh*s2
+        d2F = 2.0*s2*(1.0 - kh*t)
+        step = 2.0*F*dF/(2.0*dF**2 - F*d2F)
+        kh = kh - step
+        with np.errstate(invalid='ignore'):
+            if np.all(np.abs(step[active]) <= tol*kh[active]):
+                break
+    
+    # Deep water limit
+    kh = np.where(deep,x,kh)
+    
+    return kh
+
+
+#===============================================================================
+# Dispersion relation lookup table
+#===============================================================================
+class DispersionTable(object):
+    '''
+    Precomputed lookup table of the nondimensional linear dispersion relation
+    kh(x), x = sigma**2 * h / g.
+    
+    USAGE:
+    ------
+    table = DispersionTable(rtol)
+    kh = table.kh(x)
+    k = table.wavenumber(period,h)
+    
+    PARAMETERS:
+    -----------
+    rtol     : (Optional) Maximum relative error allowed on kh. Defaults to
+               1e-10.
+    x_min    : (Optional) Lower limit of the table. Below it the shallow water
+               expansion kh = x**0.5 * (1 + x/6) is used.
+    x_max    : (Optional) Upper limit of the table. Above it the deep water
+               limit kh = x is used.
+    
+    NOTES:
+    ------
+    log(kh) is tabulated on a uniform grid of log(x) together with its exact
+    derivative and evaluated with piecewise cubic Hermite interpolation. The
+    tabulated function is strictly increasing and the interpolant is checked
+    to satisfy the Fritsch-Carlson monotonicity conditions on every interval.
+    The grid is refined until the error measured against the exact solution
+    at three points inside every interval is below rtol, the achieved error 
+    is stored in max_error.
+    
+    Building the table takes a fraction of a second but most users should
+    use get_dispersion_table, which keeps the table cached on disk and in 
+    memory.
+    
+    '''
+    
+    _version = 1
+    
+    def __init__(self,rtol=1e-10,x_min=1e-6,x_max=20.0,_data=None):
+        
+        self.rtol = rtol
+        self.x_min = x_min
+        self.x_max = x_max
+        
+        if _data is not None:
+            self.q = _data['q']
+            self.m = _data['m']
+            self.max_error = float(_data['max_error'])
+        else:
+            self._build()
+        
+        self._s0 = np.log(x_min)
+        self._ds = (np.log(x_max) - self._s0)/(self.q.shape[0] - 1)
+        
+    
+    def _tabulate(self,npts):
+        '''
+        Tabulate log(kh) and its derivative on a uniform log(x) grid
+        '''
+        s = np.linspace(np.log(self.x_min),np.log(self.x_max),npts)
+        x = np.exp(s)
+        kh = _kh_linear(x)
+        t = np.tanh(kh)
+        
+        # d(log(kh))/d(log(x)) = x/kh * d(kh)/dx
+        q = np.log(kh)
+        m = x/kh/(t + kh*(1.0 - t**2))
+        return q,m
+    
+    
+    def _build(self):
+        '''
+        Refine the table until the requested tolerance is met
+        '''
+        npts = 256
+        while True:
+            self.q,self.m = self._tabulate(npts)
+            self._s0 = np.log(self.x_min)
+            self._ds = (np.log(self.x_max) - self._s0)/(npts - 1)
+            
+            # Monotonicity (Fritsch and Carlson, 1980)
+            delta = np.diff(self.q)/self._ds
+            if (np.any(delta <= 0) or
+                np.any((self.m[:-1]/delta)**2 + (self.m[1:]/delta)**2 > 9.0)):
+                raise ValueError('Dispersion table is not monotone')
+            
+            # Error check inside every interval
+            s = (self._s0 + self._ds*(np.arange(npts - 1)[:,np.newaxis] +
+                                      np.array([0.25,0.5,0.75])))
+            x = np.exp(s.ravel())
+            self.max_error = np.max(np.abs(self.kh(x)/_kh_linear(x) - 1.0))
+            if self.max_error <= self.rtol or npts >= 2**20:
+                break
+            npts *= 2
+    
+    
+    def kh(self,x):
+        '''
+        Nondimensional wave number kh for x = sigma**2 * h / g. NaN is 
+        returned where x <= 0.
+        '''
+        
+        x = np.asarray(x,dtype=np.float64)
+        kh = np.full(x.shape,np.nan)
+        
+        # Shallow and deep water limits
+        ind = (x > 0) & (x < self.x_min)
+        kh[ind] = x[ind]**0.5*(1.0 + x[ind]/6.0)
+        ind = x >= self.x_max
+        kh[ind] = x[ind]
+        
+        # Cubic Hermite interpolation
+        ind = (x >= self.x_min) & (x < self.x_max)
+        pos = (np.log(x[ind]) - self._s0)/self._ds
+        ii = np.minimum(pos.astype(np.intp),self.q.shape[0] - 2)
+        t = pos - ii
+        t2 = t*t
+        t3 = t2*t
+        kh[ind] = np.exp((2.0*t3 - 3.0*t2 + 1.0)*self.q[ii] + 
+                         (t3 - 2.0*t2 + t)*self._ds*self.m[ii] +
+                         (3.0*t2 - 2.0*t3)*self.q[ii+1] +
+                         (t3 - t2)*self._ds*self.m[ii+1])
+        
+        return kh
+    
+    
+    def wavenumber(self,period,h):
+        '''
+        Linear wave number [m**-1] for the given period [s] and depth [m].
+        '''
+        return dispersion(period,h,table=self)
+    
+    
+    def save(self,filename):
+        '''
+        Save the table to a numpy .npz file. The file is written to a 
+        temporary location first and then atomically replaces the old file,
+        so concurrent readers never see a partial table.
+        '''
+        
+        fld = os.path.dirname(os.path.abspath(filename))
+        fid,tmpfile = tempfile.mkstemp(suffix='.npz',dir=fld)
+        try:
+            with os.fdopen(fid,'wb') as f:
+                np.savez(f,q=self.q,m=self.m,max_error=self.max_error,
+                         rtol=self.rtol,x_min=self.x_min,x_max=self.x_max,
+                         version=self._version)
+            os.replace(tmpfile,filename)
+        except:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
+    
+    
+    @classmethod
+    def load(cls,filename):
+        '''
+        Load a table saved with DispersionTable.save
+        '''
+        
+        with np.load(filename) as data:
+            if int(data['version']) != cls._version:
+                raise ValueError('Dispersion table version mismatch: ' + 
+                                 filename)
+            return cls(rtol=float(data['rtol']),x_min=float(data['x_min']),
+                       x_max=float(data['x_max']),
+                       _data={'q':data['q'],'m':data['m'],
+                              'max_error':data['max_error']})
+
+
+# Dispersion tables loaded in this session
+_dispersion_tables = {}
+
+def get_dispersion_table(rtol=1e-10,cache_dir=None):
+    '''
+    Return the dispersion lookup table for the given tolerance.
+    
+    USAGE:
+    ------
+    table = get_dispersion_table(rtol,cache_dir)
+    
+    PARAMETERS:
+    -----------
+    rtol      : (Optional) Maximum relative error on kh. Defaults to 1e-10.
+    cache_dir : (Optional) Folder where the table is cached. Defaults to the
+                PYNMD_CACHE_DIR environment variable or ~/.pynmd
+    
+    RETURNS:
+    --------
+    table     : DispersionTable
+    
+    NOTES:
+    ------
+    The table is kept in memory after the first call. If it is not in memory
+    it is loaded from the cache folder and it is only built (and saved) if 
+    no valid cached file exists. Failure to write the cache is not an error.
+    
+    '''
+    
+    if rtol in _dispersion_tables:
+        return _dispersion_tables[rtol]
+    
+    if cache_dir is None:
+        cache_dir = os.environ.get('PYNMD_CACHE_DIR',
+                                   os.path.join(os.path.expanduser('~'),
+                                                '.pynmd'))
+    cache_file = os.path.join(cache_dir,'dispersion_table_%g.npz' % rtol)
+    
+    table = None
+    if os.path.isfile(cache_file):
+        try:
+            table = DispersionTable.load(cache_file)
+        except (IOError,OSError,ValueError,KeyError):
+            table = None
+    
+    if table is None:
+        table = DispersionTable(rtol)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            table.save(cache_file)
+        except (IOError,OSError):
+            pass
+    
+    _dispersion_tables[rtol] = table
+    return table
+
+
+def _solve_kh(x,table=None):
+    '''
+    Solve the nondimensional dispersion relation with the exact solver or 
+    with a lookup table (True for the default table or a DispersionTable).
+    '''
+    if table is None or table is False:
+        return _kh_linear(x)
+    if table is True:
+        table = get_dispersion_table()
+    return table.kh(x)
+
+
 #===============================================================================
 # Compute radian frequency from wave number
 #===============================================================================
-def idispersion(k,h):
+def idispersion(k,h,u=None):
     '''
     Inverse linear dispersion relation
     
     USAGE:
     ------
-    sigma = idispersion(k,h)
+    sigma = idispersion(k,h,u)
     
     INPUT:
     ------
     k      : Wave number [m**-1]
     h      : water depth [m]
+    u      : (Optional) Ambient current velocity [m/s]
     
     OUTPUT:
     -------
     sigma  : radian frequency [Hz]
+    
+    NOTES:
+    ------
+    Inputs can be scalars or broadcastable numpy arrays. Points with h <= 0
+    are returned as NaN.
     '''
+    
+    k = np.asarray(k,dtype=np.float64)
+    h = np.asarray(h,dtype=np.float64)
 
     # Get radian wave frequency
-    sigma = (9.81*k*np.tanh(k*h))**0.5    
+    with np.errstate(invalid='ignore'):
+        sigma = (9.81*k*np.tanh(k*h))**0.5
+        sigma = np.where(h > 0,sigma,np.nan)
+    
+    # Doppler shift
+    if u is not None:
+        sigma = sigma + np.asarray(u,dtype=np.float64)*k
                             
-    # Return stokes velocities
-    return sigma
+    # Return radian frequency
+    return _unwrap(sigma)
 
 
 #===============================================================================
 # Compute wave number
 #===============================================================================
-def dispersion(period,h,u=None):
+def dispersion(period,h,u=None,tol=1e-12,maxiter=100,table=None):
     '''
     
     Computes the linear dispersion relation.
@@ -79,43 +549,76 @@ def dispersion(period,h,u=None):
     Period   : Wave period [s]
     h        : Water depth [m]
     u        : (Optional) Ambient current velocity [m/s]
+    tol      : (Optional) Relative tolerance of the Newton iterations with
+               current
+    maxiter  : (Optional) Maximum number of Newton iterations with current
+    table    : (Optional) Use a precomputed lookup table for the still water
+               solution. True uses get_dispersion_table(), a DispersionTable
+               instance can also be given.
     
     RETURNS:
     --------
     k        : Wave number (2*pi/wave_length) [m**-1]
     
-    '''
+    NOTES:
+    ------
+    Period, h and u can be scalars or numpy arrays that broadcast against 
+    each other, all points are solved at once. Without current the 
+    nondimensional relation kh*tanh(kh) = sigma**2*h/g is solved from an 
+    explicit first guess with Halley iterations (see _kh_linear). With 
+    current the still water solution is used as first guess for a 
+    vectorized Newton-Raphson iteration on
+        (g*k*tanh(k*h))**0.5 + u*k - sigma = 0
+    NaN is returned where h <= 0, where the period is not positive, where 
+    the waves are blocked by an opposing current or where the iteration 
+    does not converge.
     
-    if u is None:
-        u = 0
-
-    # Initialize wave number
-#     k = np.zeros(len(period))
-    sigma = (2.0*np.pi)/period
-#     kinit = (((sigma**2)*h/9.81)*
-#              ((1/np.tanh(((sigma**2)/9.81*h)**0.75))**(2.0/3.0)))
-    kinit = 0.0001
+    '''
     
-    def f(k,sigma,h,u):
-        y = (9.81*k*np.tanh(k*h))**0.5 - sigma + u*k
-        return y
+    period = np.asarray(period,dtype=np.float64)
+    h = np.asarray(h,dtype=np.float64)
     
-    if h <= 0:
-        k = np.NAN
-    else:
-        try:
-            k = scipy.optimize.newton(f,kinit,fprime=None,
-                                      args=(sigma,h,u),maxiter=100)
-        except RuntimeError:
-            k = np.NAN
+    # Radian frequency
+    with np.errstate(divide='ignore',invalid='ignore'):
+        sigma = np.where(period > 0,(2.0*np.pi)/period,np.nan)
+        sigma, h = np.broadcast_arrays(sigma,h)
+        
+        # Still water solution
+        kh = _solve_kh(sigma**2*h/9.81,table)
+        k = np.where(h > 0,sigma**2/9.81/np.tanh(kh),np.nan)
     
-    return k
+    if u is None:
+        return _unwrap(k)
+    
+    # Doppler shifted solution
+    u = np.asarray(u,dtype=np.float64)
+    sigma, h, u, k = np.broadcast_arrays(sigma,h,u,k)
+    moving = u != 0
+    if np.any(moving):
+        k = k.copy()
+        k[moving] = _newton(_f_current,k[moving],
+                            (sigma[moving],h[moving],u[moving]),tol,maxiter)
+    
+    return _unwrap(k)
+
+
+def _f_current(k,sigma,h,u):
+    '''
+    Doppler shifted linear dispersion function and its derivative
+    '''
+    kh = np.minimum(k*h,50.0)
+    t = np.tanh(kh)
+    root = (9.81*k*t)**0.5
+    f = root + u*k - sigma
+    df = 9.81*(t + kh*(1.0 - t**2))/(2.0*root) + u
+    return f,df
 
 
 #===============================================================================
 # Compute wave number using the Kirby and Dalrymple (1986) composite equation
 #===============================================================================
-def dispersion_kd86(period,h,wh,u=None):
+def dispersion_kd86(period,h,wh,u=None,tol=1e-12,maxiter=100,chunk_size=None,
+                    out=None):
     '''
     
     Return the wave number from the composite dispersion relation by 
@@ -127,14 +630,19 @@ def dispersion_kd86(period,h,wh,u=None):
     
     Input:
     ------
-    Period   : Wave period [s]
-    h        : Water depth [m]
-    wh       : Wave height [m]
-    u        : (Optional) Ambient current velocity [m/s]
+    Period     : Wave period [s]
+    h          : Water depth [m]
+    wh         : Wave height [m]
+    u          : (Optional) Ambient current velocity [m/s]
+    tol        : (Optional) Relative tolerance of the Newton iterations
+    maxiter    : (Optional) Maximum number of Newton iterations
+    chunk_size : (Optional) Number of elements of the leading axis processed
+                 at once (see notes)
+    out        : (Optional) Array where the results are written
     
     RETURNS:
     --------
-    k        : Wave number (2*pi/wave_length) [m**-1]
+    k          : Wave number (2*pi/wave_length) [m**-1]
     
     CELERITY EQUATION:
     ------------------
@@ -144,6 +652,19 @@ def dispersion_kd86(period,h,wh,u=None):
     eps     = k*wh/2
     D       = (8 + cosh(4*k*h) - 2 * tanh(k*h)^2)/(8*sinh(k*h)^4)    
     
+    NOTES:
+    ------
+    Inputs can be scalars or broadcastable arrays, e.g. a (time,y,x) stack 
+    of depth and wave height. The equation is solved for every point at 
+    once with Newton-Raphson iterations using its analytic derivative, 
+    starting from the linear (Airy) wave number. NaN is returned where 
+    h <= 0 or where there is no solution.
+    
+    If chunk_size is given the inputs are processed in blocks along the 
+    leading axis so that the memory used by the solver stays bounded. Inputs
+    and out can then be numpy memory maps or netCDF4 variables, which are 
+    read and written one block at a time.
+    
     REFERENCES:
     -----------
     Catalan, P., and M. C. Haller, 2008: Remote sensing of breaking wave phase
@@ -156,42 +677,66 @@ def dispersion_kd86(period,h,wh,u=None):
     
     # Depth averaged ambient velocity
     if u is None:
-        u = 0
-
-    # Compute radian frequency
-    sigma = (2.0*np.pi)/period
-    
-    # Initialize wave number
-    #kinit = 0.0001                # Manually initialize
-    kinit = dispersion(period,h,u) # Initialize with Airy dispersion relation
-    
-    # Kirby and Dalrymple (1986) dispersion function        
-    def f(k,sigma,h,wh,u):
-        eps = k*wh/2
-        f1  = np.tanh(k*h)**5
-        f2  = (k*h/np.sinh(k*h))**4
-        D   = ((8.0 + np.cosh(4.0*k*h) - 2.0*(np.tanh(k*h)**2))/
-               (8.0*(np.sinh(k*h)**4)))
-        y   = ((9.81*k*np.tanh(k*h+f2*eps)*(1.0+f1*(eps**2)*D))**0.5 + 
-               u*k - sigma)
-        return y
-    
-    if h <= 0:
-        k = np.NAN
-    else:
-        try:
-            k = scipy.optimize.newton(f,kinit,fprime=None,
-                                      args=(sigma,h,wh,u),maxiter=100)
-        except RuntimeError:
-            k = np.NAN
+        u = 0.0
+    
+    def solve(period,h,wh,u):
+        # Initialize with Airy dispersion relation
+        kinit = dispersion(period,h,u)
+        sigma = (2.0*np.pi)/period
+        return _newton(_f_kd86,kinit,(sigma,h,wh,u),tol,maxiter)
+    
+    k = _chunked(solve,(period,h,wh,u),chunk_size,out)
+    
+    return _unwrap(k) if out is None else out
+
+
+def _f_kd86(k,sigma,h,wh,u):
+    '''
+    Kirby and Dalrymple (1986) dispersion function and its derivative
+    '''
     
-    return k
+    g = 9.81
+    kh = k*h
+    
+    # Hyperbolic functions are saturated in deep water
+    deep = kh > 30.0
+    khc = np.minimum(kh,30.0)
+    th = np.tanh(kh)
+    sh = np.sinh(khc)
+    ch = np.cosh(khc)
+    
+    # Amplitude dispersion terms and derivatives with respect to k
+    eps = k*wh/2.0
+    deps = wh/2.0
+    f1 = th**5
+    df1 = 5.0*th**4*(1.0 - th**2)*h
+    f2 = (khc/sh)**4
+    df2 = np.where(deep,0.0,4.0*(khc/sh)**3*(sh - khc*ch)/sh**2*h)
+    D = (8.0 + np.cosh(4.0*khc) - 2.0*th**2)/(8.0*sh**4)
+    dD = np.where(deep,0.0,
+                  ((4.0*np.sinh(4.0*khc) - 4.0*th*(1.0 - th**2))/
+                   (8.0*sh**4) - 4.0*D*ch/sh)*h)
+    
+    T = np.tanh(kh + f2*eps)
+    dT = (1.0 - T**2)*(h + df2*eps + f2*deps)
+    P = 1.0 + f1*eps**2*D
+    dP = df1*eps**2*D + 2.0*f1*eps*deps*D + f1*eps**2*dD
+    
+    R = g*k*T*P
+    dR = g*(T*P + k*dT*P + k*T*dP)
+    root = R**0.5
+    
+    f = root + u*k - sigma
+    df = dR/(2.0*root) + u
+    
+    return f,df
 
 
 #===============================================================================
 # Compute wave number using the Booij 
 #===============================================================================
-def dispersion_booij(period,h,wh,u=None):
+def dispersion_booij(period,h,wh,u=None,tol=1e-12,maxiter=100,chunk_size=None,
+                     out=None):
     '''
     
     Return the wave number from the composite dispersion relation by 
@@ -203,18 +748,29 @@ def dispersion_booij(period,h,wh,u=None):
     
     Input:
     ------
-    Period   : Wave period [s]
-    h        : Water depth [m]
-    wh       : Wave height [m]
-    u        : (Optional) Ambient current velocity [m/s]
+    Period     : Wave period [s]
+    h          : Water depth [m]
+    wh         : Wave height [m]
+    u          : (Optional) Ambient current velocity [m/s]
+    tol        : (Optional) Relative tolerance of the Newton iterations
+    maxiter    : (Optional) Maximum number of Newton iterations
+    chunk_size : (Optional) Number of elements of the leading axis processed
+                 at once (see dispersion_kd86)
+    out        : (Optional) Array where the results are written
     
     RETURNS:
     --------
-    k        : Wave number (2*pi/wave_length) [m**-1]
+    k          : Wave number (2*pi/wave_length) [m**-1]
     
     CELERITY EQUATION:
     ------------------
     (c-u)^2 = g / k * tanh(k*(h+wh/2))
+    
+    NOTES:
+    ------
+    The Booij equation is the linear dispersion relation evaluated at the 
+    depth h + wh/2, so it is solved with the vectorized linear solver (see
+    dispersion). NaN is returned where h <= 0 or where there is no solution.
         
     REFERENCES:
     -----------
@@ -228,30 +784,15 @@ def dispersion_booij(period,h,wh,u=None):
     
     # Depth averaged ambient velocity
     if u is None:
-        u = 0
-
-    # Compute radian frequency
-    sigma = (2.0*np.pi)/period
-    
-    # Initialize wave number
-    #kinit = 0.0001                # Manually initialize
-    kinit = dispersion(period,h,u) # Initialize with Airy dispersion relation
+        u = 0.0
     
-    # Booij (1981) dispersion function        
-    def f(k,sigma,h,wh,u):
-        y = (9.81*k*np.tanh(k*(h+wh/2.0)))**0.5 + u*k - sigma
-        return y
+    def solve(period,h,wh,u):
+        k = dispersion(period,h + wh/2.0,u,tol,maxiter)
+        return np.where(h > 0,k,np.nan)
     
-    if h <= 0:
-        k = np.NAN
-    else:
-        try:
-            k = scipy.optimize.newton(f,kinit,fprime=None,
-                                      args=(sigma,h,wh,u),maxiter=100)
-        except RuntimeError:
-            k = np.NAN
+    k = _chunked(solve,(period,h,wh,u),chunk_size,out)
     
-    return k
+    return _unwrap(k) if out is None else out
 
 
 #===============================================================================
@@ -278,6 +819,16 @@ def dispersion_nwogu(period,h,alpha):
     alpha = -1/3    solves the traditional depth averaged equations.
     alpha = -0.39   gives similar results to linear wave theory (Nwogu 1993)   
     
+    Period, h and alpha can be scalars or broadcastable numpy arrays. The
+    dispersion relation
+        sigma**2 = g*k**2*h*(1 - (alpha + 1/3)*(kh)**2)/(1 - alpha*(kh)**2)
+    is a quadratic in K = (kh)**2 with X = sigma**2*h/g:
+        (alpha + 1/3)*K**2 - (1 + alpha*X)*K + X = 0
+    The root that tends to the shallow water limit (K = X) is evaluated 
+    exactly as K = 2*X / ((1 + alpha*X) + ((1 + alpha*X)**2 - 
+    4*(alpha + 1/3)*X)**0.5), which is also valid for alpha = -1/3. NaN is
+    returned where h <= 0 or where the relation has no real solution.
+    
     REFERENCES:
     -----------
     Nwogu, O., 1993: Alternative Form of Boussinesq Equations for Nearshore
@@ -286,32 +837,93 @@ def dispersion_nwogu(period,h,alpha):
       
     '''
     
-    # Compute randian frequency    
-    sigma = (2.0*np.pi)/period
+    period = np.asarray(period,dtype=np.float64)
+    h = np.asarray(h,dtype=np.float64)
+    alpha = np.asarray(alpha,dtype=np.float64)
     
-    # Initialize wave number    
-    #kinit = dispersion(period,h) # Linear wave theory 
-    kinit = sigma**2 / 9.81       # Deep water equivalent   
-    #kinit = 0.05                 # Hard code parameter
+    with np.errstate(divide='ignore',invalid='ignore'):
+        
+        # Compute randian frequency    
+        sigma = np.where(period > 0,(2.0*np.pi)/period,np.nan)
+        X = sigma**2 * h / 9.81
+        
+        # Smaller root of the quadratic in (kh)**2
+        bb = 1.0 + alpha*X
+        disc = bb**2 - 4.0*(alpha + 1.0/3.0)*X
+        K = 2.0*X/(bb + disc**0.5)
+        
+        k = np.where((h > 0) & (K > 0) & np.isfinite(K),K**0.5/h,np.nan)
+        
+    return _unwrap(k)
+
 
-    # Define the dispersion relation function    
-    def bd(k,sigma,h,alpha):
-        #y = 9.81 * (k**2) * h * (1.0 - 1.0/3.0 * (k*h)**2) - sigma**2
-        y = (9.81 * (k**2) * h * (1.0 - (alpha + 1.0/3.0) * ((k*h)**2)) /
-            (1.0 - alpha * ((k*h)**2)) - sigma**2)         
-        return y
+#===============================================================================
+# Dispersion errors of Nwogu's equations
+#===============================================================================
+def nwogu_dispersion_error(period,h,alpha):
+    '''
+    Phase and group velocity errors of Nwogu's (1993) Boussinesq equations
+    relative to linear wave theory.
     
-    # Use Newton-Rhapson method to find the wave number
-    if h <= 0:
-        k = np.NAN
-    else:
-        try:
-            k = scipy.optimize.newton(bd,kinit,fprime=None,
-                                      args=(sigma,h,alpha),maxiter=1000)
-        except RuntimeError:
-            k = np.NAN
+    USAGE:
+    ------
+    err = nwogu_dispersion_error(period,h,alpha)
+    
+    PARAMETERS:
+    -----------
+    period    : Wave period [s]
+    h         : Water depth [m]
+    alpha     : Non-dimensional wave steepness parameter 
+                (see dispersion_nwogu)
+    
+    RETURNS:
+    --------
+    Dictionary containing
+    k         : Boussinesq wave number [m**-1]
+    kh        : Linear nondimensional depth
+    C         : Boussinesq phase velocity [m/s]
+    Cg        : Boussinesq group velocity [m/s]
+    C_err     : Relative phase velocity error (C/C_linear - 1)
+    Cg_err    : Relative group velocity error (Cg/Cg_linear - 1)
+    
+    NOTES:
+    ------
+    All inputs broadcast against each other, so errors for whole grids and 
+    sets of periods and alpha values are computed at once, e.g.
+        err = nwogu_dispersion_error(periods[:,None,None],h[None,:,:])
+    The group velocity follows from differentiating the Boussinesq 
+    relation with K = (kh)**2:
+        Cg = g*h*k/sigma * (N/M - K/(3*M**2)) 
+        N  = 1 - (alpha + 1/3)*K,  M = 1 - alpha*K
+    
+    '''
+    
+    period = np.asarray(period,dtype=np.float64)
+    h = np.asarray(h,dtype=np.float64)
+    alpha = np.asarray(alpha,dtype=np.float64)
+    
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        sigma = np.where(period > 0,(2.0*np.pi)/period,np.nan)
         
-    return k
+        # Boussinesq wave number, phase and group velocities
+        k = np.asarray(dispersion_nwogu(period,h,alpha))
+        K = (k*h)**2
+        N = 1.0 - (alpha + 1.0/3.0)*K
+        M = 1.0 - alpha*K
+        C = sigma/k
+        Cg = 9.81*h*k/sigma*(N/M - K/(3.0*M**2))
+        
+        # Linear wave theory
+        k_lin = np.asarray(dispersion(period,h))
+        kh = k_lin*h
+        C_lin = sigma/k_lin
+        Cg_lin = 0.5*C_lin*(1.0 + 2.0*kh/np.sinh(2.0*kh))
+        
+        C_err = C/C_lin - 1.0
+        Cg_err = Cg/Cg_lin - 1.0
+    
+    return {'k':_unwrap(k),'kh':_unwrap(kh),'C':_unwrap(C),'Cg':_unwrap(Cg),
+            'C_err':_unwrap(C_err),'Cg_err':_unwrap(Cg_err)}
 
     
 #===============================================================================
@@ -327,30 +939,31 @@ def shallow_water_depth(period):
     
     PARAMETERS:
     -----------
-    period     : wave period [s]
+    period     : wave period [s] (scalar or numpy array)
     
     RETURNS:
     --------
     h_shallow  : Water depth where shallow water approximation is valid [m]
     
+    NOTES:
+    ------
+    The shallow water limit is kh = pi/10. The dispersion relation can be
+    inverted exactly for the depth at a known kh:
+        h = g / sigma**2 * kh * tanh(kh)
+    so no iteration or lookup table is needed.
+    
     '''
     
-    # Initialize shallow water depth
-    hinit = 2.0
+    period = np.asarray(period,dtype=np.float64)
     
-    # Define shallow water limit
-    def swd(h,period):
-        y = dispersion(period,h) * h - np.pi/10.0
-        return y
-
-    # Find zeros of the swd function
-    try:
-        h = scipy.optimize.newton(swd,hinit,fprime=None,
-                                  args=(period,),maxiter=100)
-    except RuntimeError:
-        h = np.NAN
+    # Shallow water limit
+    kh = np.pi/10.0
+    
+    with np.errstate(divide='ignore',invalid='ignore'):
+        sigma = np.where(period > 0,(2.0*np.pi)/period,np.nan)
+        h = 9.81/sigma**2 * kh * np.tanh(kh)
     
-    return h
+    return _unwrap(h)
 
 
 #===============================================================================
@@ -394,6 +1007,114 @@ def uvstokes(Hwave,Dwave,Lwave,WDepth,VertDisc):
     return ustokes, vstokes  
 
 
+#===============================================================================
+# Stokes drift profiles from directional spectra
+#===============================================================================
+def stokes_drift_spectral(spec,freq,dirs,h,z,sigma=False,k=None,
+                          time_block=None):
+    '''
+    Compute Stokes drift profiles from directional wave spectra on a grid.
+    
+    USAGE:
+    ------
+    ustokes,vstokes = stokes_drift_spectral(spec,freq,dirs,h,z,sigma,k,
+                                            time_block)
+    
+    PARAMETERS:
+    -----------
+    spec        : Directional spectra [m2/Hz/deg] with shape 
+                  (time,) + h.shape + (freq,dir), e.g. (time,y,x,freq,dir).
+                  Can be a netCDF4 variable (see time_block).
+    freq        : Spectral frequencies [Hz]
+    dirs        : Spectral directions in Nautical convention [degrees]
+    h           : Water depth [m], e.g. (y,x)
+    z           : Vertical levels [m] (negative downwards, 0 at the surface)
+                  with shape (s,) or (s,) + h.shape
+    sigma       : (Optional) If True, z are sigma coordinates between -1 
+                  (bottom) and 0 (surface) and the levels are z*h. 
+                  Defaults to False.
+    k           : (Optional) Precomputed wave numbers with shape 
+                  h.shape + (freq,) [m**-1]. Computed with dispersion if not
+                  given.
+    time_block  : (Optional) Number of time steps processed at once. Limits
+                  the memory used and allows reading spec lazily.
+    
+    RETURNS:
+    --------
+    ustokes     : Zonal Stokes drift [m/s] with shape (time,s) + h.shape
+    vstokes     : Meridional Stokes drift [m/s] with shape (time,s) + h.shape
+    
+    NOTES:
+    ------
+    The monochromatic finite depth Stokes drift is integrated over the 
+    spectrum (e.g. Kenyon 1969)
+        us(z) = int int 2*pi*f*k*E(f,theta) * cosh(2k(z+h))/sinh(kh)**2 * 
+                (cos(theta),sin(theta)) df dtheta
+    with theta the direction of propagation. The depth function is 
+    evaluated as 2*(exp(2kz) + exp(-2k(z+2h)))/(1 - exp(-2kh))**2 to avoid 
+    overflow in deep water.
+    
+    The spectra are first integrated over directions and the vertical 
+    kernel (s,...,freq), which does not depend on time, is computed once.
+    
+    REFERENCES:
+    -----------
+    Kenyon, K. E., 1969: Stokes drift for random gravity waves. Journal of
+        Geophysical Research, 74, 6991-6994.
+    
+    '''
+    
+    freq = np.asarray(freq,dtype=np.float64)
+    dirs = np.asarray(dirs,dtype=np.float64)
+    h = np.asarray(h,dtype=np.float64)
+    z = np.asarray(z,dtype=np.float64)
+    
+    # Vertical levels (s,) + h.shape + (1,)
+    if z.ndim == 1:
+        z = z.reshape(z.shape + (1,)*h.ndim)
+    if sigma:
+        z = z*h
+    z = z[...,np.newaxis]
+    
+    # Wave numbers
+    if k is None:
+        k = dispersion(1.0/freq,h[...,np.newaxis])
+    k = np.asarray(k,dtype=np.float64)
+    hh = h[...,np.newaxis]
+    
+    # Vertical kernel including the frequency integration weights
+    with np.errstate(invalid='ignore',over='ignore'):
+        kern = (_trapz_weights(freq) * 2.0*np.pi*freq * k * 2.0 *
+                (np.exp(2.0*k*z) + np.exp(-2.0*k*(z + 2.0*hh))) / 
+                (1.0 - np.exp(-2.0*k*hh))**2)
+    
+    # Direction of propagation and circular direction bin widths
+    theta = (270.0 - dirs)*np.pi/180.0
+    dth = np.diff(np.concatenate((dirs[-1:],dirs,dirs[:1])))
+    dth = np.abs((dth + 180.0) % 360.0 - 180.0)
+    dth = 0.5*(dth[:-1] + dth[1:])
+    dir_weights = np.array([dth*np.cos(theta),dth*np.sin(theta)]).T
+    
+    # Process time blocks
+    nt = np.shape(spec)[0]
+    if time_block is None:
+        time_block = nt
+    ustokes = np.empty((nt,) + kern.shape[:-1])
+    vstokes = np.empty_like(ustokes)
+    
+    for t0 in range(0,nt,time_block):
+        sl = slice(t0,min(t0 + time_block,nt))
+        
+        # Integrate over directions (time,...,freq,2)
+        exy = np.dot(np.asarray(spec[sl],dtype=np.float64),dir_weights)
+        
+        # Integrate over frequencies
+        ustokes[sl] = np.einsum('t...f,s...f->ts...',exy[...,0],kern)
+        vstokes[sl] = np.einsum('t...f,s...f->ts...',exy[...,1],kern)
+    
+    return ustokes,vstokes
+
+
 #===============================================================================
 # TMA Spectrum
 #===============================================================================
@@ -432,24 +1153,26 @@ def tma(freq_peak,gamma,h,Hmo,freq_min=0.01,freq_max=1.0,freq_int=0.001):
     -----
     The units of the spectrum still do not make sense to me, must be verified.
     No scaling applied, alpha = 1
+    See tma_batch to generate many spectra at once.
     
     '''
     
-    # For testing only
-    #freq_peak = 0.1
-    #gamma = 3.3
-    #freq_min = 0.01
-    #freq_max = 1.0
-    #freq_int = 0.001
-    #h = 10.0
-    #Hmo = 1.0
-        
-    # Compute frequency vector
-    freq = np.arange(freq_min,freq_max+freq_int,freq_int)
+    s_tma,freq = tma_batch(freq_peak,gamma,h,Hmo,freq_min,freq_max,freq_int)
+    s_tma = s_tma.reshape(np.broadcast(freq_peak,gamma,h).shape + freq.shape)
+    
+    # End of function
+    return s_tma
+
+
+def _tma_block(freq,freq_peak,gamma,h):
+    '''
+    TMA spectra for a block of cases (leading axes) and frequencies (last)
+    '''
+    
+    fp = freq_peak[...,np.newaxis]
     
     # Constants for peak enhancement factor
-    delta = np.ones_like(freq)*0.07
-    delta[freq>freq_peak] = 0.09
+    delta = np.where(freq > fp,0.09,0.07)
     
     # Compute alpha parameter (equation 26,27) TMA report
     #wlen = 2.0*np.pi/dispersion(freq_peak**-1,h)
@@ -457,27 +1180,85 @@ def tma(freq_peak,gamma,h,Hmo,freq_min=0.01,freq_max=1.0,freq_int=0.001):
     alpha = 1.0
     
     # TMA scaling factor 
-    omh = 2.0*np.pi*freq*(h/9.81)**0.5
-    phi = 1.0 - 0.5 * (2.0 - omh)**2
-    phi[omh<1.0] = (0.5*omh**2)[omh<1.0]
-    phi[omh>2.0] = 1.0
+    omh = 2.0*np.pi*freq*(h[...,np.newaxis]/9.81)**0.5
+    phi = np.where(omh < 1.0,0.5*omh**2,1.0 - 0.5 * (2.0 - omh)**2)
+    phi[omh > 2.0] = 1.0
     
     # Generate spectrum
-    s_tma = (alpha * 9.81**2 * (2.0*np.pi)**-4 * (freq**-5) * phi *
-             np.exp(-1.25 * (freq_peak/freq)**4) *
-             gamma ** np.exp(-1.0*((freq - freq_peak)**2)
-                             /(2.0*(delta**2)*freq_peak**2)))
+    return (alpha * 9.81**2 * (2.0*np.pi)**-4 * (freq**-5) * phi *
+            np.exp(-1.25 * (fp/freq)**4) *
+            gamma[...,np.newaxis] ** np.exp(-1.0*((freq - fp)**2)
+                                            /(2.0*(delta**2)*fp**2)))
+
+
+def tma_batch(freq_peak,gamma,h,Hmo,freq_min=0.01,freq_max=1.0,freq_int=0.001,
+              single=False,chunk_size=None):
+    '''
+    Generate many TMA spectra at once on a shared frequency grid.
+    
+    USAGE:
+    ------
+    spec,freq = tma_batch(freq_peak,gamma,h,Hmo)
     
+    PARAMETERS:
+    -----------
+    freq_peak    : Peak frequencies [Hz]
+    gamma        : Peak enhancement factors
+    h            : Water depths [m]
+    Hmo          : Significant wave heights [m] (not used, see tma)
+    freq_min     : (Optional) Minimum frequency [Hz]. Defaults to 0.01 Hz
+    freq_max     : (Optional) Maximum frequency [Hz]. Defaults to 1.0 Hz
+    freq_int     : (Optional) Frequency interval [Hz]. Defaults to 0.001 Hz
+    single       : (Optional) Return float32 spectra. Defaults to False.
+    chunk_size   : (Optional) If given, spec is a generator that yields the
+                   spectra in blocks of chunk_size cases.
     
-    # End of function
-    return s_tma
+    RETURNS:
+    --------
+    spec         : TMA spectra with shape (n_cases,n_freq), where n_cases is
+                   the broadcast shape of the inputs.
+    freq         : Frequency vector [Hz]. It is shared between calls with the
+                   same frequency parameters and is read-only.
+    
+    NOTES:
+    ------
+    Same spectral form as tma (no scaling, alpha = 1).
+    
+    '''
+    
+    freq,_ = _frequency_grid(freq_min,freq_max,freq_int)
+    freq_peak,gamma,h = np.broadcast_arrays(np.atleast_1d(freq_peak),
+                                            np.atleast_1d(gamma),
+                                            np.atleast_1d(h))
+    dtype = np.float32 if single else np.float64
+    
+    def block(sl):
+        return _tma_block(freq,freq_peak[sl],gamma[sl],h[sl]).astype(dtype)
+    
+    return _spectra_output(block,freq_peak.shape[0],chunk_size),freq
+
+
+def _spectra_output(block,n_cases,chunk_size):
+    '''
+    Return all spectra as an array or as a generator of blocks along the 
+    leading axis of the cases.
+    '''
+    
+    if chunk_size is None:
+        return block(slice(None))
+    
+    def generator():
+        for i0 in range(0,n_cases,chunk_size):
+            yield block(slice(i0,i0 + chunk_size))
+    
+    return generator()
 
 
 
 #===============================================================================
 # Wave length
 #===============================================================================
-def wave_length(period,h):
+def wave_length(period,h,table=None,verbose=False):
     '''
     Compute wave length using linear wave theory
     
@@ -485,34 +1266,132 @@ def wave_length(period,h):
     ----------
     period   : wave period [s]
     h        : water depth [m]
+    table    : (Optional) Use a dispersion lookup table (see dispersion)
+    verbose  : (Optional) Print the deep and shallow water approximations.
+               Defaults to False.
     
     Results
     -------
     wl_int   : real wave length [m]
     
-    Screen output
-    -------------
+    Screen output (verbose only)
+    ----------------------------
     wl_deep  : deep water wave length [m]
     wl_sha   : shallow water wave length [m]
     
     '''
     
-    wl_deep = 9.81 * period**2 / 2.0 / np.pi
-    wl_sha = period * np.sqrt(9.81 * h)
-    k = dispersion(period,h)
-    wl_int = 9.81 / 2.0 / np.pi * period**2 * np.tanh(k*h)
-    
-    print(' ')
-    print('---------------------------------------------------------')
-    print('Wave Length deep water approx      = ' + np.str(wl_deep) + ' m')
-    print('Wave Length shallow water approx   = ' + np.str(wl_sha) + ' m')
-    print('Wave Length linear wave theory     = ' + np.str(wl_int) + ' m')
-    print('---------------------------------------------------------')
-    print(' ')
+    k = dispersion(period,h,table=table)
+    wl_int = 9.81 / 2.0 / np.pi * np.asarray(period)**2 * np.tanh(k*h)
+    
+    if verbose:
+        wl_deep = 9.81 * np.asarray(period)**2 / 2.0 / np.pi
+        wl_sha = np.asarray(period) * np.sqrt(9.81 * np.asarray(h))
+        print(' ')
+        print('---------------------------------------------------------')
+        print('Wave Length deep water approx      = ' + str(wl_deep) + ' m')
+        print('Wave Length shallow water approx   = ' + str(wl_sha) + ' m')
+        print('Wave Length linear wave theory     = ' + str(wl_int) + ' m')
+        print('---------------------------------------------------------')
+        print(' ')
+    
+    return _unwrap(wl_int)
+
     
-    return wl_int
+#===============================================================================
+# Gridded linear wave kinematics
+#===============================================================================
+WaveKinematics = collections.namedtuple('WaveKinematics',
+                                        ['k','L','C','Cg','n','Ks'])
 
+# Memoized wave kinematics (most recently used last)
+_kinematics_cache = collections.OrderedDict()
+_kinematics_cache_size = 8
+
+def wave_kinematics(period,h,single=False,table=None,cache=True):
+    '''
+    Linear wave kinematics on whole grids in one vectorized pass.
+    
+    USAGE:
+    ------
+    wk = wave_kinematics(period,h,single,table,cache)
+    wk.k, wk.L, wk.C, wk.Cg, wk.n, wk.Ks
+    
+    PARAMETERS:
+    -----------
+    period   : Wave period [s] (scalar or numpy array)
+    h        : Water depth [m] (scalar or numpy array, e.g. a 2D or 3D grid)
+    single   : (Optional) Return float32 arrays. Defaults to False.
+    table    : (Optional) Use a dispersion lookup table (see dispersion)
+    cache    : (Optional) Memoize the results. Defaults to True.
     
+    RETURNS:
+    --------
+    WaveKinematics named tuple with the following fields broadcast to the 
+    shape of period and h
+    k        : Wave number [m**-1]
+    L        : Wave length [m]
+    C        : Phase velocity [m/s]
+    Cg       : Group velocity [m/s]
+    n        : Cg/C
+    Ks       : Shoaling coefficient (Cg_deep/Cg)**0.5
+    
+    NOTES:
+    ------
+    Nothing is printed to the screen. Points with h <= 0 are NaN.
+    
+    The results are memoized on a hash of the bathymetry, the periods and 
+    the options so repeated calls with the same grid (e.g. from different 
+    pre- and post-processing tools) return the cached arrays. The cached 
+    arrays are read-only, copy them before modifying them in place.
+    
+    '''
+    
+    period = np.asarray(period,dtype=np.float64)
+    h = np.asarray(h,dtype=np.float64)
+    
+    # Look for memoized results
+    if cache:
+        key = hashlib.sha1()
+        for arr in (period,h):
+            key.update(str(arr.shape).encode())
+            key.update(np.ascontiguousarray(arr).tobytes())
+        key.update(str((single,table)).encode())
+        key = key.hexdigest()
+        if key in _kinematics_cache:
+            wk = _kinematics_cache.pop(key)
+            _kinematics_cache[key] = wk
+            return wk
+    
+    dtype = np.float32 if single else np.float64
+    
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        k = np.asarray(dispersion(period,h,table=table)).astype(dtype)
+        sigma = ((2.0*np.pi)/period).astype(dtype)
+        kh2 = np.minimum(2.0*k*h.astype(dtype),700.0)
+        
+        L = (2.0*np.pi)/k
+        C = sigma/k
+        n = 0.5*(1.0 + kh2/np.sinh(kh2))
+        Cg = n*C
+        
+        # Shoaling coefficient referenced to deep water group velocity
+        Ks = (9.81/(2.0*sigma)/Cg)**0.5
+    
+    wk = WaveKinematics(*[_unwrap(np.asarray(aa,dtype=dtype)) 
+                          for aa in (k,L,C,Cg,n,Ks)])
+    
+    if cache:
+        for aa in wk:
+            if isinstance(aa,np.ndarray):
+                aa.setflags(write=False)
+        _kinematics_cache[key] = wk
+        while len(_kinematics_cache) > _kinematics_cache_size:
+            _kinematics_cache.popitem(last=False)
+    
+    return wk
+
+
 #===============================================================================
 # JONSWAP Spectrum
 #===============================================================================
@@ -551,59 +1430,138 @@ def jonswap(freq_peak,Hmo,gamma=3.3,freq_min=0.01,freq_max=1.0,
     Notes
     -----
     Need to add directional dispersion of the spectrum
+    See jonswap_batch to generate many spectra at once.
     
     '''
     
-    # For code development only -----------------------------------------------
-    #freq_peak = 1.0/10.0
-    #gamma = 3.3
-    #freq_min = 0.01
-    #freq_max = 0.5
-    #freq_int = 0.001
-    #Hmo = 1.0
-    # -------------------------------------------------------------------------
-        
-    # Create frequency vector
-    freq = np.arange(freq_min,freq_max+freq_int,freq_int)
-      
+    spec_jonswap,freq = jonswap_batch(freq_peak,Hmo,gamma,freq_min,freq_max,
+                                      freq_int,goda)
+    spec_jonswap = spec_jonswap.reshape(np.broadcast(freq_peak,Hmo,gamma).shape
+                                        + freq.shape)
+    
+    # End of function
+    return spec_jonswap,freq.copy()
+
+
+def _jonswap_block(freq,weights,freq_peak,Hmo,gamma,goda):
+    '''
+    JONSWAP spectra for a block of cases (leading axes) and frequencies (last)
+    '''
+    
+    fp = freq_peak[...,np.newaxis]
+    gamma = gamma[...,np.newaxis]
+    
     # Constants for peak enhancement factor
-    sigma = np.ones_like(freq)*0.07
-    sigma[freq>freq_peak] = 0.09
+    sigma = np.where(freq > fp,0.09,0.07)
+    
+    # Spectral shape
+    spec = ((freq**-5) * np.exp(-1.25 * ((freq/fp)**-4)) *
+            gamma ** (np.exp(-1.0 * (freq/fp - 1.0)**2 / (2.0 * sigma**2))))
     
     # Goda's formulation 
     if goda:
         # Beta parameter
         beta = (0.0624/(0.230 + 0.0336*gamma - 0.185*((1.9 + gamma)**-1)) *
                 (1.094 - 0.01915*np.log(gamma)))
-       
-        # Generate spectrum
-        spec_jonswap = (beta * (Hmo**2) * (freq_peak**4) * (freq**-5) *
-                        np.exp(-1.25 * ((freq/freq_peak)**-4)) *
-                        gamma ** (np.exp(-1.0 * (freq/freq_peak - 1.0)**2 / 
-                                         (2.0 * sigma**2)))) 
+        spec *= beta * (Hmo[...,np.newaxis]**2) * (fp**4)
         
     else:
-               
-        # Generate spectrum
-        spec_jonswap = ((freq**-5) *
-                        np.exp(-1.25 * ((freq/freq_peak)**-4)) *
-                        gamma ** (np.exp(-1.0 * (freq/freq_peak - 1.0)**2 / 
-                                         (2.0 * sigma**2))))
-        
         # Scale parameter to match wave height energy in deep water
         # I am not sure this is the right way to proceed but I'll still do it.
-        alpha = 1.0/16.0 * Hmo**2 / np.trapz(spec_jonswap,freq)
-        spec_jonswap = spec_jonswap * alpha
-        
+        alpha = 1.0/16.0 * Hmo**2 / np.dot(spec,weights)
+        spec *= alpha[...,np.newaxis]
     
-    # End of function
-    return spec_jonswap,freq
+    return spec
+
+
+def jonswap_batch(freq_peak,Hmo,gamma=3.3,freq_min=0.01,freq_max=1.0,
+                  freq_int=0.001,goda=False,single=False,chunk_size=None):
+    '''
+    Generate many JONSWAP spectra at once on a shared frequency grid.
+    
+    USAGE:
+    ------
+    spec,freq = jonswap_batch(freq_peak,Hmo,gamma)
+    
+    PARAMETERS:
+    -----------
+    freq_peak    : Peak frequencies [Hz]
+    Hmo          : Significant wave heights [m]
+    gamma        : (Optional) Peak enhancement factors. Defaults to 3.3
+    freq_min     : (Optional) Minimum frequency [Hz]. Defaults to 0.01 Hz
+    freq_max     : (Optional) Maximum frequency [Hz]. Defaults to 1.0 Hz
+    freq_int     : (Optional) Frequency interval [Hz]. Defaults to 0.001 Hz
+    goda         : (Optional) Use Goda's approximation (see jonswap)
+    single       : (Optional) Return float32 spectra. Defaults to False.
+    chunk_size   : (Optional) If given, spec is a generator that yields the
+                   spectra in blocks of chunk_size cases.
+    
+    RETURNS:
+    --------
+    spec         : JONSWAP spectra with shape (n_cases,n_freq), where 
+                   n_cases is the broadcast shape of the inputs.
+    freq         : Frequency vector [Hz]. It is shared between calls with the
+                   same frequency parameters and is read-only.
+    
+    NOTES:
+    ------
+    The spectra are computed in double precision and converted to float32
+    after scaling if single is True. In generator mode only one block is 
+    kept in memory at a time, e.g.
+        specs,freq = jonswap_batch(fp,hs,chunk_size=10000)
+        for spec in specs:
+            ...
+    
+    '''
+    
+    freq,weights = _frequency_grid(freq_min,freq_max,freq_int)
+    freq_peak,Hmo,gamma = np.broadcast_arrays(np.atleast_1d(freq_peak),
+                                              np.atleast_1d(Hmo),
+                                              np.atleast_1d(gamma))
+    dtype = np.float32 if single else np.float64
+    
+    def block(sl):
+        return _jonswap_block(freq,weights,freq_peak[sl],Hmo[sl],gamma[sl],
+                              goda).astype(dtype)
+    
+    return _spectra_output(block,freq_peak.shape[0],chunk_size),freq
 
 
 
 #===============================================================================
 # Add directional distribution to spectrum
 #===============================================================================
+# Normalized spreading kernels that do not depend on time
+_spreading_kernels = collections.OrderedDict()
+_spreading_kernels_size = 32
+
+def _spreading_kernel(peak_dir,m,dirs,out=None):
+    '''
+    Normalized cos(0.5*(dirs - peak_dir))**(2m) distribution. peak_dir, m 
+    and dirs are in radians, dirs runs along the last axis. The kernel is 
+    built in place in out if given.
+    '''
+    
+    peak_dir = np.asarray(peak_dir)[...,np.newaxis]
+    m = np.asarray(m)[...,np.newaxis]
+    if out is None:
+        out = np.empty(np.broadcast(peak_dir,m,dirs).shape)
+    
+    # Compute directional spread (absolute value avoids NaN for non-integer
+    # m when |dirs - peak_dir| > pi)
+    np.subtract(dirs,peak_dir,out=out)
+    out *= 0.5
+    np.cos(out,out=out)
+    np.abs(out,out=out)
+    np.power(out,2.0*m,out=out)
+    
+    # Normalize (trapezoidal integration over directions)
+    norm = np.dot(out,_trapz_weights(dirs))
+    out /= norm[...,np.newaxis]
+    
+    return out
+
+
 def directional_spreading(spec,peak_dir,m,dirs=None):
     """
     This function computes a directionally spread spectrum from a frequency
@@ -611,7 +1569,8 @@ def directional_spreading(spec,peak_dir,m,dirs=None):
     
     PARAMETERS:
     -----------
-    spec         : frequency spectrum (as vector) 
+    spec         : frequency spectrum, the last axis must be frequency, e.g.
+                   (freq,) or (time,freq)
     peak_dir     : Peak wave direction in Nautical convention [degrees]
     m            : Directional width [cos(theta)**2m]
     dirs         : (Optional) vector of directions. If not given, the spectrum
@@ -620,7 +1579,7 @@ def directional_spreading(spec,peak_dir,m,dirs=None):
     RETURNS:
     --------
     dir_spec     : Directional spectrum in the same units given by the input
-                   spectrum by degrees.
+                   spectrum by degrees. Shape is spec.shape + (dirs.shape[0],)
     dirs         : Vector with directions
     
     NOTES:
@@ -629,33 +1588,58 @@ def directional_spreading(spec,peak_dir,m,dirs=None):
       (is blowing) from with respect to the true north measured clockwise. 
     To recover the significant wave height
        4.004 * np.trapz(np.trapz(dir_spec,dirs,axis=-1),freq)**0.5
+    peak_dir and m can be scalars or arrays that broadcast against spec. For
+      example, m with shape (freq,) gives frequency dependent spreading and 
+      peak_dir[:,np.newaxis] gives one peak direction per time of a 
+      (time,freq) spectrum.
+    The full (time,freq,dir) array is built in place, no intermediate array
+      larger than the output is allocated. When peak_dir and m do not vary in
+      time the normalized spreading kernels are cached and reused.
     """
    
     # If direction vector is not passed as argument the directional distribution
     # will be computed every five degrees.
-    if dirs == None:
+    if dirs is None:
         dirs = np.arange(0,360,5)
+    
+    spec = np.asarray(spec,dtype=np.float64)
+    peak_dir = np.asarray(peak_dir,dtype=np.float64)
+    m = np.asarray(m,dtype=np.float64)
         
     # Change directions to radians for internal computations
-    peak_dir = np.pi / 180.0 * peak_dir
-    dirs = np.pi / 180.0 * dirs
-        
-    # Compute directional spread
-    g = np.cos(0.5*(dirs - peak_dir))**(2*m)
-    g = g / np.trapz(g,dirs)
-    
-    # Generate the directionally spread spectrum
-    dir_spec = np.zeros((spec.shape[0],dirs.shape[0]))
-    for aa in range(spec.shape[0]):
-        dir_spec[aa,:] = spec[aa] * g
+    dirs_rad = np.pi / 180.0 * np.asarray(dirs,dtype=np.float64)
     
     # Rescale the spectrum for dimensions of [m2/Hz-deg] if the input spectrum 
-    # has units of [m2/Hz]. 
-    dir_spec = dir_spec * 180.0 / np.pi
-    dirs = dirs * 180.0 / np.pi
+    # has units of [m2/Hz] (the kernel is normalized in radians). 
+    scale = np.pi / 180.0
+    
+    if np.broadcast(peak_dir,m).nd <= 1:
+        
+        # Kernel is at most frequency dependent, use the cache
+        key = (peak_dir.tobytes(),peak_dir.shape,m.tobytes(),m.shape,
+               dirs_rad.tobytes())
+        if key in _spreading_kernels:
+            g = _spreading_kernels.pop(key)
+        else:
+            g = _spreading_kernel(np.pi / 180.0 * peak_dir,m,dirs_rad)
+            g *= scale
+            g.setflags(write=False)
+        _spreading_kernels[key] = g
+        while len(_spreading_kernels) > _spreading_kernels_size:
+            _spreading_kernels.popitem(last=False)
+        
+        dir_spec = spec[...,np.newaxis] * g
+        
+    else:
+        
+        # Build the time dependent kernels directly in the output array
+        shape = np.broadcast(spec,peak_dir,m).shape + dirs_rad.shape
+        dir_spec = _spreading_kernel(np.pi / 180.0 * peak_dir,m,dirs_rad,
+                                     out=np.empty(shape))
+        dir_spec *= (spec * scale)[...,np.newaxis]
     
     # Return directional spectrum
-    return dir_spec,dirs
+    return dir_spec,np.asarray(dirs,dtype=np.float64)
     
 
 #===============================================================================
@@ -742,17 +1726,96 @@ def eta_bulk_params(eta,ot,band_ave=False,window=False):
     return bwp
         
         
+#===============================================================================
+# Bulk wave parameters from many gauges using segment averaged spectra
+#===============================================================================
+def eta_bulk_params_welch(eta,ot,nperseg=1024,window='hann',overlap=0.5,
+                          conf_lev=0.95,gauge_chunk=None):
+    """
+    Compute bulk wave parameters from water surface elevation time series
+    at many gauges using Welch (segment averaged) spectra.
+    
+    Parameters:
+    -----------
+    eta         : Water surface elevation [m] with shape (time,gauges). Can 
+                  also be a netCDF4 variable (see gauge_chunk).
+    ot          : Time vector [s]
+    nperseg     : (Optional) Number of points per segment. Defaults to 1024
+    window      : (Optional) Window applied to each segment (see 
+                  scipy.signal.get_window). Defaults to 'hann'
+    overlap     : (Optional) Fraction of overlap between segments. Defaults
+                  to 0.5
+    conf_lev    : (Optional) Confidence level. Defaults to 0.95
+    gauge_chunk : (Optional) Number of gauges processed at once. If given, 
+                  eta is read lazily in blocks of gauges, so it can be a 
+                  netCDF4 variable larger than memory.
+    
+    Output:
+    -------
+    Dictionary containing
+    freq       : Spectral frequencies [Hz]
+    spec       : Wave variance spectra [m**2/Hz] with shape (freq,gauges)
+    cl         : Confidence levels on the spectral estimates (2,freq,gauges)
+    dof        : Equivalent degrees of freedom of the spectral estimates
+    Hs,H1,Tp,Tp_fit,Tm01,Tm02,Te,Sw : Bulk parameters for every gauge (see
+                 fspec_bulk_params)
+    
+    Notes:
+    ------
+    The spectra of all segments of all gauges (in a chunk) are computed with
+    one batched real FFT (see gsignal.psd_welch). The segment windowing is
+    normalized by the window power so no variance correction is required. 
+    The degrees of freedom account for the overlap between segments.
+    
+    """
+    
+    # Time series information
+    ngauges = np.shape(eta)[1]
+    dt = ot[1] - ot[0]
+    if gauge_chunk is None:
+        gauge_chunk = ngauges
+    
+    for g0 in range(0,ngauges,gauge_chunk):
+        
+        # Read gauges
+        sl = slice(g0,min(g0 + gauge_chunk,ngauges))
+        etaw = np.asarray(eta[:,sl],dtype=np.float64)
+        
+        # Compute variance spectrum
+        freq,spec,dof = gsignal.psd_welch(etaw,dt,nperseg,window,overlap)
+        
+        # Bulk parameters
+        bwp = fspec_bulk_params(freq,spec,axis=0)
+        
+        # Allocate output
+        if g0 == 0:
+            out = {'freq':freq,'dof':dof,
+                   'spec':np.empty((freq.shape[0],ngauges))}
+            for key in bwp:
+                out[key] = np.empty((ngauges,))
+        out['spec'][:,sl] = spec
+        for key in bwp:
+            out[key][sl] = bwp[key]
+    
+    # Confidence levels on the spectral estimates
+    out['cl'] = gsignal.psd_ci(out['spec'],conf_lev,out['dof'])
+    
+    return out
+        
+        
 #===============================================================================
 # Function to compute bulk wave parameters from frequency spectrum        
 #===============================================================================
-def fspec_bulk_params(freq,spec):
+def fspec_bulk_params(freq,spec,axis=-1):
     """
     Function to compute bulk wave parameters from frequency spectrum
     
     Parameters:
     -----------
     freq    : Vector of spectral frequencies [Hz]
-    spec    : Frequency spectrum [m2/Hz]
+    spec    : Frequency spectrum [m2/Hz]. Can be N-dimensional, e.g. 
+              (station,time,freq) 
+    axis    : (Optional) Frequency axis of spec. Defaults to the last one.
     
     Returns:
     --------
@@ -772,18 +1835,29 @@ def fspec_bulk_params(freq,spec):
     - mn are the different spectral moments
     - First frequency will be discarded from the analysis. It is assumed to be
       the zeroth-frequency.
+    - For N-dimensional spectra every parameter is an array with the shape of
+      spec without the frequency axis. All moments are computed in a single
+      matrix product and Tp_fit uses the closed form vertex of the parabola 
+      through the peak and its two neighbours (NaN if the peak is at the 
+      first or last frequency).
         
     """
     
+    # Frequency axis last
+    spec = np.moveaxis(np.asarray(spec,dtype=np.float64),axis,-1)
+    
     # Remove zeroth frequencies
-    spec = spec[1:]
-    freq = freq[1:]
-        
-    # Compute spectral moments
-    moment0 = np.trapz(spec,freq,axis=-1)
-    moment1 = np.trapz(spec*freq,freq,axis=-1)
-    moment2 = np.trapz(spec*(freq)**2,freq,axis=-1)
-    momentn1 = np.trapz(spec*(freq)**-1,freq,axis=-1)
+    spec = spec[...,1:]
+    freq = np.asarray(freq,dtype=np.float64)[1:]
+        
+    # Compute spectral moments (trapezoidal integration)
+    weights = _trapz_weights(freq)
+    moments = np.dot(spec,np.array([weights,weights*freq,weights*freq**2,
+                                    weights/freq]).T)
+    moment0 = moments[...,0]
+    moment1 = moments[...,1]
+    moment2 = moments[...,2]
+    momentn1 = moments[...,3]
                        
     # Wave heights
     Hs = 4.004 * (moment0)**0.5
@@ -803,21 +1877,25 @@ def fspec_bulk_params(freq,spec):
     Tm02 = (moment0 / moment2)**0.5
     
     # Peak wave period
-    freq_max_ind = np.argmax(spec) 
+    freq_max_ind = np.argmax(spec,axis=-1) 
     Tp = freq[freq_max_ind]**-1
             
     # Peak wave period using a quadratic fit over the largest frequencies
-    if freq_max_ind == 0:
-        Tp_fit = np.nan
-    elif freq_max_ind == freq.shape[0]-1:
-        Tp_fit = np.nan
-    else:
-        minfreq = freq_max_ind - 1
-        maxfreq = freq_max_ind + 2
-        tmp_fit = np.polyfit(freq[minfreq:maxfreq],spec[minfreq:maxfreq],2)
-        Tp_fit = (-1.0 * tmp_fit[1] / (2.0* tmp_fit[0]))**-1
-        
+    ind = np.clip(freq_max_ind,1,freq.shape[0]-2)[...,np.newaxis]
+    ym = np.take_along_axis(spec,ind-1,axis=-1)[...,0]
+    y0 = np.take_along_axis(spec,ind,axis=-1)[...,0]
+    yp = np.take_along_axis(spec,ind+1,axis=-1)[...,0]
+    ind = ind[...,0]
+    dm = freq[ind] - freq[ind-1]
+    dp = freq[ind] - freq[ind+1]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        fit_freq = freq[ind] - 0.5*((dm**2*(y0 - yp) - dp**2*(y0 - ym))/
+                                    (dm*(y0 - yp) - dp*(y0 - ym)))
+        Tp_fit = np.where((freq_max_ind == 0) | 
+                          (freq_max_ind == freq.shape[0]-1),
+                          np.nan,fit_freq**-1)
 
     # Exit function
-    return {'Hs':Hs,'H1':H1,'Tp':Tp,'Tp_fit':Tp_fit,'Tm01':Tm01,'Tm02':Tm02,
-            'Te':Te,'Sw':Sw}
+    return {'Hs':_unwrap(Hs),'H1':_unwrap(H1),'Tp':_unwrap(Tp),
+            'Tp_fit':_unwrap(Tp_fit),'Tm01':_unwrap(Tm01),
+            'Tm02':_unwrap(Tm02),'Te':_unwrap(Te),'Sw':_unwrap(Sw)}
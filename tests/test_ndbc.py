@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pynmd.data.ndbc
+
+Run with the package on the PYTHONPATH (see INSTALL.txt):
+  >> python -m pytest tests
+"""
+
+from __future__ import division,print_function
+
+import os
+
+import numpy as np
+import netCDF4
+import pytest
+
+import pynmd.data.ndbc as gndbc
+
+
+#===============================================================================
+# Synthetic NDBC files
+#===============================================================================
+_FREQ = np.array([0.03,0.05,0.07,0.1,0.13,0.17,0.22,0.3,0.4])
+
+def _write_spec_year(folder,year,nrec,seed,buoyid='46029'):
+    '''
+    Write the five hourly spectral files of one year
+    '''
+    
+    rng = np.random.RandomState(seed)
+    time = (np.datetime64('%d-01-01T00:50' % year) + 
+            np.arange(nrec)*np.timedelta64(1,'h'))
+    shape = (nrec,_FREQ.shape[0])
+    values = {'w':rng.uniform(0.0,2.0,shape),
+              'd':rng.uniform(0.0,360.0,shape),
+              'i':rng.uniform(0.0,360.0,shape),
+              'j':rng.uniform(0.1,0.9,shape),
+              'k':rng.uniform(0.1,0.9,shape)}
+    for letter in values:
+        filename = os.path.join(folder,buoyid + letter + str(year) + '.txt')
+        with open(filename,'w') as f:
+            f.write('#YY  MM DD hh mm ' + 
+                    ' '.join(['%.4f' % x for x in _FREQ]) + '\n')
+            f.write('#yr  mo dy hr mn\n')
+            for tt,row in zip(time,values[letter]):
+                f.write(str(tt.astype(object).strftime('%Y %m %d %H %M ')) + 
+                        ' '.join(['%.2f' % x for x in row]) + '\n')
+
+
+def _read_nc(ncfile):
+    nc = netCDF4.Dataset(ncfile)
+    data = dict((name,np.array(nc.variables[name][:])) 
+                for name in nc.variables)
+    nc.close()
+    return data
+
+
+#===============================================================================
+# Text readers
+#===============================================================================
+_BULK_TEXT = (
+    '#YY  MM DD hh mm WDIR WSPD GST  WVHT   DPD   APD MWD   PRES  ATMP  ' + 
+    'WTMP  DEWP  VIS  TIDE\n' + 
+    '#yr  mo dy hr mn degT m/s  m/s     m   sec   sec degT   hPa  degC  ' + 
+    'degC  degC  nmi    ft\n' + 
+    '2011 01 01 00 50 250  5.1  6.3  1.52 10.00  6.20 270 1013.2  10.1  ' + 
+    '11.2 999.0 99.0 99.00\n' + 
+    '2011 01 01 01 50 999  4.8  6.0 99.00 99.00 99.00 999 9999.0  10.0  ' + 
+    '11.1 999.0 99.0 99.00\n')
+
+def _parse_bulk(folder,loadtxt_c,monkeypatch):
+    monkeypatch.setattr(gndbc,'_LOADTXT_C',loadtxt_c)
+    gndbc._SCHEMA_CACHE.clear()
+    filename = os.path.join(folder,'46029h2011.txt')
+    with open(filename,'w') as f:
+        f.write(_BULK_TEXT)
+    return gndbc.read_bulk(filename)
+
+
+def test_read_bulk_numeric_readers(tmpdir,monkeypatch):
+    '''
+    The loadtxt and fromstring readers give the same bulk data
+    '''
+    
+    for loadtxt_c in [True,False]:
+        data = _parse_bulk(str(tmpdir),loadtxt_c,monkeypatch)
+        np.testing.assert_array_equal(data['WVHT'],[1.52,np.nan])
+        np.testing.assert_array_equal(data['WDIR'],[250.0,np.nan])
+        np.testing.assert_array_equal(data['PRES'],[1013.2,np.nan])
+        np.testing.assert_array_equal(np.diff(data['wave_time']),[3600.0])
+
+
+def test_read_spec_numeric_readers(tmpdir,monkeypatch):
+    '''
+    The loadtxt and fromstring readers give the same spectra and both 
+    reject records that do not match the header
+    '''
+    
+    folder = str(tmpdir)
+    _write_spec_year(folder,2011,5,0)
+    filename = os.path.join(folder,'46029w2011.txt')
+    
+    spec = {}
+    for loadtxt_c in [True,False]:
+        monkeypatch.setattr(gndbc,'_LOADTXT_C',loadtxt_c)
+        gndbc._SCHEMA_CACHE.clear()
+        spec[loadtxt_c] = gndbc.read_spec(filename)
+    assert spec[True]['values'].shape == (5,_FREQ.shape[0])
+    for name in ['freq','wave_time','values']:
+        np.testing.assert_array_equal(spec[True][name],spec[False][name])
+    
+    with open(filename,'a') as f:
+        f.write('2011 01 01 05 50 1.0 2.0\n')
+    for loadtxt_c in [True,False]:
+        monkeypatch.setattr(gndbc,'_LOADTXT_C',loadtxt_c)
+        with pytest.raises(ValueError):
+            gndbc.read_spec(filename)
+
+
+#===============================================================================
+# Incremental spectral updates
+#===============================================================================
+def test_spec2nc_reingest_overlapping_year(tmpdir):
+    '''
+    Re-ingesting a year already in the file (followed by a later year) 
+    gives the same file as a full rebuild
+    '''
+    
+    inc = str(tmpdir.mkdir('inc'))
+    full = str(tmpdir.mkdir('full'))
+    
+    _write_spec_year(inc,2010,30,0)
+    _write_spec_year(inc,2011,20,1)
+    gndbc.spec2nc(inc,dtheta=30,time_block=7,incremental=True)
+    
+    # Rewrite 2010 with longer records and new values
+    _write_spec_year(inc,2010,45,2)
+    for name in os.listdir(inc):
+        if '2010' in name:
+            os.utime(os.path.join(inc,name),(1,1))
+    gndbc.spec2nc(inc,dtheta=30,time_block=7,incremental=True)
+    
+    _write_spec_year(full,2010,45,2)
+    _write_spec_year(full,2011,20,1)
+    gndbc.spec2nc(full,dtheta=30,time_block=7)
+    
+    inc_data = _read_nc(os.path.join(inc,'46029_spec.nc'))
+    full_data = _read_nc(os.path.join(full,'46029_spec.nc'))
+    assert inc_data['dir_time'].shape[0] == 65
+    assert inc_data['wave_time'].shape[0] == 65
+    assert np.all(np.diff(inc_data['dir_time']) > 0)
+    for name in full_data:
+        np.testing.assert_array_equal(inc_data[name],full_data[name])
+
+
+#===============================================================================
+# Multi-buoy driver
+#===============================================================================
+def test_convert_buoys_missing_file(tmpdir,monkeypatch):
+    '''
+    A file that disappears before it is parsed is reported as a failure of
+    its station without stopping the other stations
+    '''
+    
+    folder = str(tmpdir)
+    _write_spec_year(folder,2011,10,0)
+    stations = gndbc.find_buoys(folder)
+    stations[('bulk','46050',folder)] = ['46050h2011.txt']
+    monkeypatch.setattr(gndbc,'find_buoys',lambda rootdir: stations)
+    
+    report = gndbc.convert_buoys(folder,processes=2,dtheta=30,verbose=False)
+    
+    bulk = report[('bulk','46050')]
+    assert len(bulk['failures']) == 1
+    assert 'No such file' in bulk['failures'][0][1]
+    assert np.isfinite(bulk['throughput'])
+    
+    spec = report[('spec','46029')]
+    assert spec['failures'] == []
+    assert spec['records'] == 50
+    assert os.path.isfile(os.path.join(folder,'46029_spec.nc'))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pynmd.data.signal
+
+Run with the package on the PYTHONPATH (see INSTALL.txt):
+  >> python -m pytest tests
+"""
+
+from __future__ import division,print_function
+
+import numpy as np
+import pytest
+
+import pynmd.data.signal as gsignal
+
+
+#===============================================================================
+# Cross-correlation
+#===============================================================================
+def test_cross_corr_pairs():
+    '''
+    Unknown pairs options raise ValueError
+    '''
+    
+    x = np.random.RandomState(0).randn(100,3)
+    rho,_ = gsignal.cross_corr(x,x,5,pairs='all')
+    assert rho.shape == (11,3,3)
+    with pytest.raises(ValueError):
+        gsignal.cross_corr(x,x,5,pairs='al')
+
+
+#===============================================================================
+# Slow Fourier transform
+#===============================================================================
+def test_slow_dft_irregular_times():
+    '''
+    With irregular times the default frequencies follow the record length
+    and not dt
+    '''
+    
+    N = 64
+    ot = 0.5*np.arange(N) + 0.1*np.sin(np.arange(N))
+    ot[-1] = 0.5*(N - 1)
+    yt = np.cos(2.0*np.pi*4.0/(0.5*N)*ot)
+    
+    yf = gsignal.slow_dft(yt,ot=ot)
+    yf_dt = gsignal.slow_dft(yt,dt=0.5,ot=ot)
+    np.testing.assert_allclose(yf,yf_dt)
+    assert np.argmax(np.abs(yf[:N//2])) == 4
+    
+    # Uniform times give the FFT whatever dt is
+    yf = gsignal.slow_dft(yt,dt=7.0,ot=0.5*np.arange(N))
+    np.testing.assert_allclose(yf,np.fft.fft(yt)/N,atol=1e-12)
+
+
+#===============================================================================
+# Skill accumulator
+#===============================================================================
+def test_skill_accumulator_empty():
+    '''
+    An accumulator without valid pairs returns NaN statistics and N=0
+    '''
+    
+    stats = gsignal.SkillAccumulator().result()
+    assert stats['N'] == 0
+    for key in ['rmse','nrmse','bias','si','r']:
+        assert np.isnan(stats[key])
+    
+    # Merging empty accumulators and all-NaN chunks keeps them empty
+    skill = gsignal.SkillAccumulator()
+    skill.merge(gsignal.SkillAccumulator())
+    skill.update(np.array([np.nan,1.0]),np.array([2.0,np.nan]))
+    stats = skill.result()
+    assert stats['N'] == 0
+    for key in ['rmse','nrmse','bias','si','r']:
+        assert np.isnan(stats[key])
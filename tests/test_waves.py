@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pynmd.physics.waves
+
+Run with the package on the PYTHONPATH (see INSTALL.txt):
+  >> python -m pytest tests
+"""
+
+from __future__ import division,print_function
+
+import numpy as np
+
+import pynmd.physics.waves as gwaves
+
+
+#===============================================================================
+# Linear dispersion
+#===============================================================================
+def test_dispersion_small_depth():
+    '''
+    Very shallow (but positive) depths give the shallow water wave number 
+    and only non-positive depths give NaN
+    '''
+    
+    h = np.array([1e-300,1e-20,1e-12,1e-6])
+    k = gwaves.dispersion(10.0,h)
+    np.testing.assert_allclose(k,2.0*np.pi/10.0/np.sqrt(9.81*h),rtol=1e-6)
+    assert np.all(np.isnan(gwaves.dispersion(10.0,np.array([0.0,-1.0]))))
+
+
+#===============================================================================
+# Stokes drift from directional spectra
+#===============================================================================
+def test_stokes_drift_spectral_direction_order():
+    '''
+    Drift must not depend on the ordering of the spectral directions
+    (ascending or WW3-style descending).
+    '''
+    
+    freq = np.linspace(0.05,0.4,30)
+    dirs = np.arange(0.0,360.0,10.0)
+    h = np.array([20.0])
+    z = np.array([-5.0,-1.0,0.0])
+    
+    # Swell from 250 deg with a cos**2s spreading
+    fspec = np.exp(-0.5*((freq - 0.1)/0.02)**2)
+    dspec = np.cos(0.5*(dirs - 250.0)*np.pi/180.0)**20
+    spec = (fspec[:,None]*dspec[None,:])[None,None,:,:]
+    
+    uasc,vasc = gwaves.stokes_drift_spectral(spec,freq,dirs,h,z)
+    
+    # WW3 order: 90, 80, ..., -260 wrapped to [0,360)
+    ww3 = np.mod(90.0 - np.arange(36)*10.0,360.0)
+    ind = np.searchsorted(dirs,ww3)
+    udes,vdes = gwaves.stokes_drift_spectral(spec[...,ind],freq,ww3,h,z)
+    
+    assert np.all(np.isfinite(uasc))
+    assert np.abs(uasc).max() > 0.0
+    np.testing.assert_allclose(udes,uasc,rtol=1e-10,atol=1e-14)
+    np.testing.assert_allclose(vdes,vasc,rtol=1e-10,atol=1e-14)
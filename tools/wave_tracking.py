@@ -352,20 +352,22 @@ def time_lag(eta,ot,lags=None):
     # Time interval
     dt = ot[2] - ot[1]
     
+    # Find the time lagged cross-correlation between adjacent points to adjust
+    # the time series (all pairs in one call)
+    rho,stats = gsignal.cross_corr(eta[:,:-1],eta[:,1:],lags)
+    
     # Loop over points
     for aa in range(1,cum_lag_time.shape[0]):
         
-        # Find the time lagged cross-correlation to adjust the time series
-        rho,stats = gsignal.cross_corr(eta[:,aa-1],eta[:,aa],lags)
-        
         # Identify the maximum auto correlation
-        if np.max(rho) < 0.8:
+        if np.max(rho[:,aa-1]) < 0.8:
             print('Warning: Correlation is less than 0.8')
-            print('  aa = ' + np.str(aa))
-            print('  r = ' + np.str(np.max(rho)))
+            print('  aa = ' + str(aa))
+            print('  r = ' + str(np.max(rho[:,aa-1])))
             
         # Compute cumulative lag time
-        cum_lag_time[aa] = cum_lag_time[aa-1] + stats[np.argmax(rho),0] * dt
+        cum_lag_time[aa] = (cum_lag_time[aa-1] + 
+                            stats[np.argmax(rho[:,aa-1]),0,aa-1] * dt)
     
     # Create output array based on lag time
     ot_lag = np.zeros_like(eta)